@@ -0,0 +1,804 @@
+# asgi.py - async serving mode for the Cholo Pay API
+
+"""ASGI entry point for main.py: ``uvicorn asgi:app`` (or any ASGI server).
+
+The busiest endpoints (/pay, logins, ticket validity checks, vehicle fares,
+user details and the paged user/owner ticket listings) run as coroutines on the
+Firestore AsyncClient. One worker process keeps many of them in flight
+while they wait on Firestore, and reads that do not depend on each other
+are issued together. Every other route, and streamed listings, run the
+Flask views on a pool of ASGI_THREADS threads. The SSE ticket stream and the
+long-poll feed hold a thread for as long as the client stays connected, so
+they run on their own pool of ASGI_STREAM_THREADS; once every one of those is
+taken, further streams get a 503 instead of queueing. A stream gives its
+thread back once its client disconnects.
+
+Both paths go through Flask's request hooks, error handlers and response
+helpers, so status codes, bodies and headers (CORS, X-Request-ID, metrics)
+match the WSGI app. On the SQLite backend the async endpoints call the
+store on the thread pool instead of an async client.
+"""
+
+import asyncio
+import contextvars
+import functools
+import io
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from flask import jsonify, request
+
+import firestore_storage
+import main
+from main import _log
+from storage import (
+    IdempotentReplay, PaymentError, UnknownCursor, archive_position, idempotency_id, ledger_entry, ledger_start, payment_entry_id
+)
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 32))
+ASGI_STREAM_THREADS = int(os.environ.get("ASGI_STREAM_THREADS", 64))
+# Custom-token RSA signatures for the login coroutines
+TOKEN_SIGNING_WORKERS = int(os.environ.get("TOKEN_SIGNING_WORKERS", min(4, os.cpu_count() or 1)))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi-wsgi')
+_stream_executor = ThreadPoolExecutor(max_workers=ASGI_STREAM_THREADS, thread_name_prefix='asgi-stream')
+_token_signer = ThreadPoolExecutor(max_workers=TOKEN_SIGNING_WORKERS, thread_name_prefix='token-signer')
+_open_streams = 0
+_background_writes = set()
+
+async def _in_thread(func, *args, **kwargs):
+    """Run blocking ``func`` on the pool, inside the calling request's context."""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_executor, call)
+
+def _write_in_background(coroutine):
+    """Start a write without holding up the response; failures are logged."""
+    task = asyncio.ensure_future(coroutine)
+    _background_writes.add(task)
+
+    def finished(task):
+        _background_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            _log.warning("⚠️ Background write failed: %s", task.exception())
+    task.add_done_callback(finished)
+
+# --- ASYNC DATASTORE METRICS ---
+# The AsyncClient's RPCs are metered into the same per-request usage as the
+# sync client's (see REQUEST METRICS in main.py).
+class _MeteredAsyncStream(main._MeteredStream):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not hasattr(self._responses, '__anext__'):
+            self._responses = self._responses.__aiter__()
+        waited = time.perf_counter()
+        try:
+            response = await self._responses.__anext__()
+        except StopAsyncIteration:
+            self._exhausted()
+            raise
+        finally:
+            self._waited(waited)
+        return self._count(response)
+
+class _MeteredAsyncFirestoreAPI(main._MeteredFirestoreAPI):
+    @staticmethod
+    async def _stream(rpc, method, *args, **kwargs):
+        usage = main._datastore_usage.get()
+        started = time.perf_counter()
+        return _MeteredAsyncStream(await method(*args, **kwargs), rpc, usage, started)
+
+    @staticmethod
+    async def _call(rpc, method, *args, **kwargs):
+        usage = main._datastore_usage.get()
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            main._rpc_finished(rpc, usage, started, kwargs.get('request', args[0] if args else None))
+
+# --- ASYNC STORAGE ---
+def _async_transactional(func):
+    """``firestore.async_transactional`` that defers importing Firestore to the first call."""
+    transactional = None
+
+    @functools.wraps(func)
+    async def run(transaction, *args, **kwargs):
+        nonlocal transactional
+        if transactional is None:
+            transactional = main.firestore_client.async_transactional(func)
+        return await transactional(transaction, *args, **kwargs)
+    return run
+
+@_async_transactional
+async def _run_payment_transaction(transaction, client, user_id, ticket_data, when, idempotency=None):
+    """firestore_storage._run_payment_transaction on the AsyncClient.
+
+    The Idempotency-Key record and the wallet are read in one batched get.
+    """
+    user_ref = client.collection('users').document(user_id)
+    refs = [user_ref]
+    if idempotency is not None:
+        idempotency_ref = client.collection('idempotencyKeys').document(
+            idempotency_id(idempotency['scope'], idempotency['key'])
+        )
+        refs.append(idempotency_ref)
+    snapshots = {snapshot.reference.path: snapshot async for snapshot in client.get_all(refs, transaction=transaction)}
+
+    if idempotency is not None:
+        existing = main._live_idempotency_record(snapshots[idempotency_ref.path])
+        if existing is not None:
+            raise IdempotentReplay(existing)
+
+    user_snapshot = snapshots[user_ref.path]
+    if not user_snapshot.exists:
+        raise PaymentError("User not found", 404)
+
+    fare = ticket_data['farePaid']
+    user_data = user_snapshot.to_dict()
+    user_balance = user_data.get('walletBalance', 0)
+    if user_balance < fare:
+        raise PaymentError("Insufficient funds", 400)
+
+    new_user_balance = user_balance - fare
+
+    entry_id = payment_entry_id(ticket_data['ticketId'])
+    seq, opening = ledger_start(user_id, user_data, when)
+    if opening is not None:
+        transaction.set(main._ledger_ref(user_id, opening['entryId'], client=client), opening)
+    transaction.update(user_ref, {'walletBalance': main.firestore.Increment(-fare), 'ledgerSeq': seq + 1})
+    transaction.set(main._ledger_ref(user_id, entry_id, client=client), ledger_entry(
+        user_id, 'payment', seq + 1, -fare, new_user_balance, when, entry_id,
+        ticketId=ticket_data['ticketId'], idempotencyKey=idempotency and idempotency['key']
+    ))
+    transaction.set(client.collection('tickets').document(ticket_data['ticketId']), ticket_data)
+    for stats_ref, stats_update in main._owner_stats_writes(
+        ticket_data['ownerId'], ticket_data['userId'], fare, when, client=client
+    ):
+        transaction.set(stats_ref, stats_update, merge=True)
+
+    if idempotency is not None:
+        idempotency['response']['newBalance'] = new_user_balance
+        transaction.set(idempotency_ref, idempotency)
+
+    return new_user_balance
+
+class AsyncFirestoreStorage:
+    """The FirestoreStorage operations the async endpoints use, on firestore.AsyncClient."""
+
+    def __init__(self):
+        self._client = None
+        self._metered = False
+
+    def open(self):
+        """Build the AsyncClient on the initialized Firebase app (blocking; call once)."""
+        if self._client is None:
+            main._init_firebase_app()
+            self._client = main._timed_import('firebase_admin.firestore_async').client()
+        return self._client
+
+    def meter(self):
+        """Meter the client's RPCs; call on the event loop, after ``open()``.
+
+        Building the async transport looks up the current event loop, so this
+        cannot run on a pool thread with ``open()``.
+        """
+        if self._metered or not main.METRICS_ENABLED:
+            return
+        self._metered = True
+        try:
+            self._client._firestore_api_internal = _MeteredAsyncFirestoreAPI(self._client._firestore_api)
+        except Exception as e:
+            _log.warning("⚠️ Datastore metrics unavailable: %s", e)
+
+    async def get_user(self, user_id):
+        user_doc = await self._client.collection('users').document(user_id).get()
+        return user_doc.to_dict() if user_doc.exists else None
+
+    async def get_users(self, user_ids, fields=None):
+        users_collection = self._client.collection('users')
+        user_refs = [users_collection.document(user_id) for user_id in user_ids]
+        if not user_refs:
+            return {}
+        return {
+            user_doc.id: user_doc.to_dict() if user_doc.exists else None
+            async for user_doc in self._client.get_all(user_refs, field_paths=fields)
+        }
+
+    async def ensure_wallet(self, user_id):
+        await self._client.collection('users').document(user_id).update({'walletBalance': main.firestore.Increment(0)})
+
+    async def get_vehicle(self, vehicle_id):
+        vehicle_doc = await self._client.collection('vehicles').document(vehicle_id).get()
+        if vehicle_doc.exists:
+            return vehicle_doc.to_dict()
+        # Not indexed yet: the sync lookup falls back to owners and backfills
+        return await _in_thread(main.store.get_vehicle, vehicle_id)
+
+    async def get_tickets(self, ticket_ids, fields=None):
+        tickets_collection = self._client.collection('tickets')
+        ticket_refs = [tickets_collection.document(ticket_id) for ticket_id in ticket_ids]
+        if not ticket_refs:
+            return {}
+        ticket_docs = [
+            ticket_doc async for ticket_doc in self._client.get_all(ticket_refs, field_paths=fields)
+            if ticket_doc.exists
+        ]
+        return {ticket['ticketId']: ticket for ticket in main._ticket_dicts(ticket_docs)}
+
+    async def ticket_page(self, field, value, limit, after, select=None):
+        """main._ticket_page: hot tickets from Firestore, then the archive tier."""
+        tickets_collection = self._client.collection('tickets')
+        query = tickets_collection.where(
+            filter=main.firestore.FieldFilter(field, '==', value)
+        ).order_by('timestamp', direction=main.firestore.Query.DESCENDING)
+        if select:
+            query = query.select(select)
+
+        position = archive_position(after)
+        tickets = []
+        if position is None:
+            if after:
+                cursor_doc = await tickets_collection.document(after).get()
+                if not cursor_doc.exists:
+                    raise UnknownCursor(after)
+                query = query.start_after(cursor_doc)
+            if limit:
+                query = query.limit(limit + 1)
+            tickets = list(main._ticket_dicts([ticket_doc async for ticket_doc in query.stream()]))
+        hot = len(tickets)
+
+        if not limit or hot <= limit:
+            # The hot tickets ran out inside this page
+            wanted = limit + 1 - hot if limit else None
+            tickets += await _in_thread(
+                lambda: list(itertools.islice(
+                    main.store.iter_archived_tickets(field, value, position, select), wanted
+                ))
+            )
+        if limit and len(tickets) > limit:
+            return tickets[:limit], main._page_cursor(tickets[limit - 1], archived=limit > hot)
+        return tickets, None
+
+    async def pay(self, user_id, ticket, when, idempotency=None):
+        return await _run_payment_transaction(
+            self._client.transaction(), self._client, user_id, firestore_storage._firestore_values(ticket), when, idempotency
+        )
+
+    async def get_idempotency_record(self, scope, key):
+        record_doc = await self._client.collection('idempotencyKeys').document(idempotency_id(scope, key)).get()
+        return main._live_idempotency_record(record_doc)
+
+class ThreadedStorage:
+    """Async wrapper that runs a synchronous Storage's calls on the thread pool."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def open(self):
+        return self._store
+
+    def meter(self):
+        """The sync engine's RPCs are already metered by main.py."""
+
+    def __getattr__(self, name):
+        method = getattr(self._store, name)
+
+        async def call(*args, **kwargs):
+            return await _in_thread(method, *args, **kwargs)
+        return call
+
+    async def ticket_page(self, field, value, limit, after, select=None):
+        return await _in_thread(main._ticket_page, field, value, limit, after, select)
+
+astore = AsyncFirestoreStorage() if main.store.name == 'firestore' else ThreadedStorage(main.store)
+_store_open = False
+
+async def _store_ready():
+    """``if not store`` for the async endpoints; the first call opens the clients."""
+    global _store_open
+    if not _store_open:
+        def open_store():
+            if not main.store:
+                return False
+            astore.open()
+            return True
+        _store_open = await _in_thread(open_store)
+        if _store_open:
+            astore.meter()
+    return _store_open
+
+# --- ASYNC HELPERS ---
+# Async counterparts of the main.py helpers that touch the datastore; the
+# cache handling and response shaping are main's own.
+async def _lookup_vehicle(vehicle_id):
+    entry = main._vehicle_cache.get(vehicle_id)
+    if entry is None:
+        entry = await astore.get_vehicle(vehicle_id)
+        if entry is not None:
+            main._vehicle_cache.set(vehicle_id, entry)
+    return entry
+
+async def _find_idempotent_record(scope, key):
+    record = main._idempotency_cache.get(f"{scope}:{key}")
+    if record is None:
+        record = await astore.get_idempotency_record(scope, key)
+        if record is not None:
+            main._remember_idempotent_response(record)
+    return record
+
+async def _attach_user_info(tickets):
+    user_info, missing = main._cached_user_info(tickets)
+    if missing:
+        try:
+            main._cache_user_info(user_info, await astore.get_users(missing, fields=main._USER_INFO_FIELDS))
+        except Exception as e:
+            _log.warning("⚠️ Error getting user details: %s", e)
+    return main._apply_user_info(tickets, user_info)
+
+async def _nothing():
+    return None
+
+def _custom_token_future(uid):
+    """A Future for a custom token for ``uid``: cached, already being signed, or queued on the signers.
+
+    Shares main._tokens_signing with the Flask views, so a uid is signed once
+    whichever path asks first.
+    """
+    token = main._cached_custom_token(uid)
+    if token is not None:
+        future = Future()
+        future.set_result(token)
+        return future
+
+    with main._tokens_signing_lock:
+        future = main._tokens_signing.get(uid)
+        if future is None:
+            future = main._tokens_signing[uid] = _token_signer.submit(main._sign_custom_token, uid)
+    future.add_done_callback(functools.partial(main._signing_finished, uid))
+    return future
+
+async def _login_token(email):
+    """(uid, custom token); cache misses wait on the pool and the token signers, not the loop."""
+    uid = main._cached_login_uid(email) or await _in_thread(main._fetch_login_uid, email)
+    return uid, await asyncio.wrap_future(_custom_token_future(uid))
+
+# --- ASYNC ENDPOINTS ---
+# Same logic and responses as the Flask views of the same name in main.py.
+async def login_user():
+    try:
+        data = request.get_json()
+        uid, custom_token = await _login_token(data['email'])
+
+        return jsonify({
+            "success": True,
+            "token": custom_token,
+            "uid": uid
+        })
+
+    except Exception as e:
+        _log.exception("❌ User login error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+async def login_owner():
+    try:
+        data = request.get_json()
+        uid, custom_token = await _login_token(data['email'])
+
+        return jsonify({
+            "success": True,
+            "token": custom_token,
+            "uid": uid
+        })
+
+    except Exception as e:
+        _log.exception("❌ Owner login error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+async def get_user_details(user_id):
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        _log.debug("🔍 Getting user details for: %s", user_id)
+
+        user_data = await astore.get_user(user_id)
+
+        if user_data is not None:
+            _log.debug("✅ User found: %s", user_data.get('fullName', 'Unknown'))
+
+            # Ensure walletBalance exists; the backfill does not hold up the response
+            if 'walletBalance' not in user_data:
+                user_data['walletBalance'] = 0
+                _write_in_background(astore.ensure_wallet(user_id))
+
+            return jsonify(main._serializable_user(user_data))
+        else:
+            _log.info("❌ User not found: %s", user_id)
+            return jsonify({"error": "User not found"}), 404
+
+    except Exception as e:
+        _log.exception("❌ Get user details error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+async def get_user_tickets(user_id):
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        _log.debug("🔍 Getting tickets for user: %s", user_id)
+
+        limit, after = main._page_args()
+        try:
+            projection = main._projection_args()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        now = main._now_micros()
+
+        tickets, next_cursor = await astore.ticket_page('userId', user_id, limit, after, projection.select)
+        main._normalize_tickets(tickets, now, hidden=main._RIDER_HIDDEN_TICKET_FIELDS)
+
+        _log.debug("✅ Found %s tickets for user", len(tickets))
+
+        return main._page_response(tickets, next_cursor, projection)
+
+    except UnknownCursor as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        _log.exception("❌ Get user tickets error: %s", e)
+        return jsonify([])
+
+async def get_vehicle_fare(vehicle_id):
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        _log.debug("🔍 Looking for vehicle: %s", vehicle_id)
+
+        vehicle = await _lookup_vehicle(vehicle_id)
+
+        if not vehicle:
+            _log.info("❌ Vehicle not found: %s", vehicle_id)
+            return jsonify({"error": "Vehicle not found"}), 404
+
+        _log.debug("✅ Vehicle found: %s", vehicle_id)
+
+        return jsonify(main._vehicle_fare_body(vehicle_id, vehicle))
+
+    except Exception as e:
+        _log.exception("❌ Get vehicle fare error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+async def make_payment():
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        data = request.get_json()
+        user_id = data['userId']
+        vehicle_id = data['vehicleId']
+
+        _log.debug("💳 Processing payment: User %s -> Vehicle %s", user_id, vehicle_id)
+
+        # The replay lookup and the vehicle lookup do not depend on each other
+        idempotency_key = request.headers.get('Idempotency-Key')
+        idempotency_scope = f"pay:{user_id}"
+        replay, vehicle = await asyncio.gather(
+            _find_idempotent_record(idempotency_scope, idempotency_key) if idempotency_key else _nothing(),
+            _lookup_vehicle(vehicle_id),
+            return_exceptions=True
+        )
+        if isinstance(replay, Exception):
+            raise replay
+        if replay is not None:
+            _log.info("🔁 Replaying payment for key %s", idempotency_key)
+            return main._replay_response(replay)
+        if isinstance(vehicle, Exception):
+            raise vehicle
+
+        if not vehicle:
+            return jsonify({"error": "Vehicle not found"}), 404
+
+        ticket, response_body, current_time = main._new_ticket(user_id, vehicle_id, vehicle)
+        idempotency = None
+        if idempotency_key:
+            idempotency = main._idempotency_record(idempotency_scope, idempotency_key, response_body, 201)
+
+        # Balance check, debit, ticket and owner credit run in one transaction
+        new_user_balance = await astore.pay(user_id, ticket, current_time, idempotency)
+
+        if idempotency is not None:
+            main._remember_idempotent_response(idempotency)
+
+        _log.info("✅ Payment successful: Ticket %s", ticket['ticketId'])
+
+        response_body['newBalance'] = new_user_balance
+        return jsonify(response_body), 201
+
+    except IdempotentReplay as e:
+        return main._replay_response(e.record)
+    except PaymentError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        _log.exception("❌ Payment error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+async def get_owner_tickets(owner_id):
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        _log.debug("🔍 Getting tickets for owner: %s", owner_id)
+
+        limit, after = main._page_args()
+        try:
+            projection = main._projection_args(passenger_info=True)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Newest tickets for this owner, one page at a time
+        tickets, next_cursor = await astore.ticket_page('ownerId', owner_id, limit, after, projection.select)
+        main._normalize_tickets(tickets, main._now_micros())
+
+        # Passenger names/emails for the whole page in one batched read
+        if projection.wants(main._PASSENGER_FIELDS):
+            await _attach_user_info(tickets)
+
+        _log.debug("✅ Found %s tickets for owner", len(tickets))
+
+        return main._page_response(tickets, next_cursor, projection)
+
+    except UnknownCursor as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        _log.exception("❌ Get owner tickets error: %s", e)
+        return jsonify([])
+
+async def check_ticket_validity(ticket_id):
+    """Check if a ticket is still valid"""
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        now = main._now_micros()
+        ticket_data = main._ticket_cache.get(ticket_id)
+
+        if ticket_data is None:
+            ticket_data = (await astore.get_tickets([ticket_id], main._TICKET_VALIDITY_FIELDS)).get(ticket_id)
+
+            if ticket_data is None:
+                return jsonify({"error": "Ticket not found"}), 404
+
+            ticket_data = main._cache_ticket(ticket_id, ticket_data, now)
+
+        return jsonify(main._validity_body(ticket_id, ticket_data, now))
+
+    except Exception as e:
+        _log.exception("❌ Check ticket validity error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+async def check_ticket_validity_batch():
+    """Check many tickets against one timestamp with a single batched read"""
+    if not await _store_ready():
+        return jsonify({"error": "Database not initialized"}), 500
+
+    try:
+        try:
+            ticket_ids, vehicle_id = main._batch_validity_request(request.get_json())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        now = main._now_micros()
+        tickets, missing = main._cached_validity(ticket_ids)
+        if missing:
+            for ticket_id, ticket_data in (await astore.get_tickets(missing, main._TICKET_VALIDITY_FIELDS)).items():
+                tickets[ticket_id] = main._cache_ticket(ticket_id, ticket_data, now)
+
+        return jsonify(main._batch_validity_body(ticket_ids, tickets, vehicle_id, now))
+
+    except Exception as e:
+        _log.exception("❌ Batch ticket validity error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def _not_streamed(environ):
+    # Streamed listings (?stream=1 with no limit) stay on the Flask views
+    args = main.app.request_class(environ).args
+    return args.get('limit') is not None or args.get('stream') not in ('1', 'true')
+
+# Flask endpoint name -> (coroutine, predicate on the WSGI environ or None)
+ASYNC_VIEWS = {
+    'login_user': (login_user, None),
+    'login_owner': (login_owner, None),
+    'get_user_details': (get_user_details, None),
+    'get_user_tickets': (get_user_tickets, _not_streamed),
+    'get_vehicle_fare': (get_vehicle_fare, None),
+    'make_payment': (make_payment, None),
+    'get_owner_tickets': (get_owner_tickets, _not_streamed),
+    'check_ticket_validity': (check_ticket_validity, None),
+    'check_ticket_validity_batch': (check_ticket_validity_batch, None),
+}
+
+# Flask routes that hold their thread until the client goes away
+STREAMING_ENDPOINTS = {'get_owner_ticket_feed', 'stream_owner_tickets'}
+
+async def _streams_busy():
+    return jsonify({"error": "Too many open ticket streams; retry later"}), 503
+
+# --- ASGI APPLICATION ---
+def _environ(scope, body):
+    """The WSGI environ for an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ and name.startswith('HTTP_') else value
+    return environ
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+def _encoded_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+async def _dispatch_async(view, environ, view_args):
+    """Run an async view inside Flask's request handling; returns the finalized response."""
+    flask_app = main.app
+    context = flask_app.request_context(environ)
+    context.push()
+    try:
+        try:
+            try:
+                rv = flask_app.preprocess_request()
+                if rv is None:
+                    rv = await view(**view_args)
+            except Exception as e:
+                rv = flask_app.handle_user_exception(e)
+            return flask_app.finalize_request(rv)
+        except Exception as e:
+            return flask_app.handle_exception(e)
+    finally:
+        context.pop()
+
+async def _serve_async(view, environ, view_args, send):
+    response = await _dispatch_async(view, environ, view_args)
+    try:
+        body = response.get_data()
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': _encoded_headers(response.headers.items())
+        })
+        await send({'type': 'http.response.body', 'body': body})
+    finally:
+        response.close()
+
+async def _disconnected(receive):
+    """Returns once the client has gone away."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _serve_wsgi(environ, receive, send, executor=_executor):
+    """Run the Flask app on the pool; the body is pulled a chunk at a time so streams stay streamed.
+
+    A client that disconnects stops the pulls: the body is closed as soon as
+    the chunk in progress is ready (for the SSE stream, by its next keepalive),
+    which ends the view's generator and frees the thread.
+    """
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+
+    def run(func, *args):
+        return loop.run_in_executor(executor, functools.partial(context.run, func, *args))
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    body = await run(main.app, environ, start_response)
+    disconnected = asyncio.ensure_future(_disconnected(receive))
+    try:
+        chunks = iter(body)
+        chunk = await run(next, chunks, None)
+        await send({
+            'type': 'http.response.start',
+            'status': started['status'],
+            'headers': _encoded_headers(started['headers'])
+        })
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            pull = run(next, chunks, None)
+            await asyncio.wait((pull, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                # A generator cannot be closed while a thread is running it
+                await asyncio.gather(pull, return_exceptions=True)
+                return
+            chunk = pull.result()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        if hasattr(body, 'close'):
+            await run(body.close)
+
+async def _serve_stream(environ, receive, send):
+    """A streaming route on its own pool, or 503 when every stream thread is taken."""
+    global _open_streams
+    if _open_streams >= ASGI_STREAM_THREADS:
+        await _serve_async(_streams_busy, environ, {}, send)
+        return
+    _open_streams += 1
+    try:
+        await _serve_wsgi(environ, receive, send, _stream_executor)
+    finally:
+        _open_streams -= 1
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _background_writes:
+                await asyncio.gather(*_background_writes, return_exceptions=True)
+            _executor.shutdown(wait=False)
+            _stream_executor.shutdown(wait=False)
+            _token_signer.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    environ = _environ(scope, await _read_body(receive))
+    try:
+        endpoint, view_args = main.app.url_map.bind_to_environ(environ).match()
+    except Exception:
+        endpoint, view_args = None, None
+
+    view, applies = ASYNC_VIEWS.get(endpoint, (None, None))
+    if view is not None and (applies is None or applies(environ)):
+        await _serve_async(view, environ, view_args, send)
+    elif endpoint in STREAMING_ENDPOINTS:
+        await _serve_stream(environ, receive, send)
+    else:
+        await _serve_wsgi(environ, receive, send)
@@ -0,0 +1,265 @@
+"""Load and latency benchmark for the Flask app on an in-memory Firestore.
+
+Seeds a synthetic dataset (see seed_data.py), replays a weighted request mix
+through the app's test client from several threads, and reports latency
+percentiles, throughput and datastore reads/writes per request:
+
+    python benchmarks/bench_load.py --tickets 50000 --requests 5000 \\
+        --mix pay=4,vehicle-fare=3,check-ticket=3,owner-tickets=1 \\
+        --output bench-load.json --baseline bench-load-before.json
+
+Runs are reproducible for a given --seed. With --baseline the new results are
+compared per scenario against an earlier --output file, and the exit status
+is 1 if p95 latency or reads per request grew by more than --max-regression.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import seed_data  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+
+main = seed_data.main
+
+DEFAULT_MIX = 'pay=4,vehicle-fare=3,check-ticket=3,user-tickets=2,owner-tickets=1,owner-earnings=1'
+
+
+def _pick_vehicle(rng, dataset):
+    return rng.choices(dataset.vehicle_ids, dataset.vehicle_weights)[0]
+
+
+def _pick_owner(rng, dataset):
+    return rng.choices(dataset.owner_ids, dataset.vehicle_weights)[0]
+
+
+# Each scenario turns (rng, dataset) into (method, path, json body, headers)
+SCENARIOS = {
+    'pay': lambda rng, dataset: (
+        'POST', '/pay',
+        {'userId': rng.choice(dataset.user_ids), 'vehicleId': _pick_vehicle(rng, dataset)},
+        {'Idempotency-Key': f'bench-{rng.getrandbits(64):016x}'}
+    ),
+    'vehicle-fare': lambda rng, dataset: (
+        'GET', f'/get-vehicle-fare/{_pick_vehicle(rng, dataset)}', None, None
+    ),
+    'check-ticket': lambda rng, dataset: (
+        'GET', f'/check-ticket-validity/{rng.choice(dataset.ticket_ids)}', None, None
+    ),
+    'check-tickets-batch': lambda rng, dataset: (
+        'POST', '/check-ticket-validity/batch',
+        {'ticketIds': rng.sample(dataset.ticket_ids, min(50, len(dataset.ticket_ids)))}, None
+    ),
+    'user-details': lambda rng, dataset: (
+        'GET', f'/get-user-details/{rng.choice(dataset.user_ids)}', None, None
+    ),
+    'user-tickets': lambda rng, dataset: (
+        'GET', f'/get-user-tickets/{rng.choice(dataset.user_ids)}?limit=20', None, None
+    ),
+    'owner-tickets': lambda rng, dataset: (
+        'GET', f'/get-owner-tickets/{_pick_owner(rng, dataset)}?limit=50', None, None
+    ),
+    'owner-tickets-full': lambda rng, dataset: (
+        'GET', f'/get-owner-tickets/{_pick_owner(rng, dataset)}?stream=1', None, None
+    ),
+    'active-tickets': lambda rng, dataset: (
+        'GET', f'/get-tickets-by-status/{_pick_owner(rng, dataset)}/active?limit=50', None, None
+    ),
+    'owner-earnings': lambda rng, dataset: (
+        'GET', f'/get-owner-earnings/{_pick_owner(rng, dataset)}', None, None
+    ),
+    'owner-analytics': lambda rng, dataset: (
+        'GET', f'/owner-analytics/{_pick_owner(rng, dataset)}', None, None
+    ),
+}
+
+
+def parse_mix(text):
+    """``"pay=4,vehicle-fare=3"`` -> ``{'pay': 4.0, 'vehicle-fare': 3.0}``."""
+    mix = {}
+    for part in filter(None, (item.strip() for item in text.split(','))):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def plan_requests(mix, count, dataset, seed):
+    """A fixed, seeded sequence of (scenario, request) pairs."""
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    return [(name, SCENARIOS[name](rng, dataset)) for name in rng.choices(names, weights, k=count)]
+
+
+def percentile(values, fraction):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(samples, seconds):
+    latencies = sorted(sample['ms'] for sample in samples)
+    totals = Counter()
+    for sample in samples:
+        totals.update(sample['datastore'])
+    count = len(samples)
+    return {
+        'requests': count,
+        'errors': sum(1 for sample in samples if sample['status'] >= 500),
+        'throughputPerSecond': round(count / seconds, 1) if seconds else None,
+        'latencyMs': {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'mean': round(sum(latencies) / count, 3),
+            'max': round(latencies[-1], 3)
+        },
+        'perRequest': {
+            kind: round(totals[kind] / count, 2) for kind in ('reads', 'writes', 'round_trips')
+        }
+    }
+
+
+def run(client, plan, concurrency):
+    """Replay ``plan`` from ``concurrency`` threads; returns (samples, wall seconds)."""
+    work = iter(plan)
+    lock = threading.Lock()
+    samples = []
+
+    def worker():
+        app_client = main.app.test_client()
+        local = []
+        while True:
+            with lock:
+                item = next(work, None)
+            if item is None:
+                break
+            name, (method, path, body, headers) = item
+            client.reset_thread_stats()
+            started = time.perf_counter()
+            response = app_client.open(path, method=method, json=body, headers=headers)
+            response.get_data()
+            response.close()
+            elapsed = (time.perf_counter() - started) * 1000
+            local.append({
+                'scenario': name,
+                'status': response.status_code,
+                'ms': elapsed,
+                'datastore': dict(client.thread_stats())
+            })
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def compare(results, baseline, max_regression):
+    """Print per-scenario changes against a baseline run; returns the regressions."""
+    regressions = []
+    print(f"\n{'vs baseline':<20} {'p95 ms':>20} {'reads/req':>18}")
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            print(f"  {name:<18} {'(new)':>20}")
+            continue
+        old_p95, new_p95 = before['latencyMs']['p95'], current['latencyMs']['p95']
+        old_reads, new_reads = before['perRequest']['reads'], current['perRequest']['reads']
+        ratio = new_p95 / old_p95 if old_p95 else 1
+        print(f"  {name:<18} {old_p95:>8.2f} -> {new_p95:<8.2f} {old_reads:>7.2f} -> {new_reads:<7.2f}")
+        if ratio > 1 + max_regression:
+            regressions.append(f"{name}: p95 {old_p95:.2f} -> {new_p95:.2f} ms")
+        if old_reads and new_reads / old_reads > 1 + max_regression:
+            regressions.append(f"{name}: reads/request {old_reads:.2f} -> {new_reads:.2f}")
+    return regressions
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--owners', type=int, default=50)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tickets', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"scenario=weight list; scenarios: {', '.join(SCENARIOS)}")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated datastore round-trip time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='compare with an earlier --output file')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='allowed p95 and reads/request growth vs baseline')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    client = FakeFirestore()
+    dataset = seed_data.populate(client, args.owners, args.users, args.tickets, args.days, seed=args.seed)
+    main.db = client
+    client.latency = args.latency_ms / 1000
+
+    warmup = plan_requests(mix, args.warmup, dataset, args.seed + 1)
+    plan = plan_requests(mix, args.requests, dataset, args.seed + 2)
+    run(client, warmup, args.concurrency)
+    samples, seconds = run(client, plan, args.concurrency)
+
+    by_scenario = {}
+    for sample in samples:
+        by_scenario.setdefault(sample['scenario'], []).append(sample)
+    results = {
+        'benchmark': 'load',
+        'startedAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'config': {
+            'requests': args.requests, 'warmup': args.warmup, 'concurrency': args.concurrency,
+            'mix': mix, 'latencyMs': args.latency_ms, 'seed': args.seed
+        },
+        'dataset': dataset.summary(),
+        'overall': summarize(samples, seconds),
+        'scenarios': {name: summarize(by_scenario[name], seconds) for name in mix if name in by_scenario}
+    }
+
+    print(f"{args.requests} requests x{args.concurrency} threads on {dataset.summary()}")
+    print(f"{'scenario':<20} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'reads':>7} {'writes':>7} {'5xx':>5}")
+    rows = itertools.chain([('overall', results['overall'])], results['scenarios'].items())
+    for name, stats in rows:
+        latency, per_request = stats['latencyMs'], stats['perRequest']
+        print(
+            f"{name:<20} {stats['requests']:>6} {latency['p50']:>8.2f} {latency['p95']:>8.2f} "
+            f"{latency['p99']:>8.2f} {per_request['reads']:>7.2f} {per_request['writes']:>7.2f} {stats['errors']:>5}"
+        )
+    print(f"throughput: {results['overall']['throughputPerSecond']} requests/s")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.max_regression)
+        if regressions:
+            print("\nregressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_()
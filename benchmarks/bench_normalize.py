@@ -0,0 +1,127 @@
+"""Microbenchmarks for ticket normalization.
+
+Compares the batch normalizer in main.py against the per-ticket code it
+replaced, on synthetic tickets shaped like Firestore reads:
+
+    python benchmarks/bench_normalize.py --tickets 5000 --repeat 7
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+try:
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds as _Timestamp
+except ImportError:
+    _Timestamp = datetime
+
+
+def make_tickets(count, seed=0):
+    """Tickets spread over the last 30 days, about a tenth of them still active."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    tickets = []
+    for index in range(count):
+        boarded = now - timedelta(seconds=rng.randrange(30 * 86400)) if rng.random() > 0.1 else now
+        expires = boarded + timedelta(minutes=120)
+        tickets.append({
+            'ticketId': f'ticket-{index}',
+            'userId': f'user-{rng.randrange(500)}',
+            'ownerId': 'owner-1',
+            'vehicleId': 'BUS1',
+            'farePaid': 10,
+            'timestamp': _Timestamp.fromtimestamp(boarded.timestamp(), tz=timezone.utc),
+            'expiresAt': _Timestamp.fromtimestamp(expires.timestamp(), tz=timezone.utc),
+            'status': 'valid'
+        })
+    return tickets
+
+
+def legacy_normalize(ticket_data, current_time):
+    """The per-ticket owner normalization that _normalize_tickets replaced."""
+    expires_at = ticket_data.get('expiresAt')
+    if expires_at:
+        try:
+            if hasattr(expires_at, 'timestamp'):
+                expires_at_aware = expires_at.replace(tzinfo=current_time.tzinfo) if expires_at.tzinfo is None else expires_at
+                current_time_aware = current_time.replace(tzinfo=expires_at.tzinfo) if current_time.tzinfo is None else current_time
+                is_valid = current_time_aware < expires_at_aware and ticket_data.get('status', 'valid') == 'valid'
+                ticket_data['isValid'] = is_valid
+                ticket_data['isActive'] = is_valid
+                ticket_data['expiresAt'] = expires_at.isoformat()
+            else:
+                is_valid = ticket_data.get('status', 'valid') == 'valid'
+                ticket_data['isValid'] = is_valid
+                ticket_data['isActive'] = is_valid
+        except Exception:
+            ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
+            ticket_data['isActive'] = ticket_data.get('status', 'valid') == 'valid'
+    else:
+        ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
+        ticket_data['isActive'] = ticket_data.get('status', 'valid') == 'valid'
+    if 'timestamp' in ticket_data:
+        timestamp = ticket_data['timestamp']
+        try:
+            if hasattr(timestamp, 'seconds'):
+                ticket_data['timestamp'] = {'seconds': timestamp.seconds}
+            elif hasattr(timestamp, 'timestamp'):
+                ticket_data['timestamp'] = {'seconds': int(timestamp.timestamp())}
+        except Exception:
+            ticket_data['timestamp'] = {'seconds': 0}
+    ticket_data.setdefault('vehicleId', 'Unknown')
+    ticket_data.setdefault('farePaid', 0)
+    ticket_data.setdefault('status', 'valid')
+    return ticket_data
+
+
+def per_ticket_ns(run, batches):
+    """Best time per ticket over fresh copies of the batch (normalization mutates)."""
+    best = min(timeit.timeit(lambda batch=batch: run(batch), number=1) for batch in batches)
+    return best / len(batches[0]) * 1e9
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=7)
+    args = parser.parse_args()
+
+    tickets = make_tickets(args.tickets)
+    fresh = lambda: [copy.copy(ticket) for ticket in tickets]
+
+    def legacy(batch):
+        current_time = datetime.now()
+        for ticket in batch:
+            legacy_normalize(ticket, current_time)
+
+    def batched(batch):
+        main._normalize_tickets(batch, main._now_micros())
+
+    expires = [ticket['expiresAt'] for ticket in tickets]
+
+    results = {
+        'legacy per-ticket': per_ticket_ns(legacy, [fresh() for _ in range(args.repeat)]),
+        '_normalize_tickets': per_ticket_ns(batched, [fresh() for _ in range(args.repeat)]),
+        '_epoch_micros': min(
+            timeit.repeat(lambda: [main._epoch_micros(value) for value in expires], number=1, repeat=args.repeat)
+        ) / len(expires) * 1e9,
+        'dict copy (baseline)': min(
+            timeit.repeat(fresh, number=1, repeat=args.repeat)
+        ) / len(tickets) * 1e9,
+    }
+
+    print(f"{args.tickets} tickets, best of {args.repeat}, {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    for name, nanoseconds in results.items():
+        print(f"  {name:<22} {nanoseconds:8.0f} ns/ticket")
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,649 @@
+"""In-memory stand-in for the Firestore client surface main.py uses.
+
+Documents live in per-collection dicts. Equality filters go through hash
+indexes built on first use, so a ``ownerId == X`` query costs about as much
+as the owner's tickets rather than the whole collection, roughly like
+Firestore's single-field indexes. Every call counts reads, writes and round
+trips both globally and for the calling thread, and can sleep ``latency``
+seconds per round trip to model the network.
+
+Field values and sentinels (SERVER_TIMESTAMP, Increment, FieldFilter) are the
+real ones from google-cloud-firestore, so main.py runs unmodified with
+``main.db = FakeFirestore()``.
+"""
+import heapq
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from google.api_core import exceptions
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.cloud.firestore_v1 import transforms
+
+
+def _now():
+    return DatetimeWithNanoseconds.now(timezone.utc)
+
+
+def _clone(value):
+    if isinstance(value, dict):
+        return {key: _clone(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_clone(item) for item in value]
+    return value
+
+
+def _get_path(data, path):
+    current = data
+    for part in path.split('.'):
+        if not isinstance(current, dict) or part not in current:
+            raise KeyError(path)
+        current = current[part]
+    return current
+
+
+def _set_path(data, path, value):
+    parts = path.split('.')
+    current = data
+    for part in parts[:-1]:
+        current = current.setdefault(part, {})
+    if value is transforms.DELETE_FIELD:
+        current.pop(parts[-1], None)
+    else:
+        current[parts[-1]] = value
+
+
+def _project(data, field_paths):
+    projected = {}
+    for field in field_paths:
+        try:
+            _set_path(projected, field, _clone(_get_path(data, field)))
+        except KeyError:
+            pass
+    return projected
+
+
+def _resolve(value, current):
+    """Apply a written value (or transform) on top of the stored one."""
+    if value is transforms.SERVER_TIMESTAMP:
+        return _now()
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, transforms.ArrayUnion):
+        base = list(current or [])
+        return base + [item for item in value.values if item not in base]
+    if isinstance(value, transforms.ArrayRemove):
+        return [item for item in (current or []) if item not in value.values]
+    if isinstance(value, dict):
+        merged = _clone(current) if isinstance(current, dict) else {}
+        for key, item in value.items():
+            if item is transforms.DELETE_FIELD:
+                merged.pop(key, None)
+            else:
+                merged[key] = _resolve(item, merged.get(key))
+        return merged
+    return _clone(value)
+
+
+def _sort_key(value):
+    """Firestore's cross-type ordering: null < bool < number < timestamp < string."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (3, value.timestamp())
+    if isinstance(value, str):
+        return (4, value)
+    return (5, str(value))
+
+
+class _Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _split(path):
+    parent, _, doc_id = path.rpartition('/')
+    return parent, doc_id
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, read_time=None):
+        self.reference = reference
+        self._data = data
+        self.read_time = read_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return _clone(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return None if self._data is None else _clone(_get_path(self._data, field_path))
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self):
+        return _split(self.path)[1]
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, _split(self.path)[0])
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        self._client._round_trip(reads=1)
+        if transaction is not None:
+            transaction._reads[self.path] = self._client._versions.get(self.path, 0)
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, data, merge=False):
+        self._client._commit([('set', self, data, merge)])
+
+    def create(self, data):
+        self._client._commit([('create', self, data, False)])
+
+    def update(self, data):
+        self._client._commit([('update', self, data, False)])
+
+    def delete(self):
+        self._client._commit([('delete', self, None, False)])
+
+
+class FakeAggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class FakeAggregationQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias
+
+    def get(self, transaction=None, **kwargs):
+        # Billed like Firestore: one read per batch of up to 1000 index entries
+        matches = self._query._matching()
+        self._query._client._round_trip(reads=max(1, -(-len(matches) // 1000)))
+        return [[FakeAggregationResult(self._alias, len(matches))]]
+
+
+class FakeQuery:
+    def __init__(self, client, parent_path, filters=(), orders=(), limit=None, cursor=None, projection=None):
+        self._client = client
+        self._parent_path = parent_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **changes):
+        state = dict(
+            filters=self._filters, orders=self._orders, limit=self._limit,
+            cursor=self._cursor, projection=self._projection
+        )
+        state.update(changes)
+        return FakeQuery(self._client, self._parent_path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def count(self, alias=None):
+        return FakeAggregationQuery(self, alias or 'count')
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, f"{self._parent_path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    @staticmethod
+    def _match(data, field, op, value):
+        try:
+            actual = _get_path(data, field)
+        except KeyError:
+            return False
+        if op == '==':
+            return actual == value
+        if op == '!=':
+            return actual != value
+        if op == 'in':
+            return actual in value
+        if op == 'not-in':
+            return actual not in value
+        if op == 'array_contains':
+            return isinstance(actual, list) and value in actual
+        if op == 'array_contains_any':
+            return isinstance(actual, list) and any(item in actual for item in value)
+        left, right = _sort_key(actual), _sort_key(value)
+        if left[0] != right[0]:
+            return False
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[op]
+
+    def _effective_orders(self):
+        # Inequality filters sort by their field first, as Firestore requires
+        orders = list(self._orders)
+        for field, op, _ in self._filters:
+            if op in ('<', '<=', '>', '>=', '!=', 'not-in') and not any(order[0] == field for order in orders):
+                orders.insert(0, (field, 'ASCENDING'))
+        return orders
+
+    def _matching(self):
+        candidates, filters = self._client._candidates(self._parent_path, self._filters)
+        orders = self._effective_orders()
+        last_direction = orders[-1][1] if orders else 'ASCENDING'
+
+        def key(item):
+            path, data = item
+            parts = []
+            for field, direction in orders:
+                value = _sort_key(_get_path(data, field))
+                parts.append(_Descending(value) if direction == 'DESCENDING' else value)
+            parts.append(_Descending(path) if last_direction == 'DESCENDING' else path)
+            return tuple(parts)
+
+        result = []
+        for path, data in candidates:
+            if not all(self._match(data, field, op, value) for field, op, value in filters):
+                continue
+            try:
+                for field, _ in orders:
+                    _get_path(data, field)
+            except KeyError:
+                continue
+            result.append((path, data))
+
+        if self._cursor is None and self._limit is not None:
+            return heapq.nsmallest(self._limit, result, key=key)
+        result.sort(key=key)
+
+        if self._cursor is not None:
+            if isinstance(self._cursor, FakeSnapshot):
+                cursor_data, cursor_path = self._cursor._data or {}, self._cursor.reference.path
+            else:
+                cursor_data, cursor_path = self._cursor, None
+            cursor_key = []
+            for field, direction in orders:
+                value = _sort_key(cursor_data.get(field) if '.' not in field else _get_path(cursor_data, field))
+                cursor_key.append(_Descending(value) if direction == 'DESCENDING' else value)
+            if cursor_path is not None:
+                cursor_key.append(_Descending(cursor_path) if last_direction == 'DESCENDING' else cursor_path)
+                result = [item for item in result if key(item) > tuple(cursor_key)]
+            else:
+                size = len(cursor_key)
+                result = [item for item in result if key(item)[:size] > tuple(cursor_key)]
+
+        if self._limit is not None:
+            result = result[:self._limit]
+        return result
+
+    def stream(self, transaction=None, **kwargs):
+        matches = self._matching()
+        self._client._round_trip(reads=max(1, len(matches)))
+        for path, data in matches:
+            data = _project(data, self._projection) if self._projection is not None else _clone(data)
+            yield FakeSnapshot(FakeDocumentReference(self._client, path), data)
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream(transaction=transaction))
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.path = path
+
+    @property
+    def id(self):
+        return _split(self.path)[1]
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return _now(), ref
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(('set', ref, data, merge))
+
+    def create(self, ref, data):
+        self._ops.append(('create', ref, data, False))
+
+    def update(self, ref, data):
+        self._ops.append(('update', ref, data, False))
+
+    def delete(self, ref):
+        self._ops.append(('delete', ref, None, False))
+
+    def __len__(self):
+        return len(self._ops)
+
+    def commit(self):
+        if len(self._ops) > 500:
+            raise exceptions.InvalidArgument('maximum 500 writes allowed per request')
+        ops, self._ops = self._ops, []
+        self._client._commit(ops)
+        return [object() for _ in ops]
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Optimistic transaction: commit aborts if a document it read has changed."""
+
+    _read_only = False
+
+    def __init__(self, client, max_attempts=5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._id = None
+        self._reads = {}
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _clean_up(self):
+        self._ops = []
+        self._id = None
+        self._reads = {}
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        with self._client._lock:
+            for path, version in self._reads.items():
+                if self._client._versions.get(path, 0) != version:
+                    self._clean_up()
+                    raise exceptions.Aborted('transaction contention')
+            self._client._commit(self._ops)
+        self._clean_up()
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            self._reads[ref_or_query.path] = self._client._versions.get(ref_or_query.path, 0)
+            return iter([ref_or_query.get()])
+        return ref_or_query.stream()
+
+    def get_all(self, references, field_paths=None):
+        return self._client.get_all(references, field_paths=field_paths, transaction=self)
+
+
+class _Watch:
+    def __init__(self, client, query, callback):
+        self._client = client
+        self.query = query
+        self.callback = callback
+
+    def unsubscribe(self):
+        self._client._watches.discard(self)
+
+
+class _Change:
+    def __init__(self, snapshot, kind):
+        self.document = snapshot
+        self.type = type('ChangeType', (), {'name': kind})()
+
+
+class FakeFirestore:
+    """A thread-safe, dict-backed Firestore client with read/write accounting."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.stats = Counter()
+        self._collections = {}
+        self._indexes = {}
+        self._versions = {}
+        self._lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        self._watches = set()
+
+    # Accounting
+    def _round_trip(self, reads=0, writes=0):
+        counts = {'round_trips': 1, 'reads': reads, 'writes': writes}
+        with self._stats_lock:
+            self.stats.update(counts)
+        self.thread_stats().update(counts)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def thread_stats(self):
+        """Counts for calls made on the current thread since its last reset."""
+        stats = getattr(self._local, 'stats', None)
+        if stats is None:
+            stats = self._local.stats = Counter()
+        return stats
+
+    def reset_thread_stats(self):
+        self._local.stats = Counter()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.stats = Counter()
+
+    def document_count(self, collection_path):
+        return len(self._collections.get(collection_path, ()))
+
+    # Client surface
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def collection_group(self, collection_id):
+        return FakeQuery(self, f"**/{collection_id}")
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts=5, **kwargs):
+        return FakeTransaction(self, max_attempts=max_attempts)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        self._round_trip(reads=max(1, len(references)))
+        for ref in references:
+            if transaction is not None:
+                transaction._reads[ref.path] = self._versions.get(ref.path, 0)
+            yield self._snapshot(ref, field_paths)
+
+    # Storage
+    def _snapshot(self, ref, field_paths=None):
+        parent, doc_id = _split(ref.path)
+        with self._lock:
+            data = self._collections.get(parent, {}).get(doc_id)
+            if data is not None:
+                data = _project(data, field_paths) if field_paths is not None else _clone(data)
+        return FakeSnapshot(ref, data, read_time=_now())
+
+    def _index(self, parent, field):
+        """``{value: {doc_id, ...}}`` for one field of one collection, built on first use."""
+        index = self._indexes.get((parent, field))
+        if index is None:
+            index = self._indexes[(parent, field)] = {}
+            for doc_id, data in self._collections.get(parent, {}).items():
+                self._index_add(index, field, doc_id, data)
+        return index
+
+    @staticmethod
+    def _index_add(index, field, doc_id, data):
+        try:
+            value = _get_path(data, field)
+            index.setdefault(value, set()).add(doc_id)
+        except (KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def _index_remove(index, field, doc_id, data):
+        try:
+            value = _get_path(data, field)
+            index.get(value, set()).discard(doc_id)
+        except (KeyError, TypeError):
+            pass
+
+    def _candidates(self, parent, filters):
+        """Documents that pass the indexable equality filters, and the filters left to apply."""
+        if parent.startswith('**/'):
+            # Collection group: every collection with that id, unindexed
+            group = parent[3:]
+            with self._lock:
+                items = [
+                    (f"{path}/{doc_id}", data)
+                    for path, docs in self._collections.items() if _split(path)[1] == group
+                    for doc_id, data in docs.items()
+                ]
+            return items, list(filters)
+        with self._lock:
+            docs = self._collections.get(parent, {})
+            doc_ids = None
+            remaining = []
+            for field, op, value in filters:
+                try:
+                    hash(value)
+                except TypeError:
+                    remaining.append((field, op, value))
+                    continue
+                if op != '==' or isinstance(value, bool):
+                    remaining.append((field, op, value))
+                    continue
+                matches = self._index(parent, field).get(value, set())
+                doc_ids = set(matches) if doc_ids is None else doc_ids & matches
+            if doc_ids is None:
+                items = list(docs.items())
+            else:
+                items = [(doc_id, docs[doc_id]) for doc_id in doc_ids]
+        return [(f"{parent}/{doc_id}", data) for doc_id, data in items], remaining
+
+    def _commit(self, ops):
+        if not ops:
+            return
+        self._round_trip(writes=len(ops))
+        with self._lock:
+            staged = {}
+            for kind, ref, data, merge in ops:
+                path = ref.path
+                existing = staged[path] if path in staged else self._stored(path)
+                if kind == 'create' and existing is not None:
+                    raise exceptions.AlreadyExists(f'Document already exists: {path}')
+                if kind == 'update' and existing is None:
+                    raise exceptions.NotFound(f'No document to update: {path}')
+                if kind == 'delete':
+                    staged[path] = None
+                elif kind in ('set', 'create') and not merge:
+                    staged[path] = _resolve(data, {})
+                else:
+                    doc = _clone(existing) if existing is not None else {}
+                    for field, value in data.items():
+                        if value is transforms.DELETE_FIELD:
+                            _set_path(doc, field, value)
+                            continue
+                        if kind == 'update':
+                            try:
+                                current = _get_path(doc, field)
+                            except KeyError:
+                                current = None
+                            _set_path(doc, field, _resolve(value, current))
+                        else:
+                            doc[field] = _resolve(value, doc.get(field))
+                    staged[path] = doc
+
+            for path, doc in staged.items():
+                parent, doc_id = _split(path)
+                collection = self._collections.setdefault(parent, {})
+                previous = collection.get(doc_id)
+                for (index_parent, field), index in self._indexes.items():
+                    if index_parent != parent:
+                        continue
+                    if previous is not None:
+                        self._index_remove(index, field, doc_id, previous)
+                    if doc is not None:
+                        self._index_add(index, field, doc_id, doc)
+                if doc is None:
+                    collection.pop(doc_id, None)
+                else:
+                    collection[doc_id] = doc
+                self._versions[path] = self._versions.get(path, 0) + 1
+        self._notify(list(staged))
+
+    def _stored(self, path):
+        parent, doc_id = _split(path)
+        return self._collections.get(parent, {}).get(doc_id)
+
+    def _watch(self, query, callback):
+        watch = _Watch(self, query, callback)
+        self._watches.add(watch)
+        docs = [FakeSnapshot(FakeDocumentReference(self, path), data) for path, data in query._matching()]
+        callback(docs, [_Change(doc, 'ADDED') for doc in docs], _now())
+        return watch
+
+    def _notify(self, paths):
+        for watch in list(self._watches):
+            matching = dict(watch.query._matching())
+            changed = [
+                FakeSnapshot(FakeDocumentReference(self, path), matching[path])
+                for path in paths if path in matching
+            ]
+            if changed:
+                docs = [FakeSnapshot(FakeDocumentReference(self, path), data) for path, data in matching.items()]
+                watch.callback(docs, [_Change(doc, 'ADDED') for doc in changed], _now())
@@ -0,0 +1,156 @@
+"""Synthetic Cholo Pay data for benchmarks.
+
+Writes N owners (one vehicle each), M users and K tickets through the client
+API, in the same shapes main.py stores:
+
+    python benchmarks/seed_data.py --owners 50 --users 2000 --tickets 50000
+
+Vehicle popularity is Zipf-like, so a few busy routes own most tickets, and
+about ``--active`` of the tickets are still inside their validity window.
+Owner aggregates are then derived with main's own rebuild, so they match what
+/pay maintains.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('TICKET_TOKEN_SECRET', 'benchmark-secret')
+os.environ['STORAGE_BACKEND'] = 'firestore'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import main  # noqa: E402
+from fake_firestore import FakeFirestore  # noqa: E402
+
+FARES = (10, 15, 20, 25, 30, 40)
+VALIDITY_MINUTES = (30, 60, 120)
+STARTING_BALANCE = 10 ** 9
+
+
+class Dataset:
+    """Ids of everything seeded, plus the vehicle weights requests should follow."""
+
+    def __init__(self, owner_ids, vehicle_ids, vehicle_weights, user_ids, ticket_ids, seconds):
+        self.owner_ids = owner_ids
+        self.vehicle_ids = vehicle_ids
+        self.vehicle_weights = vehicle_weights
+        self.user_ids = user_ids
+        self.ticket_ids = ticket_ids
+        self.seconds = seconds
+
+    def summary(self):
+        return {
+            'owners': len(self.owner_ids),
+            'users': len(self.user_ids),
+            'tickets': len(self.ticket_ids),
+            'seedSeconds': round(self.seconds, 2)
+        }
+
+
+def _writer(client):
+    """Set documents in 500-write batches; call the returned function with None to flush."""
+    batch = client.batch()
+
+    def write(ref, data=None):
+        nonlocal batch
+        if ref is not None:
+            batch.set(ref, data)
+        if len(batch) >= 500 or (ref is None and len(batch)):
+            batch.commit()
+            batch = client.batch()
+    return write
+
+
+def populate(client, owners, users, tickets, days=30, active=0.1, seed=0):
+    """Fill ``client`` with a reproducible dataset and return its Dataset."""
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    write = _writer(client)
+
+    owner_ids = [f'owner-{index:05d}' for index in range(owners)]
+    vehicle_ids = [f'BUS{index:05d}' for index in range(owners)]
+    vehicle_weights = [1 / (rank + 1) ** 1.1 for rank in range(owners)]
+    vehicles = {}
+    for owner_id, vehicle_id in zip(owner_ids, vehicle_ids):
+        owner_data = {
+            'uid': owner_id,
+            'email': f'{owner_id}@example.com',
+            'fullName': f'Owner {owner_id[-5:]}',
+            'vehicleId': vehicle_id,
+            'fixedFare': rng.choice(FARES),
+            'ticketValidityMinutes': rng.choice(VALIDITY_MINUTES),
+            'totalEarnings': 0,
+            'createdAt': now - timedelta(days=days + 1)
+        }
+        vehicles[vehicle_id] = main._vehicle_index_entry(owner_id, owner_data)
+        write(client.collection('owners').document(owner_id), owner_data)
+        write(client.collection('vehicles').document(vehicle_id), vehicles[vehicle_id])
+
+    user_ids = [f'user-{index:06d}' for index in range(users)]
+    for user_id in user_ids:
+        write(client.collection('users').document(user_id), {
+            'uid': user_id,
+            'email': f'{user_id}@example.com',
+            'fullName': f'Passenger {user_id[-6:]}',
+            'walletBalance': STARTING_BALANCE,
+            'createdAt': now - timedelta(days=days + 1)
+        })
+
+    ticket_ids = []
+    for index in range(tickets):
+        vehicle_id = rng.choices(vehicle_ids, vehicle_weights)[0]
+        vehicle = vehicles[vehicle_id]
+        validity = timedelta(minutes=vehicle['ticketValidityMinutes'])
+        if rng.random() < active:
+            boarded = now - validity * rng.random()
+        else:
+            boarded = now - validity - timedelta(seconds=rng.randrange(days * 86400))
+        ticket_id = f'ticket-{index:08d}'
+        expires_at = boarded + validity
+        write(client.collection('tickets').document(ticket_id), {
+            'ticketId': ticket_id,
+            'userId': rng.choice(user_ids),
+            'ownerId': vehicle['ownerId'],
+            'vehicleId': vehicle_id,
+            'farePaid': vehicle['fixedFare'],
+            'timestamp': boarded,
+            'recordedAt': boarded,
+            'expiresAt': expires_at,
+            'status': 'valid',
+            'ticketToken': main.sign_ticket_token(ticket_id, vehicle_id, expires_at, vehicle['fixedFare'])
+        })
+        ticket_ids.append(ticket_id)
+    write(None)
+
+    previous, main.db = main.db, client
+    try:
+        for owner_id in owner_ids:
+            main._rebuild_owner_stats(owner_id)
+    finally:
+        main.db = previous
+
+    return Dataset(owner_ids, vehicle_ids, vehicle_weights, user_ids, ticket_ids, time.perf_counter() - started)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--owners', type=int, default=50)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--tickets', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--active', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    client = FakeFirestore()
+    dataset = populate(client, args.owners, args.users, args.tickets, args.days, args.active, args.seed)
+    print(dataset.summary(), dict(client.stats))
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,517 @@
+# firestore_storage.py - the Firestore engine behind main.py's store
+
+"""FirestoreStorage: the Storage interface (storage.py) on Cloud Firestore.
+
+main.py builds it for STORAGE_BACKEND=firestore, the default. The engine
+shares main.py's lazily built client (``main.db``), its deferred Firestore
+imports and the data-model helpers that the Firestore-only routes use too:
+the vehicle index, ticket paging, idempotency records and owner aggregates.
+main.py hands its module over with ``bind()`` rather than being imported
+here, so ``python main.py``, which runs it as __main__, is not loaded twice.
+"""
+
+import functools
+import random
+from datetime import datetime, timezone
+
+from storage import (
+    LEDGER_ENTRY_TYPES, SERVER_TIMESTAMP, IdempotentReplay, PaymentError, Storage, VehicleTaken,
+    add_to_archive, archive_month, archive_month_end, archive_part_id, batch_result, fold_ledger_entries, group_ledger_entries,
+    ledger_entry, ledger_snapshot_id, ledger_start, merge_archive_parts, opening_entry, payment_entry_id
+)
+
+# Payments per user in one batch transaction; see _pack_payment_transactions
+MAX_PAYMENTS_PER_USER_TXN = 99
+
+main = None
+
+def bind(app_module):
+    """Use ``app_module`` (main.py) for the client and shared helpers."""
+    global main
+    main = app_module
+
+def _transactional(func):
+    """``firestore.transactional`` that defers importing Firestore to the first call."""
+    transactional = None
+
+    @functools.wraps(func)
+    def run(transaction, *args, **kwargs):
+        nonlocal transactional
+        if transactional is None:
+            transactional = main.firestore.transactional(func)
+        return transactional(transaction, *args, **kwargs)
+    return run
+
+def _firestore_values(data):
+    return {
+        key: main.firestore_client.SERVER_TIMESTAMP if value is SERVER_TIMESTAMP else value
+        for key, value in data.items()
+    }
+
+def _firestore_idempotency(record):
+    return None if record is None else (main._idempotency_ref(record['scope'], record['key']), record)
+
+@_transactional
+def _compact_ledger_batch(transaction, query):
+    """Fold the entries ``query`` returns into their users' monthly snapshots."""
+    entry_docs = list(transaction.get(query))
+    groups = group_ledger_entries([entry_doc.to_dict() for entry_doc in entry_docs])
+    snapshot_refs = {
+        (user_id, month): main._ledger_ref(user_id, ledger_snapshot_id(month)) for user_id, month in groups
+    }
+    snapshots = {}
+    if snapshot_refs:
+        for snapshot in transaction.get_all(list(snapshot_refs.values())):
+            snapshots[snapshot.reference.path] = snapshot.to_dict() if snapshot.exists else None
+
+    for key, group in groups.items():
+        snapshot_ref = snapshot_refs[key]
+        transaction.set(snapshot_ref, fold_ledger_entries(snapshots.get(snapshot_ref.path), group))
+    for entry_doc in entry_docs:
+        transaction.delete(entry_doc.reference)
+    return [entry for group in groups.values() for entry in group]
+
+@_transactional
+def _create_owners_transaction(transaction, claims, writes):
+    """Apply ``writes`` unless a vehicle in ``claims`` ({vehicleId: ownerId}) is held by someone else."""
+    vehicles = main.db.collection('vehicles')
+    for vehicle_doc in transaction.get_all([vehicles.document(vehicle_id) for vehicle_id in claims]):
+        if vehicle_doc.exists and vehicle_doc.to_dict().get('ownerId') != claims[vehicle_doc.id]:
+            raise VehicleTaken(vehicle_doc.id)
+    for ref, data in writes:
+        transaction.set(ref, data)
+
+@_transactional
+def _expire_ticket_batch(transaction, query):
+    """Flip the tickets ``query`` returns to 'expired'; a concurrent revoke retries the batch."""
+    ticket_docs = list(transaction.get(query))
+    for ticket_doc in ticket_docs:
+        transaction.update(ticket_doc.reference, {'status': 'expired'})
+    return ticket_docs
+
+@_transactional
+def _archive_ticket_batch(transaction, query):
+    """Move the tickets ``query`` returns into their owner-month archive parts."""
+    ticket_docs = list(transaction.get(query))
+    groups = {}
+    for ticket in main._ticket_dicts(ticket_docs):
+        groups.setdefault((ticket['ownerId'], archive_month(ticket['timestamp'])), []).append(ticket)
+
+    # Transactions read everything before they write
+    archive = main.db.collection('ticketArchive')
+    last_parts = {}
+    for owner_id, month in groups:
+        parts = [part_doc.to_dict() for part_doc in transaction.get(archive.where(
+            filter=main.firestore.FieldFilter('ownerId', '==', owner_id)
+        ).where(
+            filter=main.firestore.FieldFilter('month', '==', month)
+        ))]
+        last_parts[owner_id, month] = max(parts, key=lambda part: part['part'], default=None)
+
+    now = datetime.now(timezone.utc)
+    for (owner_id, month), tickets in groups.items():
+        for part in add_to_archive(owner_id, month, last_parts[owner_id, month], tickets, now):
+            transaction.set(archive.document(archive_part_id(owner_id, month, part['part'])), part)
+    for ticket_doc in ticket_docs:
+        transaction.delete(ticket_doc.reference)
+
+    if not ticket_docs:
+        return 0, None
+    return len(ticket_docs), max(ticket['timestamp'] for tickets in groups.values() for ticket in tickets)
+
+@_transactional
+def _run_payment_transaction(transaction, user_ref, ticket_ref, ticket_data, when, idempotency=None):
+    """Debit the user, record the ticket and credit the owner's aggregates atomically.
+
+    ``idempotency`` is an optional ``(ref, record)`` pair; the record's response
+    gets ``newBalance`` filled in and is stored in the same transaction.
+    """
+    if idempotency is not None:
+        existing = main._live_idempotency_record(idempotency[0].get(transaction=transaction))
+        if existing is not None:
+            raise IdempotentReplay(existing)
+
+    user_snapshot = user_ref.get(transaction=transaction)
+
+    if not user_snapshot.exists:
+        raise PaymentError("User not found", 404)
+
+    fare = ticket_data['farePaid']
+    user_data = user_snapshot.to_dict()
+    user_balance = user_data.get('walletBalance', 0)
+
+    if user_balance < fare:
+        raise PaymentError("Insufficient funds", 400)
+
+    new_user_balance = user_balance - fare
+
+    seq, opening = ledger_start(user_ref.id, user_data, when)
+    if opening is not None:
+        transaction.set(main._ledger_ref(user_ref.id, opening['entryId']), opening)
+    transaction.update(user_ref, {'walletBalance': main.firestore.Increment(-fare), 'ledgerSeq': seq + 1})
+    transaction.set(main._ledger_ref(user_ref.id, payment_entry_id(ticket_ref.id)), ledger_entry(
+        user_ref.id, 'payment', seq + 1, -fare, new_user_balance, when,
+        payment_entry_id(ticket_ref.id),
+        ticketId=ticket_ref.id, idempotencyKey=idempotency and idempotency[1]['key']
+    ))
+    transaction.set(ticket_ref, ticket_data)
+    for stats_ref, stats_update in main._owner_stats_writes(ticket_data['ownerId'], ticket_data['userId'], fare, when):
+        transaction.set(stats_ref, stats_update, merge=True)
+
+    if idempotency is not None:
+        idempotency_ref, record = idempotency
+        record['response']['newBalance'] = new_user_balance
+        transaction.set(idempotency_ref, record)
+
+    return new_user_balance
+
+@_transactional
+def _run_add_funds_transaction(transaction, user_ref, amount, idempotency=None):
+    """Credit a wallet, storing the Idempotency-Key record in the same transaction."""
+    if idempotency is not None:
+        existing = main._live_idempotency_record(idempotency[0].get(transaction=transaction))
+        if existing is not None:
+            raise IdempotentReplay(existing)
+
+    user_snapshot = user_ref.get(transaction=transaction)
+
+    if not user_snapshot.exists:
+        raise PaymentError("User not found", 404)
+
+    user_data = user_snapshot.to_dict()
+    current_balance = user_data.get('walletBalance', 0)
+    new_balance = current_balance + amount
+    now = datetime.now(timezone.utc)
+    seq, opening = ledger_start(user_ref.id, user_data, now)
+    if opening is not None:
+        transaction.set(main._ledger_ref(user_ref.id, opening['entryId']), opening)
+    transaction.update(user_ref, {'walletBalance': main.firestore.Increment(amount), 'ledgerSeq': seq + 1})
+    entry = ledger_entry(
+        user_ref.id, 'top-up', seq + 1, amount, new_balance, now,
+        idempotencyKey=idempotency and idempotency[1]['key']
+    )
+    transaction.set(main._ledger_ref(user_ref.id, entry['entryId']), entry)
+
+    if idempotency is not None:
+        idempotency_ref, record = idempotency
+        record['response']['newBalance'] = new_balance
+        transaction.set(idempotency_ref, record)
+
+    return current_balance, new_balance
+
+def _pack_payment_transactions(user_groups):
+    """Split per-user groups into transactions that stay under 500 writes."""
+    chunks = []
+    current = []
+    writes = 0
+    for user_ref, items in user_groups:
+        for start in range(0, len(items), MAX_PAYMENTS_PER_USER_TXN):
+            part = items[start:start + MAX_PAYMENTS_PER_USER_TXN]
+            # wallet update and opening ledger entry, then ticket, ledger entry,
+            # shard, day shard and passenger per item
+            cost = 2 + 5 * len(part)
+            if current and writes + cost > 500:
+                chunks.append(current)
+                current, writes = [], 0
+            current.append((user_ref, part))
+            writes += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+@_transactional
+def _run_batch_payment_transaction(transaction, user_groups):
+    """Apply queued payments for several users at once.
+
+    ``user_groups`` is a list of ``(user_ref, items)`` where each item carries a
+    deterministic ``ticketRef`` and the ``ticket`` to create. Returns a result
+    per item index. Tickets that already exist are replays and are not charged.
+    """
+    refs = [user_ref for user_ref, _ in user_groups]
+    refs += [item['ticketRef'] for _, items in user_groups for item in items]
+    snapshots = {snapshot.reference.path: snapshot for snapshot in transaction.get_all(refs)}
+
+    results = {}
+    stats_writes = []
+    shards = {}
+    recorded_at = datetime.now(timezone.utc)
+    for user_ref, items in user_groups:
+        user_snapshot = snapshots[user_ref.path]
+        user_data = user_snapshot.to_dict() if user_snapshot.exists else {}
+        balance = user_data.get('walletBalance', 0) if user_snapshot.exists else None
+        seq, opening = ledger_start(user_ref.id, user_data, recorded_at)
+        charged = 0
+
+        for item in items:
+            ticket = item['ticket']
+            existing = snapshots[item['ticketRef'].path]
+
+            if existing.exists:
+                result = batch_result(item, 'duplicate', existing.to_dict())
+            elif balance is None:
+                result = batch_result(item, 'failed', error="User not found")
+            elif balance < ticket['farePaid']:
+                result = batch_result(item, 'failed', error="Insufficient funds")
+            else:
+                balance -= ticket['farePaid']
+                charged += ticket['farePaid']
+                seq += 1
+                entry_id = payment_entry_id(ticket['ticketId'])
+                transaction.set(main._ledger_ref(user_ref.id, entry_id), ledger_entry(
+                    user_ref.id, 'payment', seq, -ticket['farePaid'], balance, recorded_at, entry_id,
+                    ticketId=ticket['ticketId'], idempotencyKey=item['idempotencyKey']
+                ))
+                transaction.set(item['ticketRef'], ticket)
+                owner_id = ticket['ownerId']
+                shard = shards.setdefault(owner_id, random.randrange(main.EARNINGS_SHARDS))
+                stats_writes += main._owner_stats_writes(owner_id, ticket['userId'], ticket['farePaid'], item['when'], shard)
+                result = batch_result(item, 'created', ticket, new_balance=balance)
+            results[item['index']] = result
+
+        if charged:
+            if opening is not None:
+                transaction.set(main._ledger_ref(user_ref.id, opening['entryId']), opening)
+            transaction.update(user_ref, {'walletBalance': main.firestore.Increment(-charged), 'ledgerSeq': seq})
+
+    for stats_ref, stats_update in main._merge_stats_writes(stats_writes):
+        transaction.set(stats_ref, stats_update, merge=True)
+    return results
+
+class FirestoreStorage(Storage):
+    """The Firestore data model the endpoints in main.py read and write."""
+
+    name = 'firestore'
+
+    def __bool__(self):
+        return bool(main.db)
+
+    def create_user(self, user_id, data):
+        self.create_users({user_id: data})
+
+    def create_users(self, users):
+        now = datetime.now(timezone.utc)
+        users_collection = main.db.collection('users')
+        writes = []
+        for user_id, data in users.items():
+            entry = opening_entry(user_id, data, now)
+            if entry is not None:
+                data = dict(data, ledgerSeq=entry['seq'])
+                writes.append((main._ledger_ref(user_id, entry['entryId']), entry))
+            writes.append((users_collection.document(user_id), _firestore_values(data)))
+        main._commit_in_batches(writes)
+
+    def get_user(self, user_id):
+        user_doc = main.db.collection('users').document(user_id).get()
+        return user_doc.to_dict() if user_doc.exists else None
+
+    def get_users(self, user_ids, fields=None):
+        users_collection = main.db.collection('users')
+        user_refs = [users_collection.document(user_id) for user_id in user_ids]
+        if not user_refs:
+            return {}
+        return {
+            user_doc.id: user_doc.to_dict() if user_doc.exists else None
+            for user_doc in main.db.get_all(user_refs, field_paths=fields)
+        }
+
+    def update_user(self, user_id, updates):
+        main.db.collection('users').document(user_id).update(updates)
+
+    @staticmethod
+    def _owner_writes(owner_id, data, vehicle):
+        return [
+            (main.db.collection('owners').document(owner_id), _firestore_values(data)),
+            (main.db.collection('vehicles').document(data['vehicleId']), vehicle),
+            (main.db.collection('ownerStats').document(owner_id), {
+                'ownerId': owner_id,
+                'totalRevenue': 0,
+                'ticketCount': 0
+            })
+        ]
+
+    def create_owner(self, owner_id, data, vehicle):
+        self.create_owners([(owner_id, data, vehicle)])
+
+    def create_owners(self, owners):
+        # Owner document, vehicle index and aggregates are written together,
+        # whole owners per transaction: 166 x 3 writes
+        for start in range(0, len(owners), 166):
+            chunk = owners[start:start + 166]
+            _create_owners_transaction(
+                main.db.transaction(),
+                {data['vehicleId']: owner_id for owner_id, data, _ in chunk},
+                [write for owner in chunk for write in self._owner_writes(*owner)]
+            )
+
+    def get_owner(self, owner_id):
+        owner_doc = main.db.collection('owners').document(owner_id).get()
+        return owner_doc.to_dict() if owner_doc.exists else None
+
+    def get_owners(self, owner_ids, fields=None):
+        owners_collection = main.db.collection('owners')
+        owner_refs = [owners_collection.document(owner_id) for owner_id in owner_ids]
+        if not owner_refs:
+            return {}
+        return {
+            owner_doc.id: owner_doc.to_dict() if owner_doc.exists else None
+            for owner_doc in main.db.get_all(owner_refs, field_paths=fields)
+        }
+
+    def update_owner(self, owner_id, updates):
+        owner_ref = main.db.collection('owners').document(owner_id)
+        owner_doc = owner_ref.get()
+        if not owner_doc.exists:
+            return None
+
+        batch = main.db.batch()
+        batch.update(owner_ref, updates)
+        owner = owner_doc.to_dict()
+        if owner.get('vehicleId'):
+            batch.set(main.db.collection('vehicles').document(owner['vehicleId']), {
+                'ownerId': owner_id,
+                **updates
+            }, merge=True)
+        batch.commit()
+
+        owner.update(updates)
+        return owner
+
+    def get_vehicle(self, vehicle_id):
+        return main._firestore_vehicle(vehicle_id)
+
+    def get_vehicles(self, vehicle_ids):
+        vehicle_ids = list(vehicle_ids)
+        if not vehicle_ids:
+            return {}
+        vehicles = main.db.collection('vehicles')
+        found = {
+            vehicle_doc.id: vehicle_doc.to_dict()
+            for vehicle_doc in main.db.get_all([vehicles.document(vehicle_id) for vehicle_id in vehicle_ids])
+            if vehicle_doc.exists
+        }
+        # Owners registered before the vehicles index existed; 'in' takes 30 values
+        missing = [vehicle_id for vehicle_id in vehicle_ids if vehicle_id not in found]
+        for start in range(0, len(missing), 30):
+            for owner_doc in main.db.collection('owners').where(
+                filter=main.firestore.FieldFilter('vehicleId', 'in', missing[start:start + 30])
+            ).stream():
+                owner = owner_doc.to_dict()
+                found.setdefault(owner['vehicleId'], main._vehicle_index_entry(owner_doc.id, owner))
+        return {vehicle_id: found.get(vehicle_id) for vehicle_id in vehicle_ids}
+
+    def get_tickets(self, ticket_ids, fields=None):
+        tickets_collection = main.db.collection('tickets')
+        ticket_refs = [tickets_collection.document(ticket_id) for ticket_id in ticket_ids]
+        if not ticket_refs:
+            return {}
+        ticket_docs = (ticket_doc for ticket_doc in main.db.get_all(ticket_refs, field_paths=fields) if ticket_doc.exists)
+        return {ticket['ticketId']: ticket for ticket in main._ticket_dicts(ticket_docs)}
+
+    def iter_tickets(self, field, value, limit=None, after=None, fields=None, statuses=None):
+        return main._ticket_dicts(main._ticket_page_query(field, value, limit, after, fields, statuses).stream())
+
+    def expire_tickets(self, cutoff, limit):
+        query = main.db.collection('tickets').where(
+            filter=main.firestore.FieldFilter('status', '==', 'valid')
+        ).where(
+            filter=main.firestore.FieldFilter('expiresAt', '<=', cutoff)
+        ).order_by('expiresAt').select(['expiresAt']).limit(limit)
+        ticket_docs = _expire_ticket_batch(main.db.transaction(), query)
+        if not ticket_docs:
+            return 0, None
+        return len(ticket_docs), ticket_docs[-1].get('expiresAt')
+
+    def archive_tickets(self, cutoff, limit):
+        query = main.db.collection('tickets').where(
+            filter=main.firestore.FieldFilter('timestamp', '<', cutoff)
+        ).order_by('timestamp').limit(limit)
+        return _archive_ticket_batch(main.db.transaction(), query)
+
+    def iter_archived_tickets(self, field, value, after=None, fields=None):
+        archive = main.db.collection('ticketArchive')
+        if field == 'ownerId':
+            query = archive.where(filter=main.firestore.FieldFilter('ownerId', '==', value))
+            keep = None
+        else:
+            query = archive.where(filter=main.firestore.FieldFilter('userIds', 'array_contains', value))
+            keep = lambda ticket: ticket.get('userId') == value
+        if after is not None:
+            # Parts of later months than the cursor's hold nothing older than it
+            query = query.where(filter=main.firestore.FieldFilter('newest', '<', archive_month_end(after[0])))
+        parts = (part_doc.to_dict() for part_doc in query.order_by('newest', direction=main.firestore.Query.DESCENDING).stream())
+        return merge_archive_parts(parts, keep, after, fields)
+
+    def get_checkpoint(self, name):
+        checkpoint_doc = main.db.collection('checkpoints').document(name).get()
+        return checkpoint_doc.to_dict() if checkpoint_doc.exists else None
+
+    def save_checkpoint(self, name, data):
+        main.db.collection('checkpoints').document(name).set(data)
+
+    def pay(self, user_id, ticket, when, idempotency=None):
+        return _run_payment_transaction(
+            main.db.transaction(),
+            main.db.collection('users').document(user_id),
+            main.db.collection('tickets').document(ticket['ticketId']),
+            _firestore_values(ticket),
+            when,
+            _firestore_idempotency(idempotency)
+        )
+
+    def add_funds(self, user_id, amount, idempotency=None):
+        return _run_add_funds_transaction(
+            main.db.transaction(),
+            main.db.collection('users').document(user_id),
+            amount,
+            _firestore_idempotency(idempotency)
+        )
+
+    def pay_batch(self, user_groups):
+        users_collection = main.db.collection('users')
+        tickets_collection = main.db.collection('tickets')
+        ref_groups = []
+        for user_id, items in user_groups:
+            for item in items:
+                item['ticketRef'] = tickets_collection.document(item['ticket']['ticketId'])
+                item['ticket'] = _firestore_values(item['ticket'])
+            ref_groups.append((users_collection.document(user_id), items))
+
+        results = {}
+        for chunk in _pack_payment_transactions(ref_groups):
+            try:
+                results.update(_run_batch_payment_transaction(main.db.transaction(), chunk))
+            except Exception as e:
+                main._log.warning("⚠️ Batch payment chunk failed: %s", e)
+                for _, items in chunk:
+                    for item in items:
+                        results[item['index']] = batch_result(item, 'failed', error=str(e))
+        return results
+
+    def get_idempotency_record(self, scope, key):
+        return main._live_idempotency_record(main._idempotency_ref(scope, key).get())
+
+    def ensure_wallet(self, user_id):
+        main.db.collection('users').document(user_id).update({'walletBalance': main.firestore.Increment(0)})
+
+    def iter_ledger(self, user_id, limit=None, before_seq=None):
+        ledger = main.db.collection('users').document(user_id).collection('ledger')
+        query = ledger.order_by('seq', direction=main.firestore.Query.DESCENDING)
+        if before_seq is not None:
+            query = query.where(filter=main.firestore.FieldFilter('seq', '<', before_seq))
+        if limit:
+            query = query.limit(limit)
+        return (entry_doc.to_dict() for entry_doc in query.stream())
+
+    def compact_ledger(self, cutoff, limit):
+        query = main.db.collection_group('ledger').where(
+            filter=main.firestore.FieldFilter('type', 'in', list(LEDGER_ENTRY_TYPES))
+        ).where(
+            filter=main.firestore.FieldFilter('createdAt', '<', cutoff)
+        ).order_by('createdAt').limit(limit)
+        entries = _compact_ledger_batch(main.db.transaction(), query)
+        if not entries:
+            return 0, None
+        return len(entries), max(entry['createdAt'] for entry in entries)
+
+    def owner_totals(self, owner_id):
+        return main._read_owner_totals(owner_id)
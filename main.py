@@ -1,57 +1,1430 @@
 # main.py - COMPLETE UPDATED VERSION
 
-from flask import Flask, request, jsonify
+import time
+_MODULE_STARTED = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
-from firebase_admin.firestore import firestore as firestore_client
 import uuid
+import atexit
+import base64
+import bisect
+import contextvars
+import functools
+import hmac
+import importlib
+import itertools
 from datetime import datetime, timedelta, timezone
-import pytz
+import click
 import os   
 import json
+import copy
+import csv
+import hashlib
+import heapq
+import io
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from flask import send_from_directory
+from storage import (
+    SERVER_TIMESTAMP, IdempotentReplay, PaymentError, SQLiteStorage, VehicleTaken,
+    UnknownCursor, archive_cursor, archive_position, idempotency_id, live_idempotency_record
+)
+import firestore_storage
 
-# --- Firebase Initialization ---
-try:
-    if os.path.exists("serviceAccountKey.json"):
-        cred = credentials.Certificate("serviceAccountKey.json")
+# --- STARTUP REPORT ---
+# Cold-start phases in milliseconds, served by /startup-report. Heavy modules
+# are imported on first use and timed individually; firebaseInitMs covers
+# building the credential, app and Firestore client.
+_startup_report = {
+    "release": os.environ.get("VERCEL_GIT_COMMIT_SHA") or os.environ.get("RELEASE"),
+    "moduleLoadMs": None,
+    "importsMs": {},
+    "firebaseInitMs": None,
+    "firebaseReady": False
+}
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def _timed_import(name):
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    _startup_report["importsMs"].setdefault(name, _elapsed_ms(started))
+    return module
+
+class _LazyModule:
+    """Stands in for a heavy module and imports it on first attribute access."""
+
+    def __init__(self, name, prepare=None):
+        self._name = name
+        self._prepare = prepare
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            if self._prepare:
+                self._prepare()
+            module = self._module = _timed_import(self._name)
+        return getattr(module, attr)
+
+# firebase_admin, google-cloud-firestore (with gRPC) and pytz load on first use,
+# so / and the static pages never pay for them. auth needs the default app.
+firestore = _LazyModule('firebase_admin.firestore')
+firestore_client = _LazyModule('google.cloud.firestore')
+auth = _LazyModule('firebase_admin.auth', prepare=lambda: _init_firebase_app())
+pytz = _LazyModule('pytz')
+
+def _transactional(func):
+    """``firestore.transactional`` that defers importing Firestore to the first call."""
+    transactional = None
+    
+    @functools.wraps(func)
+    def run(transaction, *args, **kwargs):
+        nonlocal transactional
+        if transactional is None:
+            transactional = firestore.transactional(func)
+        return transactional(transaction, *args, **kwargs)
+    return run
+
+# --- LOGGING ---
+# Everything logs through the "cholo_pay" logger. Request threads only put
+# records on a bounded queue; a listener thread formats and writes them to
+# stdout, so slow log output never holds up a response. When the queue is
+# full new records are dropped rather than blocking. Records carry the
+# request's X-Request-ID and route. Debug lines can be sampled per route with
+# LOG_DEBUG_SAMPLE_RATES="/get-owner-tickets/<owner_id>=0.01,...", decided once
+# per request so a sampled request keeps all of its lines. With debug off a
+# debug call costs one level check. LOG_FORMAT=json writes one JSON object per
+# line; LOG_ASYNC=0 writes from the calling thread.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_ASYNC = os.environ.get("LOG_ASYNC", "1") != "0"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+def _sample_rates(text):
+    rates = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        route, _, rate = item.rpartition('=')
+        rates[route] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+LOG_DEBUG_SAMPLE_RATES = _sample_rates(os.environ.get("LOG_DEBUG_SAMPLE_RATES", ""))
+
+# (request_id, route, debug_sampled) for the request being handled
+_log_context = contextvars.ContextVar('log_context', default=None)
+
+class _RequestContextFilter(logging.Filter):
+    """Stamps records with the request ID and route; drops debug lines of unsampled requests."""
+
+    def filter(self, record):
+        context = _log_context.get()
+        if context is None:
+            record.request_id = record.route = None
+            record.request_label = ''
+            return True
+        record.request_id, record.route, sampled = context
+        record.request_label = f"[{record.request_id}] "
+        return sampled or record.levelno > logging.DEBUG
+
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {
+    'message', 'asctime', 'request_id', 'route', 'request_label'
+}
+
+class _JSONFormatter(logging.Formatter):
+    """One JSON object per record, including any ``extra`` fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'requestId': getattr(record, 'request_id', None),
+            'route': getattr(record, 'route', None)
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener thread without ever blocking the caller."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve arguments and tracebacks now; the listener formats the rest
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _configure_logging():
+    logger = logging.getLogger('cholo_pay')
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    logger.addFilter(_RequestContextFilter())
+    
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        output.setFormatter(_JSONFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(request_label)s%(message)s'))
+    
+    if LOG_ASYNC:
+        handler = _QueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        listener = logging.handlers.QueueListener(handler.queue, output)
+        listener.start()
+        atexit.register(listener.stop)
     else:
-        private_key = os.environ.get("FIREBASE_PRIVATE_KEY")
-        if private_key:
-            # Handle potential formatting issues
-            if'\\n' in private_key:
-                private_key = private_key.replace('\\n', '\n')
-            if private_key.startswith('"') and private_key.endswith('"'):
-                private_key = private_key[1:-1]
+        handler = output
+    logger.addHandler(handler)
+    return logger
+
+_log = _configure_logging()
+
+# --- Firebase Initialization ---
+_firebase_app_lock = threading.Lock()
+
+def _init_firebase_app():
+    """Initialize the default Firebase app once; raises if the credentials are unusable."""
+    firebase_admin = _timed_import('firebase_admin')
+    with _firebase_app_lock:
+        if firebase_admin._apps:
+            return
+        credentials = _timed_import('firebase_admin.credentials')
+    
+        if os.path.exists("serviceAccountKey.json"):
+            cred = credentials.Certificate("serviceAccountKey.json")
+        else:
+            private_key = os.environ.get("FIREBASE_PRIVATE_KEY")
+            if private_key:
+                # Handle potential formatting issues
+                if'\\n' in private_key:
+                    private_key = private_key.replace('\\n', '\n')
+                if private_key.startswith('"') and private_key.endswith('"'):
+                    private_key = private_key[1:-1]
                 
             
-        firebase_config = {
-            "type": os.environ.get("FIREBASE_TYPE"),
-            "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
-            "private_key_id": os.environ.get("FIREBASE_PRIVATE_KEY_ID"),
-            "private_key": private_key,
-            "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
-            "client_id": os.environ.get("FIREBASE_CLIENT_ID"),
-            "auth_uri": os.environ.get("FIREBASE_AUTH_URI"),
-            "token_uri": os.environ.get("FIREBASE_TOKEN_URI")
-        }
-        cred = credentials.Certificate(firebase_config)
+            firebase_config = {
+                "type": os.environ.get("FIREBASE_TYPE"),
+                "project_id": os.environ.get("FIREBASE_PROJECT_ID"),
+                "private_key_id": os.environ.get("FIREBASE_PRIVATE_KEY_ID"),
+                "private_key": private_key,
+                "client_email": os.environ.get("FIREBASE_CLIENT_EMAIL"),
+                "client_id": os.environ.get("FIREBASE_CLIENT_ID"),
+                "auth_uri": os.environ.get("FIREBASE_AUTH_URI"),
+                "token_uri": os.environ.get("FIREBASE_TOKEN_URI")
+            }
+            cred = credentials.Certificate(firebase_config)
     
-    if not firebase_admin._apps:
         firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("✅ Firebase connection successful.")
-except Exception as e:
-    print(f"🔥 Firebase connection failed: {e}")
-    db = None
+
+def _init_firebase():
+    """Build the Firebase app and Firestore client; returns None on failure."""
+    started = time.perf_counter()
+    try:
+        _init_firebase_app()
+        client = firestore.client()
+        if METRICS_ENABLED:
+            _meter_datastore(client)
+        _log.info("✅ Firebase connection successful.")
+    except Exception as e:
+        _log.exception("🔥 Firebase connection failed: %s", e)
+        client = None
+    
+    _startup_report["firebaseInitMs"] = _elapsed_ms(started)
+    _startup_report["firebaseReady"] = client is not None
+    _log.info("⏱️ Firebase init took %s ms (imports: %s)", _startup_report['firebaseInitMs'], _startup_report['importsMs'])
+    return client
+
+class _LazyFirestore:
+    """The Firestore client, built on first use and kept for warm invocations.
+
+    Routes check ``if not db``, which triggers initialization. A failed
+    initialization is retried after FIREBASE_INIT_RETRY_SECONDS. A disabled
+    client (another storage backend is configured) is never built.
+    """
+
+    def __init__(self, retry_seconds, enabled=True):
+        self.retry_seconds = retry_seconds
+        self.enabled = enabled
+        self._client = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        client = self._client
+        if client is not None or not self.enabled:
+            return client
+        with self._lock:
+            if self._client is None and (
+                self._failed_at is None or time.monotonic() - self._failed_at >= self.retry_seconds
+            ):
+                self._client = _init_firebase()
+                self._failed_at = None if self._client is not None else time.monotonic()
+            return self._client
+
+    def __bool__(self):
+        return self.client() is not None
+
+    def __getattr__(self, name):
+        client = self.client()
+        if client is None:
+            raise RuntimeError("Database not initialized")
+        return getattr(client, name)
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore")
+
+db = _LazyFirestore(
+    int(os.environ.get("FIREBASE_INIT_RETRY_SECONDS", 30)),
+    enabled=STORAGE_BACKEND == "firestore"
+)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'Idempotent-Replayed', 'X-Datastore-Reads', 'X-Request-ID'])
+
+# --- REQUEST CONTEXT ---
+_REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+@app.before_request
+def _start_request_context():
+    # Reuse a caller's X-Request-ID so logs correlate across services
+    request_id = request.headers.get('X-Request-ID', '')
+    if not _REQUEST_ID_PATTERN.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    route = _route_label()
+    rate = LOG_DEBUG_SAMPLE_RATES.get(route, 1.0)
+    _log_context.set((request_id, route, rate >= 1.0 or random.random() < rate))
+
+@app.after_request
+def _add_request_id(response):
+    context = _log_context.get()
+    if context is not None:
+        response.headers['X-Request-ID'] = context[0]
+    return response
+
+# --- IN-PROCESS CACHES ---
+class _TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Fare/validity/owner for each vehicle. Entries are dropped as soon as this
+# instance changes a fare; the TTL bounds staleness across other instances.
+_vehicle_cache = _TTLCache(
+    maxsize=int(os.environ.get("VEHICLE_CACHE_SIZE", 2048)),
+    ttl=int(os.environ.get("VEHICLE_CACHE_TTL", 300))
+)
+
+# Passenger display info (fullName, email) attached to owner ticket listings
+_user_info_cache = _TTLCache(
+    maxsize=int(os.environ.get("USER_INFO_CACHE_SIZE", 4096)),
+    ttl=int(os.environ.get("USER_INFO_CACHE_TTL", 600))
+)
+
+# Recently completed Idempotency-Key responses, in front of idempotencyKeys/*
+_idempotency_cache = _TTLCache(
+    maxsize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 4096)),
+    ttl=int(os.environ.get("IDEMPOTENCY_CACHE_TTL", 900))
+)
+
+# Ticket fields used by validity checks. An entry never outlives the ticket's
+# expiresAt; the TTL bounds how long a revocation on another instance goes unseen.
+_ticket_cache = _TTLCache(
+    maxsize=int(os.environ.get("TICKET_CACHE_SIZE", 8192)),
+    ttl=int(os.environ.get("TICKET_CACHE_TTL", 30))
+)
+
+# --- REQUEST METRICS ---
+# The Firestore SDK sends every RPC through one GAPIC client; that client is
+# wrapped so each call is charged to the request that made it: reads (one per
+# document returned or looked up, and at least one per query, as Firestore
+# bills them), writes, documents streamed back and time spent waiting on the
+# RPC. When a response finishes, its totals go into per-route histograms that
+# /metrics serves in the Prometheus text format. With DATASTORE_READS_HEADER=1
+# buffered responses also carry X-Datastore-Reads. Only the Firestore backend
+# is metered; HTTP metrics cover every backend.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+DATASTORE_READS_HEADER = os.environ.get("DATASTORE_READS_HEADER") == "1"
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _label_text(names, values, extra=''):
+    labels = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+class _Counter:
+    """A Prometheus counter keyed by label values."""
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return '\n'.join(lines) + '\n'
+
+class _Histogram:
+    """A Prometheus histogram keyed by label values."""
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = _label_text(self.labels, label_values, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                labels = _label_text(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+_http_requests = _Counter(
+    'http_requests_total', 'Requests handled, by route, method and status.', ('route', 'method', 'status')
+)
+_http_duration = _Histogram(
+    'http_request_duration_seconds', 'Time to finish a response, including streamed bodies.',
+    ('route', 'method'), _LATENCY_BUCKETS
+)
+_datastore_reads = _Histogram(
+    'datastore_reads_per_request', 'Billable Firestore document reads per request.', ('route',), _COUNT_BUCKETS
+)
+_datastore_writes = _Histogram(
+    'datastore_writes_per_request', 'Firestore document writes per request.', ('route',), _COUNT_BUCKETS
+)
+_datastore_documents = _Histogram(
+    'datastore_documents_streamed_per_request', 'Documents returned by Firestore per request.',
+    ('route',), _COUNT_BUCKETS
+)
+_datastore_request_seconds = _Histogram(
+    'datastore_wait_seconds_per_request', 'Time a request spent waiting on Firestore RPCs.',
+    ('route',), _LATENCY_BUCKETS
+)
+_datastore_rpc_seconds = _Histogram(
+    'datastore_rpc_duration_seconds', 'Firestore RPC round trips (time to first response for streams).',
+    ('route', 'rpc'), _LATENCY_BUCKETS
+)
+_login_cache_lookups = _Counter(
+    'login_cache_lookups_total', 'Login lookups served from cache, by cache (uid, token) and result.',
+    ('cache', 'result')
+)
+_token_signing_seconds = _Histogram(
+    'custom_token_signing_seconds', 'Time to sign a Firebase custom token.', (), _LATENCY_BUCKETS
+)
+_METRICS = (
+    _http_requests, _http_duration, _datastore_reads, _datastore_writes,
+    _datastore_documents, _datastore_request_seconds, _datastore_rpc_seconds,
+    _login_cache_lookups, _token_signing_seconds
+)
+
+class _DatastoreUsage:
+    __slots__ = ('route', 'reads', 'writes', 'documents', 'rpcs', 'seconds')
+
+    def __init__(self, route):
+        self.route = route
+        self.reads = self.writes = self.documents = self.rpcs = 0
+        self.seconds = 0.0
+
+# Usage for the request being handled. Threads started by a request begin
+# with an empty context, so background refreshes are not charged to it.
+_datastore_usage = contextvars.ContextVar('datastore_usage', default=None)
+
+_UNARY_RPCS = frozenset([
+    'begin_transaction', 'commit', 'rollback', 'batch_write', 'get_document', 'create_document',
+    'update_document', 'delete_document', 'list_documents', 'list_collection_ids', 'partition_query'
+])
+_STREAMING_RPCS = frozenset(['run_query', 'batch_get_documents', 'run_aggregation_query'])
+
+def _rpc_started(rpc, usage, started):
+    elapsed = time.perf_counter() - started
+    _datastore_rpc_seconds.observe((usage.route if usage else '<background>', rpc), elapsed)
+    if usage is not None:
+        usage.rpcs += 1
+        usage.seconds += elapsed
+
+class _MeteredStream:
+    """Counts the documents in a streaming RPC's responses as they are consumed."""
+
+    def __init__(self, responses, rpc, usage, started):
+        self._responses = responses
+        self._rpc = rpc
+        self._usage = usage
+        self._started = started
+        self._documents = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        waited = time.perf_counter()
+        try:
+            response = next(self._responses)
+        except StopIteration:
+            self._exhausted()
+            raise
+        finally:
+            self._waited(waited)
+        return self._count(response)
+
+    def _exhausted(self):
+        # An empty query result still costs one read
+        if self._usage is not None and self._rpc != 'batch_get_documents' and not self._documents:
+            self._usage.reads += 1
+
+    def _waited(self, waited):
+        if self._started is not None:
+            _rpc_started(self._rpc, self._usage, self._started)
+            self._started = None
+        elif self._usage is not None:
+            self._usage.seconds += time.perf_counter() - waited
+
+    def _count(self, response):
+        usage = self._usage
+        if self._rpc == 'run_query':
+            found = 'document' in response
+        elif self._rpc == 'batch_get_documents':
+            found = 'found' in response
+            if usage is not None:
+                usage.reads += 1
+        else:
+            found = False
+        if found:
+            self._documents += 1
+            if usage is not None:
+                usage.documents += 1
+                if self._rpc == 'run_query':
+                    usage.reads += 1
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._responses, name)
+
+class _MeteredFirestoreAPI:
+    """Stands in for the SDK's GAPIC Firestore client and meters its RPCs."""
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        method = getattr(self._api, name)
+        if name in _STREAMING_RPCS:
+            return functools.partial(self._stream, name, method)
+        if name in _UNARY_RPCS:
+            return functools.partial(self._call, name, method)
+        return method
+
+    @staticmethod
+    def _stream(rpc, method, *args, **kwargs):
+        usage = _datastore_usage.get()
+        return _MeteredStream(method(*args, **kwargs), rpc, usage, time.perf_counter())
+
+    @staticmethod
+    def _call(rpc, method, *args, **kwargs):
+        usage = _datastore_usage.get()
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _rpc_finished(rpc, usage, started, kwargs.get('request', args[0] if args else None))
+
+def _rpc_finished(rpc, usage, started, request_):
+    _rpc_started(rpc, usage, started)
+    if usage is not None and rpc in ('commit', 'batch_write'):
+        writes = request_.get('writes') if isinstance(request_, dict) else getattr(request_, 'writes', None)
+        usage.writes += len(writes or ())
+
+def _meter_datastore(client):
+    """Route a Firestore client's RPCs through _MeteredFirestoreAPI."""
+    try:
+        client._firestore_api_internal = _MeteredFirestoreAPI(client._firestore_api)
+    except Exception as e:
+        _log.warning("⚠️ Datastore metrics unavailable: %s", e)
+
+def _observe_request(route, method, status_code, started, usage):
+    _http_requests.inc((route, method, str(status_code)))
+    _http_duration.observe((route, method), time.perf_counter() - started)
+    _datastore_reads.observe((route,), usage.reads)
+    _datastore_writes.observe((route,), usage.writes)
+    _datastore_documents.observe((route,), usage.documents)
+    _datastore_request_seconds.observe((route,), usage.seconds)
+
+@app.before_request
+def _start_request_metrics():
+    if METRICS_ENABLED:
+        _datastore_usage.set(_DatastoreUsage(_route_label()))
+        request.environ['metrics.started'] = time.perf_counter()
+
+@app.after_request
+def _finish_request_metrics(response):
+    usage = _datastore_usage.get()
+    started = request.environ.get('metrics.started')
+    if usage is None or started is None:
+        return response
+    
+    if DATASTORE_READS_HEADER and not response.is_streamed:
+        response.headers['X-Datastore-Reads'] = str(usage.reads)
+    # Streamed bodies keep reading after this hook, so totals are taken on close
+    method, status_code = request.method, response.status_code
+    response.call_on_close(lambda: _observe_request(usage.route, method, status_code, started, usage))
+    return response
+
+# --- IDEMPOTENCY KEYS ---
+# /pay and /add-funds accept an Idempotency-Key header. The first successful
+# response is stored in idempotencyKeys/{sha256(scope:key)} inside the same
+# transaction as the money movement; replays return it without re-executing.
+# expiresAt drives Firestore's TTL policy and is also checked on read.
+IDEMPOTENCY_TTL = timedelta(hours=int(os.environ.get("IDEMPOTENCY_TTL_HOURS", 24)))
+
+def _idempotency_ref(scope, key):
+    return db.collection('idempotencyKeys').document(idempotency_id(scope, key))
+
+def _idempotency_record(scope, key, body, status_code):
+    now = datetime.now(timezone.utc)
+    return {
+        'scope': scope,
+        'key': key,
+        'statusCode': status_code,
+        'response': body,
+        'createdAt': now,
+        'expiresAt': now + IDEMPOTENCY_TTL
+    }
+
+def _live_idempotency_record(snapshot):
+    """The stored record if the snapshot exists and has not expired."""
+    return live_idempotency_record(snapshot.to_dict()) if snapshot.exists else None
+
+def _remember_idempotent_response(record):
+    _idempotency_cache.set(f"{record['scope']}:{record['key']}", record)
+
+def _replay_response(record):
+    response = jsonify(record['response'])
+    response.status_code = record['statusCode']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _find_idempotent_response(scope, key):
+    """Replay response for a key already seen, from the front cache or the key store."""
+    record = _idempotency_cache.get(f"{scope}:{key}")
+    if record is None:
+        record = store.get_idempotency_record(scope, key)
+        if record is None:
+            return None
+        _remember_idempotent_response(record)
+    return _replay_response(record)
+
+# --- OWNER AGGREGATES ---
+# An owner's running totals (totalRevenue, ticketCount) are the base values on
+# ownerStats/{ownerId} plus EARNINGS_SHARDS counter documents under
+# ownerStats/{ownerId}/shards. Each payment increments one random shard so a
+# busy vehicle does not serialize on a single document.
+# Per-day totals with an hourly breakdown, bucketed in local time, are sharded
+# the same way: a payment increments ownerStats/{ownerId}/dayShards/{date}_{shard}
+# for the shard it counted in, and reads add a day's shards to its folded
+# ownerStats/{ownerId}/days/{YYYY-MM-DD} document. `flask compact-owner-stats`
+# folds both kinds of shard into their base documents.
+# ownerStats/{ownerId}/passengers/{userId} records each distinct rider so
+# unique passengers is a count() query; only that rider's payments write it.
+# Day shards carry ownerId and updatedAt so the analytics rollup can find the
+# owners paid since its last run.
+ANALYTICS_TIMEZONE = os.environ.get("ANALYTICS_TIMEZONE", "Asia/Kolkata")
+SYNC_WINDOW_DAYS = int(os.environ.get("SYNC_WINDOW_DAYS", 2))
+EARNINGS_SHARDS = int(os.environ.get("EARNINGS_SHARDS", 10))
+
+@functools.lru_cache(maxsize=None)
+def _analytics_tz():
+    return pytz.timezone(ANALYTICS_TIMEZONE)
+
+def _day_key(when):
+    return when.astimezone(_analytics_tz()).strftime('%Y-%m-%d')
+
+def _owner_stats_writes(owner_id, user_id, fare, when, shard=None, client=None):
+    """(ref, data) pairs to ``set(..., merge=True)`` that count one ticket of ``fare``.
+
+    ``client`` defaults to ``db``; the async app passes its AsyncClient.
+    """
+    local_time = when.astimezone(_analytics_tz())
+    stats_ref = (client or db).collection('ownerStats').document(owner_id)
+    if shard is None:
+        shard = random.randrange(EARNINGS_SHARDS)
+    shard_ref = stats_ref.collection('shards').document(str(shard))
+    day_ref = stats_ref.collection('dayShards').document(f"{local_time.strftime('%Y-%m-%d')}_{shard}")
+    passenger_ref = stats_ref.collection('passengers').document(user_id)
+    return [
+        (passenger_ref, {
+            'userId': user_id,
+            'rides': firestore.Increment(1),
+            'lastRideAt': when
+        }),
+        (shard_ref, {
+            'totalRevenue': firestore.Increment(fare),
+            'ticketCount': firestore.Increment(1)
+        }),
+        (day_ref, {
+            'date': local_time.strftime('%Y-%m-%d'),
+            'ownerId': owner_id,
+            'updatedAt': datetime.now(timezone.utc),
+            'revenue': firestore.Increment(fare),
+            'ticketCount': firestore.Increment(1),
+            'hours': {
+                local_time.strftime('%H'): {
+                    'revenue': firestore.Increment(fare),
+                    'ticketCount': firestore.Increment(1)
+                }
+            }
+        })
+    ]
+
+def _merge_stats_writes(writes):
+    """Collapse (ref, data) pairs for the same document by adding their Increments."""
+    def add(target, data):
+        for key, value in data.items():
+            current = target.get(key)
+            if isinstance(value, dict) and isinstance(current, dict):
+                add(current, value)
+            elif isinstance(value, firestore.Increment) and isinstance(current, firestore.Increment):
+                target[key] = firestore.Increment(current.value + value.value)
+            else:
+                target[key] = copy.deepcopy(value)
+    
+    merged = OrderedDict()
+    for ref, data in writes:
+        if ref.path in merged:
+            add(merged[ref.path][1], data)
+        else:
+            merged[ref.path] = (ref, copy.deepcopy(data))
+    return list(merged.values())
+
+def _read_owner_totals(owner_id):
+    """Sum an owner's base totals and counter shards; None if no aggregates exist."""
+    stats_ref = db.collection('ownerStats').document(owner_id)
+    stats_doc = stats_ref.get()
+    shard_docs = list(stats_ref.collection('shards').stream())
+    
+    if not stats_doc.exists and not shard_docs:
+        return None
+    
+    base = stats_doc.to_dict() if stats_doc.exists else {}
+    totals = {
+        'totalRevenue': base.get('totalRevenue', 0),
+        'ticketCount': base.get('ticketCount', 0)
+    }
+    for shard_doc in shard_docs:
+        shard_data = shard_doc.to_dict()
+        totals['totalRevenue'] += shard_data.get('totalRevenue', 0)
+        totals['ticketCount'] += shard_data.get('ticketCount', 0)
+    return totals
+
+def _bucket_tickets(tickets):
+    """Group ticket dicts into day documents shaped like ownerStats/*/days."""
+    days = {}
+    for ticket_data in tickets:
+        timestamp = ticket_data.get('timestamp')
+        if not isinstance(timestamp, datetime):
+            continue
+        fare = ticket_data.get('farePaid', 0)
+        local_time = timestamp.astimezone(_analytics_tz())
+        day = days.setdefault(local_time.strftime('%Y-%m-%d'), {
+            'date': local_time.strftime('%Y-%m-%d'), 'revenue': 0, 'ticketCount': 0, 'hours': {}
+        })
+        hour = day['hours'].setdefault(local_time.strftime('%H'), {'revenue': 0, 'ticketCount': 0})
+        day['revenue'] += fare
+        day['ticketCount'] += 1
+        hour['revenue'] += fare
+        hour['ticketCount'] += 1
+    return days
+
+def _empty_day(key):
+    return {'date': key, 'revenue': 0, 'ticketCount': 0, 'hours': {}}
+
+def _add_day(day, counts):
+    """Add the counts of a day document or day shard into ``day``."""
+    day['revenue'] += counts.get('revenue', 0)
+    day['ticketCount'] += counts.get('ticketCount', 0)
+    for hour, hour_counts in (counts.get('hours') or {}).items():
+        total = day['hours'].setdefault(hour, {'revenue': 0, 'ticketCount': 0})
+        total['revenue'] += hour_counts.get('revenue', 0)
+        total['ticketCount'] += hour_counts.get('ticketCount', 0)
+    return day
+
+def _day_shard_refs(stats_ref, day_keys):
+    """Every day shard a payment could write for ``day_keys``."""
+    shards = stats_ref.collection('dayShards')
+    return [shards.document(f"{key}_{shard}") for key in day_keys for shard in range(EARNINGS_SHARDS)]
+
+def _day_chunks(day_keys):
+    """``day_keys`` in runs whose day and shard writes fit one transaction."""
+    size = max(1, 450 // (EARNINGS_SHARDS + 1))
+    return [day_keys[start:start + size] for start in range(0, len(day_keys), size)]
+
+def _read_owner_days(stats_ref, day_keys, transaction=None):
+    """``{date: day}`` for the ``day_keys`` with anything counted: folded day plus its shards.
+
+    In a transaction the shards are read by id, so a payment landing on any
+    of those days afterwards conflicts with it.
+    """
+    if not day_keys:
+        return {}
+    days_collection = stats_ref.collection('days')
+    day_refs = [days_collection.document(key) for key in day_keys]
+    if transaction is not None:
+        day_docs = transaction.get_all(day_refs + _day_shard_refs(stats_ref, day_keys))
+    else:
+        day_docs = itertools.chain(db.get_all(day_refs), stats_ref.collection('dayShards').where(
+            filter=firestore.FieldFilter('date', '>=', min(day_keys))
+        ).where(
+            filter=firestore.FieldFilter('date', '<=', max(day_keys))
+        ).stream())
+    
+    wanted = set(day_keys)
+    days = {}
+    for day_doc in day_docs:
+        if not day_doc.exists:
+            continue
+        counts = day_doc.to_dict()
+        key = counts.get('date') or day_doc.id
+        if key in wanted:
+            _add_day(days.setdefault(key, _empty_day(key)), counts)
+    return days
+
+def _commit_in_batches(writes, batch_size=500):
+    """Commit (ref, data) ``set`` writes in batches under Firestore's 500-op limit."""
+    for start in range(0, len(writes), batch_size):
+        batch = db.batch()
+        for ref, data in writes[start:start + batch_size]:
+            batch.set(ref, data)
+        batch.commit()
+
+@_transactional
+def _reset_owner_days(transaction, stats_ref, day_keys, archived_days, rebuild=False):
+    """Rewrite the ``day_keys`` buckets from the owner's tickets, clearing their shards.
+
+    Stored buckets are compared with the hot tickets of those days plus
+    ``archived_days`` (archived tickets, already bucketed). Only days that
+    disagree are written, and the base totals move by the same amounts;
+    with ``rebuild`` every day is written and the totals are left alone.
+    Returns ``(revenue delta, ticket count delta, corrections)``.
+    """
+    stored_days = _read_owner_days(stats_ref, day_keys, transaction)
+    
+    # Tickets are read after the buckets: a payment committed since writes a
+    # shard read above, and the transaction retries
+    tz = _analytics_tz()
+    start = tz.localize(datetime.strptime(min(day_keys), '%Y-%m-%d'))
+    end = tz.localize(datetime.strptime(max(day_keys), '%Y-%m-%d') + timedelta(days=1))
+    ticket_docs = db.collection('tickets').where(
+        filter=firestore.FieldFilter('ownerId', '==', stats_ref.id)
+    ).where(
+        filter=firestore.FieldFilter('timestamp', '>=', start.astimezone(timezone.utc))
+    ).where(
+        filter=firestore.FieldFilter('timestamp', '<', end.astimezone(timezone.utc))
+    ).select(['farePaid', 'timestamp']).stream()
+    actual_days = _bucket_tickets(_ticket_dicts(ticket_docs))
+    for key, day in archived_days.items():
+        _add_day(actual_days.setdefault(key, _empty_day(key)), day)
+    
+    days_collection = stats_ref.collection('days')
+    corrections = []
+    revenue_delta = 0
+    count_delta = 0
+    for key in day_keys:
+        actual = actual_days.get(key, _empty_day(key))
+        stored = stored_days.get(key, _empty_day(key))
+        if rebuild:
+            if key not in actual_days and key not in stored_days:
+                continue
+        elif stored['revenue'] == actual['revenue'] and stored['ticketCount'] == actual['ticketCount']:
+            continue
+        else:
+            revenue_delta += actual['revenue'] - stored['revenue']
+            count_delta += actual['ticketCount'] - stored['ticketCount']
+            corrections.append({
+                'date': key,
+                'storedRevenue': stored['revenue'],
+                'actualRevenue': actual['revenue']
+            })
+        transaction.set(days_collection.document(key), actual)
+        for shard_ref in _day_shard_refs(stats_ref, [key]):
+            transaction.delete(shard_ref)
+    
+    if corrections:
+        transaction.set(stats_ref, {
+            'totalRevenue': firestore.Increment(revenue_delta),
+            'ticketCount': firestore.Increment(count_delta),
+            'updatedAt': firestore_client.SERVER_TIMESTAMP
+        }, merge=True)
+    return revenue_delta, count_delta, corrections
+
+@_transactional
+def _rebuild_owner_totals(transaction, stats_ref, archived_days):
+    """Set the base totals from the owner's tickets and clear the counter shards together."""
+    shard_refs = [stats_ref.collection('shards').document(str(shard)) for shard in range(EARNINGS_SHARDS)]
+    list(transaction.get_all(shard_refs))
+    
+    # Read after the shards, as in _reset_owner_days
+    ticket_docs = db.collection('tickets').where(
+        filter=firestore.FieldFilter('ownerId', '==', stats_ref.id)
+    ).select(['farePaid', 'timestamp']).stream()
+    days = list(_bucket_tickets(_ticket_dicts(ticket_docs)).values()) + list(archived_days.values())
+    totals = {
+        'totalRevenue': sum(day['revenue'] for day in days),
+        'ticketCount': sum(day['ticketCount'] for day in days)
+    }
+    
+    transaction.set(stats_ref, {
+        'ownerId': stats_ref.id,
+        **totals,
+        'updatedAt': firestore_client.SERVER_TIMESTAMP
+    })
+    for shard_ref in shard_refs:
+        transaction.delete(shard_ref)
+    return totals
+
+def _rebuild_owner_stats(owner_id):
+    """Recompute an owner's aggregates from that owner's own tickets, archived ones included."""
+    stats_ref = db.collection('ownerStats').document(owner_id)
+    archived = list(store.iter_archived_tickets('ownerId', owner_id))
+    archived_days = _bucket_tickets(archived)
+    totals = _rebuild_owner_totals(db.transaction(), stats_ref, archived_days)
+    
+    tickets = list(_ticket_dicts(db.collection('tickets').where(
+        filter=firestore.FieldFilter('ownerId', '==', owner_id)
+    ).select(['userId', 'farePaid', 'timestamp']).stream())) + archived
+    for day_keys in _day_chunks(sorted(_bucket_tickets(tickets))):
+        _reset_owner_days(
+            db.transaction(), stats_ref, day_keys,
+            {key: archived_days[key] for key in day_keys if key in archived_days},
+            rebuild=True
+        )
+    
+    passengers = {}
+    for ticket_data in tickets:
+        user_id = ticket_data.get('userId')
+        timestamp = ticket_data.get('timestamp')
+        if not user_id or not isinstance(timestamp, datetime):
+            continue
+        passenger = passengers.setdefault(user_id, {'userId': user_id, 'rides': 0, 'lastRideAt': timestamp})
+        passenger['rides'] += 1
+        passenger['lastRideAt'] = max(passenger['lastRideAt'], timestamp)
+    _commit_in_batches([(stats_ref.collection('passengers').document(key), p) for key, p in passengers.items()])
+    return totals
+
+def _verify_owner_stats(owner_id, current_totals, window_days):
+    """Check the last ``window_days`` day buckets against tickets and repair drift."""
+    stats_ref = db.collection('ownerStats').document(owner_id)
+    today = datetime.now(timezone.utc).astimezone(_analytics_tz()).date()
+    day_keys = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in reversed(range(window_days))]
+    
+    corrections = []
+    revenue_delta = 0
+    count_delta = 0
+    for chunk in _day_chunks(day_keys):
+        chunk_revenue, chunk_count, chunk_corrections = _reset_owner_days(db.transaction(), stats_ref, chunk, {})
+        revenue_delta += chunk_revenue
+        count_delta += chunk_count
+        corrections += chunk_corrections
+    
+    totals = {
+        'totalRevenue': current_totals['totalRevenue'] + revenue_delta,
+        'ticketCount': current_totals['ticketCount'] + count_delta
+    }
+    return totals, corrections
+
+@_transactional
+def _compact_owner_shards(transaction, stats_ref):
+    """Fold the counter shards into the base totals so reads touch fewer documents."""
+    shard_docs = list(transaction.get(stats_ref.collection('shards').select(['totalRevenue', 'ticketCount'])))
+    stats_doc = stats_ref.get(transaction=transaction)
+    if not shard_docs:
+        return 0
+    
+    base = stats_doc.to_dict() if stats_doc.exists else {}
+    transaction.set(stats_ref, {
+        'ownerId': stats_ref.id,
+        'totalRevenue': base.get('totalRevenue', 0) + sum(d.to_dict().get('totalRevenue', 0) for d in shard_docs),
+        'ticketCount': base.get('ticketCount', 0) + sum(d.to_dict().get('ticketCount', 0) for d in shard_docs),
+        'updatedAt': firestore_client.SERVER_TIMESTAMP
+    }, merge=True)
+    for shard_doc in shard_docs:
+        transaction.delete(shard_doc.reference)
+    return len(shard_docs)
+
+@_transactional
+def _compact_owner_day_shards(transaction, stats_ref, day_keys):
+    """Fold the day shards of ``day_keys`` into their days/{date} documents."""
+    days = _read_owner_days(stats_ref, day_keys, transaction)
+    days_collection = stats_ref.collection('days')
+    for key, day in days.items():
+        transaction.set(days_collection.document(key), day)
+    for shard_ref in _day_shard_refs(stats_ref, day_keys):
+        transaction.delete(shard_ref)
+    return len(days)
+
+# --- VEHICLE INDEX HELPERS ---
+def _vehicle_index_entry(owner_id, owner_data):
+    return {
+        'ownerId': owner_id,
+        'fixedFare': int(owner_data.get('fixedFare', 10)),
+        'ticketValidityMinutes': int(owner_data.get('ticketValidityMinutes', 30))
+    }
+
+def _lookup_vehicle(vehicle_id):
+    """Resolve a vehicleId to its owner, fare and validity, cached in process."""
+    entry = _vehicle_cache.get(vehicle_id)
+    if entry is None:
+        entry = store.get_vehicle(vehicle_id)
+        if entry is not None:
+            _vehicle_cache.set(vehicle_id, entry)
+    return entry
+
+def _firestore_vehicle(vehicle_id):
+    """vehicles/{vehicleId}, backfilled from the owners collection when missing."""
+    vehicle_ref = db.collection('vehicles').document(vehicle_id)
+    vehicle_doc = vehicle_ref.get()
+    
+    if vehicle_doc.exists:
+        entry = vehicle_doc.to_dict()
+    else:
+        # Owners registered before the vehicles index existed: use an indexed
+        # query once and backfill the mapping.
+        matches = db.collection('owners').where(
+            filter=firestore.FieldFilter('vehicleId', '==', vehicle_id)
+        ).limit(1).stream()
+        owner_doc = next(iter(matches), None)
+        if owner_doc is None:
+            return None
+        entry = _vehicle_index_entry(owner_doc.id, owner_doc.to_dict())
+        vehicle_ref.set(entry)
+        _log.info("🗂️ Backfilled vehicle index: %s", vehicle_id)
+    return entry
+
+# --- PASSENGER ENRICHMENT ---
+_UNKNOWN_USER = ('Unknown User', 'No email')
+
+_USER_INFO_FIELDS = ['fullName', 'email']
+
+def _cached_user_info(tickets):
+    """``(user_info, missing)``: cached (name, email) by userId, and the userIds to read."""
+    user_info = {}
+    missing = []
+    for user_id in {ticket.get('userId') for ticket in tickets if ticket.get('userId')}:
+        cached = _user_info_cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            user_info[user_id] = cached
+    return user_info, missing
+
+def _cache_user_info(user_info, users):
+    """Add ``get_users`` results to ``user_info`` and the cache."""
+    for user_id, user_data in users.items():
+        if user_data is not None:
+            info = (user_data.get('fullName', 'Unknown User'), user_data.get('email', 'No email'))
+        else:
+            info = _UNKNOWN_USER
+        _user_info_cache.set(user_id, info)
+        user_info[user_id] = info
+
+def _apply_user_info(tickets, user_info):
+    for ticket in tickets:
+        ticket['userName'], ticket['userEmail'] = user_info.get(ticket.get('userId'), _UNKNOWN_USER)
+    return tickets
+
+def _attach_user_info(tickets):
+    """Set userName/userEmail on each ticket, batch-reading only uncached users."""
+    user_info, missing = _cached_user_info(tickets)
+    if missing:
+        try:
+            _cache_user_info(user_info, store.get_users(missing, fields=_USER_INFO_FIELDS))
+        except Exception as e:
+            _log.warning("⚠️ Error getting user details: %s", e)
+    return _apply_user_info(tickets, user_info)
+
+# --- TICKET PAGINATION HELPERS ---
+MAX_PAGE_SIZE = 500
+
+def _page_args():
+    """Read ``?limit=&after=`` from the request; no limit means the full history."""
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, request.args.get('after') or None
+
+def _ticket_page_query(field, value, limit=None, after=None, select=None, statuses=None):
+    """Indexed ``field == value`` ticket query, newest first, resuming after a ticketId.
+
+    Raises UnknownCursor if ``after`` names no ticket.
+    """
+    tickets_collection = db.collection('tickets')
+    query = tickets_collection.where(
+        filter=firestore.FieldFilter(field, '==', value)
+    )
+    if statuses:
+        op, status_value = ('in', list(statuses)) if len(statuses) > 1 else ('==', statuses[0])
+        query = query.where(filter=firestore.FieldFilter('status', op, status_value))
+    query = query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+    
+    if select:
+        query = query.select(select)
+    
+    if after:
+        cursor_doc = tickets_collection.document(after).get()
+        if not cursor_doc.exists:
+            raise UnknownCursor(after)
+        query = query.start_after(cursor_doc)
+    
+    if limit:
+        query = query.limit(limit)
+    return query
+
+def _ticket_history(field, value, limit=None, after=None, select=None):
+    """``store.iter_tickets`` continued into the archive tier once the hot tickets run out."""
+    position = archive_position(after)
+    if position:
+        tickets = store.iter_archived_tickets(field, value, position, select)
+    else:
+        tickets = itertools.chain(
+            store.iter_tickets(field, value, limit, after, select),
+            store.iter_archived_tickets(field, value, fields=select)
+        )
+    return itertools.islice(tickets, limit) if limit else tickets
+
+def _ticket_page(field, value, limit, after, select=None):
+    """A page of ticket dicts from ``store`` and the cursor for the next one, if any."""
+    position = archive_position(after)
+    # One extra ticket tells us whether another page exists
+    wanted = limit and limit + 1
+    tickets = [] if position else list(store.iter_tickets(field, value, wanted, after, select))
+    hot = len(tickets)
+    if not limit or hot < wanted:
+        # The hot tickets ran out inside this page
+        archived = store.iter_archived_tickets(field, value, position, select)
+        tickets += itertools.islice(archived, wanted and wanted - hot)
+    if limit and len(tickets) > limit:
+        return tickets[:limit], _page_cursor(tickets[limit - 1], archived=limit > hot)
+    return tickets, None
+
+def _page_cursor(ticket, archived):
+    """Cursor resuming after ``ticket``: its ticketId, or its archive position."""
+    return archive_cursor(ticket) if archived else ticket['ticketId']
+
+def _page_response(items, next_cursor, projection=None):
+    response = jsonify(projection.body(items) if projection else items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+# --- FIELD PROJECTION ---
+# ``?fields=ticketId,farePaid,...`` trims ticket listings to those fields and
+# pushes the stored fields they need down to Firestore ``select()``.
+# ``?format=columns`` answers ``{"fields": [...], "rows": [[...], ...]}``
+# instead of an array of objects.
+_TICKET_FIELDS = ['ticketId', 'userId', 'ownerId', 'vehicleId', 'farePaid', 'timestamp', 'expiresAt', 'status', 'ticketToken']
+_VALIDITY_FIELDS = ['isValid', 'isActive', 'timeRemaining']
+_PASSENGER_FIELDS = ['userName', 'userEmail']
+_FIELD_SOURCES = {
+    'isValid': ('status', 'expiresAt'),
+    'isActive': ('status', 'expiresAt'),
+    'timeRemaining': ('status', 'expiresAt'),
+    'userName': ('userId',),
+    'userEmail': ('userId',),
+}
+
+class _Projection:
+    """The fields a ticket listing returns, the stored fields it reads, and its layout."""
+
+    def __init__(self, fields, select, columnar):
+        self.fields = fields
+        self.select = select
+        self.columnar = columnar
+
+    def wants(self, names):
+        return self.fields is None or any(name in self.fields for name in names)
+
+    def rows(self, tickets):
+        if self.columnar:
+            return [[ticket.get(name) for name in self.fields] for ticket in tickets]
+        if self.fields is None:
+            return tickets
+        return [{name: ticket.get(name) for name in self.fields} for ticket in tickets]
+
+    def body(self, tickets):
+        if self.columnar:
+            return {"fields": self.fields, "rows": self.rows(tickets)}
+        return self.rows(tickets)
+
+def _projection_args(passenger_info=False, reads=()):
+    """Read ``?fields=`` and ``?format=`` for a ticket listing.
+
+    ``reads`` are stored fields the endpoint needs for itself (e.g. to filter).
+    Raises ValueError for unknown field names.
+    """
+    available = _TICKET_FIELDS + _VALIDITY_FIELDS + (_PASSENGER_FIELDS if passenger_info else [])
+    columnar = request.args.get('format') == 'columns'
+    requested = request.args.get('fields')
+    
+    if requested is None:
+        return _Projection(available if columnar else None, None, columnar)
+    
+    fields = list(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    if not fields:
+        raise ValueError("fields must name at least one field")
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown ticket fields: {', '.join(unknown)}. Available: {', '.join(available)}")
+    
+    select = {'ticketId', *reads}
+    for name in fields:
+        select.update(_FIELD_SOURCES.get(name, (name,)))
+    return _Projection(fields, sorted(select), columnar)
+
+# --- TICKET NORMALIZATION ---
+# Every endpoint that returns tickets shapes them here. A batch is judged
+# against one "now" captured by the caller as epoch microseconds, and each
+# datetime is reduced to an integer once, so validity is an integer compare
+# with no per-ticket clock reads or timezone juggling. Firestore returns aware
+# UTC datetimes; naive ones are treated as UTC.
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+def _epoch_micros(when):
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return (when - _EPOCH) // _MICROSECOND
+
+def _now_micros():
+    return time.time_ns() // 1000
+
+# The ticket listings have always filled these in for tickets stored without
+# them; the validity checks report only what is stored, so a ticket with no
+# status is not valid there.
+_LISTING_DEFAULTS = {'status': 'valid', 'vehicleId': 'Unknown', 'farePaid': 0}
+# Stored ticket fields that listings leave out: recordedAt only orders the
+# owner feed, and a ticket's token is for its passenger, not the vehicle owner.
+_HIDDEN_TICKET_FIELDS = ('recordedAt', 'ticketToken')
+_RIDER_HIDDEN_TICKET_FIELDS = ('recordedAt',)
+
+def _normalize_tickets(tickets, now_micros, defaults=_LISTING_DEFAULTS, hidden=_HIDDEN_TICKET_FIELDS):
+    """Add isValid/isActive/timeRemaining and JSON-ready times to ticket dicts, in place.
+
+    ``timestamp`` becomes ``{'seconds': ...}`` and ``expiresAt`` an ISO string,
+    which is the shape the dashboards read. Missing fields are filled from
+    ``defaults``; pass ``{}`` to leave them out. ``hidden`` fields are removed.
+    """
+    for ticket in tickets:
+        for field in hidden:
+            ticket.pop(field, None)
+        for field, value in defaults.items():
+            ticket.setdefault(field, value)
+        status = ticket.get('status')
+        expires_at = ticket.get('expiresAt')
+        remaining = 0
+        if isinstance(expires_at, datetime):
+            remaining = _epoch_micros(expires_at) - now_micros
+            is_valid = status == 'valid' and remaining > 0
+            ticket['expiresAt'] = expires_at.isoformat()
+        else:
+            is_valid = status == 'valid'
+        
+        ticket['isValid'] = ticket['isActive'] = is_valid
+        ticket['timeRemaining'] = remaining / 1e6 if is_valid and remaining > 0 else 0
+        
+        timestamp = ticket.get('timestamp')
+        if isinstance(timestamp, datetime):
+            ticket['timestamp'] = {'seconds': _epoch_micros(timestamp) // 1000000}
+    return tickets
+
+def _ticket_dicts(ticket_docs):
+    for ticket_doc in ticket_docs:
+        ticket = ticket_doc.to_dict()
+        ticket.setdefault('ticketId', ticket_doc.id)
+        yield ticket
+
+def _normalized_tickets(tickets, now_micros, hidden=_HIDDEN_TICKET_FIELDS):
+    """Lazily normalize a stream of ticket dicts, one chunk at a time."""
+    for chunk in _chunked(tickets):
+        yield from _normalize_tickets(chunk, now_micros, hidden=hidden)
+
+# --- STREAMED TICKET LISTS ---
+# With ``?stream=1`` and no limit, ticket lists are written as a JSON array
+# straight off the Firestore query: documents are normalized and serialized a
+# chunk at a time, so memory per request stays flat and the first bytes go
+# out before the history has been read.
+STREAM_CHUNK_SIZE = 100
+
+def _stream_requested():
+    return request.args.get('stream') in ('1', 'true')
+
+def _chunked(items, size=STREAM_CHUNK_SIZE):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _stream_json_array(chunks, projection=None):
+    """Respond with a JSON array built from an iterable of item lists, one write per list."""
+    dumps = lambda value: app.json.dumps(value, separators=(',', ':'))
+    if projection and projection.columnar:
+        head, tail = '{"fields":' + dumps(projection.fields) + ',"rows":[', ']}'
+    else:
+        head, tail = '[', ']'
+    
+    def generate():
+        yield head
+        separator = ''
+        try:
+            for chunk in chunks:
+                if chunk:
+                    items = projection.rows(chunk) if projection else chunk
+                    yield separator + ','.join(dumps(item) for item in items)
+                    separator = ','
+        except Exception as e:
+            # Headers are already sent; end the array so the body stays valid JSON
+            _log.exception("❌ Ticket stream error: %s", e)
+        yield tail
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# --- STORAGE BACKENDS ---
+# The core endpoints (registration, profiles, ticket listings and checks,
+# /pay, /add-funds and earnings) read and write through ``store``.
+# STORAGE_BACKEND=sqlite keeps that data in the SQLite database at SQLITE_PATH
+# instead of Firestore; accounts stay in Firebase Auth. The Firestore engine
+# is in firestore_storage.py, SQLite's next to the interface in storage.py.
+# The owner feed and stream, analytics rollups, earnings sync, revocation and
+# `flask compact-owner-stats` are built on Firestore; on another backend they
+# answer 501 rather than reaching for a client that was never configured.
+def _ledger_ref(user_id, entry_id, client=None):
+    """users/{userId}/ledger/{entryId}; ``client`` defaults to ``db``."""
+    return (client or db).collection('users').document(user_id).collection('ledger').document(entry_id)
+
+def _open_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(os.environ.get("SQLITE_PATH", "cholo_pay.db"))
+    if STORAGE_BACKEND != "firestore":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    firestore_storage.bind(sys.modules[__name__])
+    return firestore_storage.FirestoreStorage()
+
+store = _open_storage()
+
+def _firestore_only():
+    """A 501 response for a Firestore-only route on another storage backend, else None."""
+    if store.name != 'firestore':
+        return jsonify({"error": f"Not available with STORAGE_BACKEND={store.name}"}), 501
+    return None
 
 @app.route("/")
 def index():
     return "Welcome to the Cholo Pay Backend!"
+
+@app.route("/startup-report", methods=['GET'])
+def startup_report():
+    """Cold-start timings for this instance"""
+    return jsonify(_startup_report)
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Request and datastore metrics in the Prometheus text format"""
+    body = ''.join(metric.render() for metric in _METRICS)
+    return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/index.html')
 def serve_index():
     return send_from_directory('.', 'index.html')
@@ -66,9 +1439,18 @@ def serve_owner_dashboard():
 
 # Optional: Update root route to serve index.html directly
 # --- USER REGISTRATION ---
+def _new_user_data(uid, email, full_name):
+    return {
+        'uid': uid, 
+        'email': email, 
+        'fullName': full_name, 
+        'walletBalance': 500,  # Start with ₹500 for testing
+        'createdAt': SERVER_TIMESTAMP
+    }
+
 @app.route("/register/user", methods=['POST'])
 def register_user():
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
@@ -79,14 +1461,7 @@ def register_user():
             display_name=data['fullName']
         )
         
-        user_ref = db.collection('users').document(user.uid)
-        user_ref.set({
-            'uid': user.uid, 
-            'email': user.email, 
-            'fullName': user.display_name, 
-            'walletBalance': 500,  # Start with ₹500 for testing
-            'createdAt': firestore_client.SERVER_TIMESTAMP
-        })
+        store.create_user(user.uid, _new_user_data(user.uid, user.email, user.display_name))
         
         return jsonify({
             "success": True, 
@@ -95,25 +1470,101 @@ def register_user():
         }), 201
         
     except Exception as e: 
-        print(f"❌ User registration error: {e}")
+        _log.exception("❌ User registration error: %s", e)
         return jsonify({"error": str(e)}), 500
 
+# --- LOGIN CACHE ---
+# Logins resolve an email to a uid (an Auth round trip) and sign a custom
+# token (an RSA signature). Both are cached: uids for LOGIN_CACHE_TTL, and
+# tokens until CUSTOM_TOKEN_REFRESH_MARGIN before their one-hour expiry.
+# The Flask views sign on the request thread, which has to wait for the token
+# either way (asgi.py signs on its own pool to keep the event loop free).
+# Concurrent logins for the same uid wait on one signature.
+CUSTOM_TOKEN_LIFETIME = 3600
+CUSTOM_TOKEN_REFRESH_MARGIN = int(os.environ.get("CUSTOM_TOKEN_REFRESH_MARGIN", 600))
+
+_login_uid_cache = _TTLCache(
+    maxsize=int(os.environ.get("LOGIN_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("LOGIN_CACHE_TTL", 900))
+)
+_custom_token_cache = _TTLCache(
+    maxsize=int(os.environ.get("LOGIN_CACHE_SIZE", 10000)),
+    ttl=max(0, CUSTOM_TOKEN_LIFETIME - CUSTOM_TOKEN_REFRESH_MARGIN)
+)
+_tokens_signing = {}
+_tokens_signing_lock = threading.Lock()
+
+def _cached_login_uid(email):
+    uid = _login_uid_cache.get(email.strip().lower())
+    _login_cache_lookups.inc(('uid', 'miss' if uid is None else 'hit'))
+    return uid
+
+def _fetch_login_uid(email):
+    uid = auth.get_user_by_email(email).uid
+    _login_uid_cache.set(email.strip().lower(), uid)
+    return uid
+
+def _login_uid(email):
+    """The Auth uid for ``email``; unknown emails raise and are not cached."""
+    return _cached_login_uid(email) or _fetch_login_uid(email)
+
+def _sign_custom_token(uid):
+    started = time.perf_counter()
+    token = auth.create_custom_token(uid).decode('utf-8')
+    _token_signing_seconds.observe((), time.perf_counter() - started)
+    _custom_token_cache.set(uid, token)
+    return token
+
+def _signing_finished(uid, future):
+    with _tokens_signing_lock:
+        if _tokens_signing.get(uid) is future:
+            del _tokens_signing[uid]
+
+def _cached_custom_token(uid):
+    token = _custom_token_cache.get(uid)
+    _login_cache_lookups.inc(('token', 'miss' if token is None else 'hit'))
+    return token
+
+def _custom_token(uid):
+    """A custom token for ``uid``: cached, already being signed, or signed on this thread."""
+    token = _cached_custom_token(uid)
+    if token is not None:
+        return token
+    
+    with _tokens_signing_lock:
+        future = _tokens_signing.get(uid)
+        signing = future is None
+        if signing:
+            future = _tokens_signing[uid] = Future()
+    if not signing:
+        return future.result()
+    try:
+        token = _sign_custom_token(uid)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(token)
+    finally:
+        _signing_finished(uid, future)
+    return token
+
 # --- USER LOGIN ---
 @app.route("/login/user", methods=['POST'])
 def login_user():
     try:
         data = request.get_json()
-        user = auth.get_user_by_email(data['email'])
-        custom_token = auth.create_custom_token(user.uid)
+        uid = _login_uid(data['email'])
+        custom_token = _custom_token(uid)
         
         return jsonify({
             "success": True, 
-            "token": custom_token.decode('utf-8'), 
-            "uid": user.uid
+            "token": custom_token, 
+            "uid": uid
         })
         
     except Exception as e: 
-        print(f"❌ User login error: {e}")
+        _log.exception("❌ User login error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- OWNER LOGIN ---
@@ -121,42 +1572,57 @@ def login_user():
 def login_owner():
     try:
         data = request.get_json()
-        owner = auth.get_user_by_email(data['email'])
-        custom_token = auth.create_custom_token(owner.uid)
+        uid = _login_uid(data['email'])
+        custom_token = _custom_token(uid)
         
         return jsonify({
             "success": True, 
-            "token": custom_token.decode('utf-8'), 
-            "uid": owner.uid
+            "token": custom_token, 
+            "uid": uid
         })
         
     except Exception as e:
-        print(f"❌ Owner login error: {e}")
+        _log.exception("❌ Owner login error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- OWNER REGISTRATION ---
+def _new_owner_data(uid, email, full_name, vehicle_id, fixed_fare=10, validity_minutes=30):
+    return {
+        'uid': uid, 
+        'email': email, 
+        'fullName': full_name, 
+        'vehicleId': vehicle_id, 
+        'fixedFare': fixed_fare,
+        'ticketValidityMinutes': validity_minutes,
+        'totalEarnings': 0, 
+        'createdAt': SERVER_TIMESTAMP
+    }
+
 @app.route("/register/owner", methods=['POST'])
 def register_owner():
     try:
         data = request.get_json()
         
+        if store.get_vehicle(data['vehicleId']) is not None:
+            return jsonify({"error": "Vehicle ID already registered"}), 409
+        
         owner = auth.create_user(
             email=data['email'], 
             password=data['password'], 
             display_name=data['fullName']
         )
         
-        owner_ref = db.collection('owners').document(owner.uid)
-        owner_ref.set({
-            'uid': owner.uid, 
-            'email': owner.email, 
-            'fullName': owner.display_name, 
-            'vehicleId': data['vehicleId'], 
-            'fixedFare': int(data.get('fixedFare', 10)),
-            'ticketValidityMinutes': 30,
-            'totalEarnings': 0, 
-            'createdAt': firestore_client.SERVER_TIMESTAMP
-        })
+        owner_data = _new_owner_data(
+            owner.uid, owner.email, owner.display_name, data['vehicleId'], int(data.get('fixedFare', 10))
+        )
+        
+        try:
+            store.create_owner(owner.uid, owner_data, _vehicle_index_entry(owner.uid, owner_data))
+        except VehicleTaken:
+            # Registered by someone else since the check above
+            auth.delete_user(owner.uid)
+            return jsonify({"error": "Vehicle ID already registered"}), 409
+        _vehicle_cache.pop(data['vehicleId'])
         
         return jsonify({
             "success": True, 
@@ -165,197 +1631,629 @@ def register_owner():
         }), 201
         
     except Exception as e: 
-        print(f"❌ Owner registration error: {e}")
+        _log.exception("❌ Owner registration error: %s", e)
         return jsonify({"error": str(e)}), 500
 
-# --- TRANSACTION HELPER FUNCTION ---
-@firestore.transactional
-def _run_payment_transaction(transaction, user_ref, owner_ref, fare):
-    user_snapshot = user_ref.get(transaction=transaction)
-    owner_snapshot = owner_ref.get(transaction=transaction)
+# --- ADMIN AUTH ---
+# Operator endpoints take ``Authorization: Bearer <ADMIN_API_KEY>``. They are
+# disabled while ADMIN_API_KEY is unset.
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")
+
+def _admin_error():
+    """An error response unless the request carries the admin key, else None."""
+    if not ADMIN_API_KEY:
+        return jsonify({"error": "Admin endpoints are disabled; set ADMIN_API_KEY"}), 403
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(key.strip().encode(), ADMIN_API_KEY.encode()):
+        return jsonify({"error": "Admin credentials required"}), 401
+    return None
+
+# --- BULK ONBOARDING ---
+# POST /import/users and /import/owners (and `flask import-accounts`) take CSV
+# or JSONL records with the register endpoints' fields: email, fullName and
+# an optional password, plus vehicleId, fixedFare and ticketValidityMinutes
+# for owners. Rows are validated up front, then handled IMPORT_CHUNK_SIZE at
+# a time on IMPORT_WORKERS threads. Each chunk looks its uids and emails up
+# in Auth, its uids in both users and owners, and (for owners) its vehicles
+# in the index, then makes one auth.import_users call (passwords are
+# PBKDF2-hashed here) and batched document writes. auth.import_users
+# overwrites accounts without checking, so a row whose email, uid or vehicle
+# belongs to someone else fails instead.
+# A row's uid is derived from its email. Running the same file again reports
+# rows that are already in as 'exists'. The HTTP endpoint needs the admin key.
+MAX_IMPORT_ROWS = int(os.environ.get("MAX_IMPORT_ROWS", 10000))
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", 4))
+IMPORT_HASH_ROUNDS = int(os.environ.get("IMPORT_HASH_ROUNDS", 10000))
+# auth.import_users takes at most 1000 accounts per call
+IMPORT_CHUNK_SIZE = 500
+_IMPORT_UID_NAMESPACE = uuid.UUID('3b0f6d2e-8a41-4c5e-b7f9-1d2c6e8a4f10')
+_IMPORT_REQUIRED_FIELDS = {
+    'users': ('email', 'fullName'),
+    'owners': ('email', 'fullName', 'vehicleId'),
+}
+_IMPORT_MIMETYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/x-jsonlines': 'jsonl',
+}
+
+def parse_import_records(text, fmt):
+    """``(row number, record, error)`` for each CSV row or JSONL line of ``text``."""
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(io.StringIO(text)), 1):
+            yield number, {key.strip(): (value or '').strip() for key, value in row.items() if key}, None
+        return
     
-    user_balance = user_snapshot.get('walletBalance')
-    owner_earnings = owner_snapshot.get('totalEarnings')
+    number = 0
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, f"Invalid JSON: {e}"
+
+def _positive_int(record, field, default):
+    value = record.get(field)
+    try:
+        value = int(value) if value not in (None, '') else default
+    except (TypeError, ValueError):
+        value = 0
+    if value <= 0:
+        raise ValueError(f"{field} must be a positive whole number")
+    return value
+
+def _import_account(kind, record):
+    """A validated account dict for one import record; raises ValueError."""
+    if not isinstance(record, dict):
+        raise ValueError("Record must be an object")
+    missing = [field for field in _IMPORT_REQUIRED_FIELDS[kind] if not str(record.get(field) or '').strip()]
+    if missing:
+        raise ValueError(f"Missing field: {', '.join(missing)}")
+    
+    email = str(record['email']).strip().lower()
+    if '@' not in email:
+        raise ValueError("Invalid email")
+    password = str(record.get('password') or '')
+    if password and len(password) < 6:
+        raise ValueError("Password must be at least 6 characters")
     
-    if user_balance < fare: 
-        raise Exception("Insufficient funds")
+    account = {
+        'uid': uuid.uuid5(_IMPORT_UID_NAMESPACE, email).hex,
+        'email': email,
+        'fullName': str(record['fullName']).strip(),
+        'password': password
+    }
+    if kind == 'owners':
+        account['vehicleId'] = str(record['vehicleId']).strip()
+        if '/' in account['vehicleId']:
+            raise ValueError("vehicleId cannot contain '/'")
+        account['fixedFare'] = _positive_int(record, 'fixedFare', 10)
+        account['ticketValidityMinutes'] = _positive_int(record, 'ticketValidityMinutes', 30)
+    return account
+
+def _import_user_record(account):
+    """auth.ImportUserRecord for an account, with its password hashed for IMPORT_HASH_ROUNDS."""
+    password_hash = password_salt = None
+    if account['password']:
+        password_salt = os.urandom(16)
+        password_hash = hashlib.pbkdf2_hmac('sha256', account['password'].encode('utf-8'), password_salt, IMPORT_HASH_ROUNDS)
+    return auth.ImportUserRecord(
+        uid=account['uid'],
+        email=account['email'],
+        display_name=account['fullName'],
+        password_hash=password_hash,
+        password_salt=password_salt
+    )
+
+def _auth_accounts(accounts):
+    """``(by uid, by email)``: the Auth accounts that already hold any of ``accounts``' uids or emails."""
+    identifiers = []
+    for account in accounts:
+        identifiers += [auth.UidIdentifier(account['uid']), auth.EmailIdentifier(account['email'])]
+    by_uid, by_email = {}, {}
+    # auth.get_users takes at most 100 identifiers per call
+    for start in range(0, len(identifiers), 100):
+        for user in auth.get_users(identifiers[start:start + 100]).users:
+            by_uid[user.uid] = user
+            if user.email:
+                by_email[user.email.lower()] = user
+    return by_uid, by_email
+
+def _import_chunk(kind, accounts):
+    """Create a chunk of ``(row, account)`` pairs; ``{row: (status, error)}``."""
+    results = {}
+    uids = [account['uid'] for _, account in accounts]
+    # Users and owners share the uid space, so both are checked
+    existing = {'users': store.get_users(uids, fields=['uid']), 'owners': store.get_owners(uids, fields=['uid'])}
+    other = 'owners' if kind == 'users' else 'users'
+    try:
+        by_uid, by_email = _auth_accounts([account for _, account in accounts])
+    except Exception as e:
+        _log.warning("⚠️ Account import lookup failed: %s", e)
+        results.update((number, ('failed', str(e))) for number, _ in accounts)
+        return results
+    vehicles = store.get_vehicles([account['vehicleId'] for _, account in accounts]) if kind == 'owners' else {}
+    
+    pending, resumed = [], []
+    for number, account in accounts:
+        uid = account['uid']
+        auth_user = by_email.get(account['email'])
+        vehicle = vehicles.get(account.get('vehicleId'))
+        if existing[kind].get(uid) is not None:
+            results[number] = ('exists', None)
+        elif existing[other].get(uid) is not None:
+            results[number] = ('failed', f"Email already registered as {'an owner' if other == 'owners' else 'a user'}")
+        elif auth_user is not None and auth_user.uid != uid:
+            results[number] = ('failed', "Email already registered")
+        elif uid in by_uid and auth_user is None:
+            results[number] = ('failed', "Account id already in use")
+        elif vehicle is not None and vehicle['ownerId'] != uid:
+            results[number] = ('failed', "Vehicle ID already registered")
+        elif uid in by_uid:
+            # In Auth from an earlier run that did not get to write the documents
+            resumed.append((number, account))
+        else:
+            pending.append((number, account))
+    
+    created = list(resumed)
+    if pending:
+        try:
+            import_result = auth.import_users(
+                [_import_user_record(account) for _, account in pending],
+                hash_alg=auth.UserImportHash.pbkdf2_sha256(rounds=IMPORT_HASH_ROUNDS)
+            )
+        except Exception as e:
+            _log.warning("⚠️ Account import chunk failed: %s", e)
+            results.update((number, ('failed', str(e))) for number, _ in pending)
+            pending = []
+        else:
+            auth_errors = {error.index: error.reason for error in import_result.errors}
+            for position, (number, account) in enumerate(pending):
+                if position in auth_errors:
+                    results[number] = ('failed', auth_errors[position])
+                else:
+                    created.append((number, account))
+    if not created:
+        return results
+    
+    try:
+        if kind == 'users':
+            store.create_users({
+                account['uid']: _new_user_data(account['uid'], account['email'], account['fullName'])
+                for _, account in created
+            })
+        else:
+            owners = []
+            for _, account in created:
+                owner_data = _new_owner_data(
+                    account['uid'], account['email'], account['fullName'],
+                    account['vehicleId'], account['fixedFare'], account['ticketValidityMinutes']
+                )
+                owners.append((account['uid'], owner_data, _vehicle_index_entry(account['uid'], owner_data)))
+            store.create_owners(owners)
+            for _, account in created:
+                _vehicle_cache.pop(account['vehicleId'])
+    except Exception as e:
+        # The accounts exist in Auth; importing the same rows again writes the documents
+        _log.warning("⚠️ Account import writes failed: %s", e)
+        results.update((number, ('failed', str(e))) for number, _ in created)
+        return results
+    
+    results.update((number, ('created', None)) for number, _ in created)
+    return results
+
+def import_accounts(kind, records, workers=IMPORT_WORKERS):
+    """Create 'users' or 'owners' accounts from ``parse_import_records`` triples.
+
+    Returns ``(results, summary)``: one result per record in row order, and
+    status counts with the run's throughput.
+    """
+    started = time.perf_counter()
+    results = {}
+    accounts = []
+    seen = {}
+    for number, record, error in records:
+        email = record.get('email') if isinstance(record, dict) else None
+        results[number] = {"row": number, "email": email, "uid": None, "status": "failed", "error": error}
+        if error:
+            continue
+        try:
+            account = _import_account(kind, record)
+            for field in ('email', 'vehicleId'):
+                if (field, account.get(field)) in seen:
+                    raise ValueError(f"Duplicate {field} (row {seen[field, account[field]]})")
+            for field in ('email', 'vehicleId'):
+                if field in account:
+                    seen[field, account[field]] = number
+        except ValueError as e:
+            results[number]['error'] = str(e)
+            continue
+        results[number].update(email=account['email'], uid=account['uid'])
+        accounts.append((number, account))
+    
+    chunks = [accounts[start:start + IMPORT_CHUNK_SIZE] for start in range(0, len(accounts), IMPORT_CHUNK_SIZE)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks))), thread_name_prefix='import') as executor:
+            # Each chunk keeps the caller's request id and datastore metering
+            futures = [executor.submit(contextvars.copy_context().run, _import_chunk, kind, chunk) for chunk in chunks]
+            for future in futures:
+                for number, (status, error) in future.result().items():
+                    results[number].update(status=status, error=error)
+    
+    ordered = [results[number] for number in sorted(results)]
+    seconds = time.perf_counter() - started
+    summary = {status: sum(1 for r in ordered if r['status'] == status) for status in ('created', 'exists', 'failed')}
+    summary.update(
+        rows=len(ordered),
+        seconds=round(seconds, 3),
+        rowsPerSecond=round(len(ordered) / seconds, 1) if seconds else None
+    )
+    
+    _log.info("✅ Imported %s: %s", kind, summary)
+    return ordered, summary
+
+@app.route("/import/<kind>", methods=['POST'])
+def import_accounts_endpoint(kind):
+    """Bulk-create users or owners from a CSV or JSONL body"""
+    denied = _admin_error()
+    if denied:
+        return denied
+    if kind not in _IMPORT_REQUIRED_FIELDS:
+        return jsonify({"error": "Import type must be users or owners"}), 404
+    if not store:
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        fmt = request.args.get('format') or _IMPORT_MIMETYPES.get(request.mimetype)
+        if fmt not in ('csv', 'jsonl'):
+            return jsonify({"error": "Send text/csv or application/x-ndjson, or pass ?format=csv|jsonl"}), 400
+        
+        records = list(parse_import_records(request.get_data(as_text=True), fmt))
+        if not records:
+            return jsonify({"error": "No records to import"}), 400
+        if len(records) > MAX_IMPORT_ROWS:
+            return jsonify({"error": f"At most {MAX_IMPORT_ROWS} records per import"}), 400
+        
+        results, summary = import_accounts(kind, records)
+        
+        return jsonify({
+            "success": True,
+            "summary": summary,
+            "results": results
+        })
+        
+    except Exception as e:
+        _log.exception("❌ Account import error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.cli.command('import-accounts')
+@click.argument('kind', type=click.Choice(sorted(_IMPORT_REQUIRED_FIELDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None, help='Input format (default: from the file extension).')
+@click.option('--workers', default=IMPORT_WORKERS, type=click.IntRange(1), help='Chunks imported in parallel.')
+@click.option('--results', 'results_path', type=click.Path(dir_okay=False), default=None, help='Write per-row results to this file as JSONL.')
+def import_accounts_command(kind, path, fmt, workers, results_path):
+    """Create user or owner accounts in bulk from a CSV or JSONL file."""
+    if not store:
+        raise click.ClickException("Database not initialized")
     
-    new_user_balance = user_balance - fare
-    new_owner_earnings = owner_earnings + fare
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8-sig', newline='') as source:
+        records = list(parse_import_records(source.read(), fmt))
     
-    transaction.update(user_ref, {'walletBalance': new_user_balance})
-    transaction.update(owner_ref, {'totalEarnings': new_owner_earnings})
+    results, summary = import_accounts(kind, records, workers=workers)
     
-    return new_user_balance
+    if results_path:
+        with open(results_path, 'w', encoding='utf-8') as output:
+            for result in results:
+                output.write(json.dumps(result) + '\n')
+    for result in results:
+        if result['status'] == 'failed':
+            click.echo(f"row {result['row']}: {result['error']}", err=True)
+    click.echo(
+        f"{summary['created']} created, {summary['exists']} already present, {summary['failed']} failed "
+        f"in {summary['seconds']}s ({summary['rowsPerSecond']} rows/s)"
+    )
 
 # --- GET USER DETAILS ---
+def _serializable_user(user_data):
+    # Convert any timestamps to serializable format
+    for key, value in user_data.items():
+        if hasattr(value, 'seconds'):  # Firestore timestamp
+            user_data[key] = {'seconds': value.seconds}
+    return user_data
+
 @app.route("/get-user-details/<user_id>", methods=['GET'])
 def get_user_details(user_id):
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
-        print(f"🔍 Getting user details for: {user_id}")
+        _log.debug("🔍 Getting user details for: %s", user_id)
         
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        user_data = store.get_user(user_id)
         
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            print(f"✅ User found: {user_data.get('fullName', 'Unknown')}")
+        if user_data is not None:
+            _log.debug("✅ User found: %s", user_data.get('fullName', 'Unknown'))
             
             # Ensure walletBalance exists and is a number
             if 'walletBalance' not in user_data:
                 user_data['walletBalance'] = 0
-                user_ref.update({'walletBalance': 0})
+                store.ensure_wallet(user_id)
             
-            # Convert any timestamps to serializable format
-            for key, value in user_data.items():
-                if hasattr(value, 'seconds'):  # Firestore timestamp
-                    user_data[key] = {'seconds': value.seconds}
-            
-            return jsonify(user_data)
+            return jsonify(_serializable_user(user_data))
         else:
-            print(f"❌ User not found: {user_id}")
+            _log.info("❌ User not found: %s", user_id)
             return jsonify({"error": "User not found"}), 404
             
     except Exception as e:
-        print(f"❌ Get user details error: {e}")
+        _log.exception("❌ Get user details error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- GET USER TICKETS ---
 @app.route("/get-user-tickets/<user_id>", methods=['GET'])
 def get_user_tickets(user_id):
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
-        print(f"🔍 Getting tickets for user: {user_id}")
+        _log.debug("🔍 Getting tickets for user: %s", user_id)
         
-        tickets = []
-        current_time = datetime.now(pytz.UTC)
+        limit, after = _page_args()
+        try:
+            projection = _projection_args()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        now = _now_micros()
         
-        # Get all tickets and filter by userId
-        tickets_collection = db.collection('tickets')
-        all_tickets = tickets_collection.stream()
+        if limit is None and _stream_requested():
+            tickets = _ticket_history('userId', user_id, after=after, select=projection.select)
+            return _stream_json_array(_chunked(_normalized_tickets(tickets, now, _RIDER_HIDDEN_TICKET_FIELDS)), projection)
         
-        for ticket_doc in all_tickets:
-            try:
-                ticket_data = ticket_doc.to_dict()
-                
-                # Check if this ticket belongs to the user
-                if ticket_data.get('userId') == user_id:
-                    print(f"✅ Found ticket: {ticket_data.get('ticketId', 'Unknown')}")
-                    
-                    # Handle expiry time with proper timezone handling
-                    expires_at = ticket_data.get('expiresAt')
-                    
-                    if expires_at:
-                        try:
-                            # Handle Firestore DatetimeWithNanoseconds
-                            if hasattr(expires_at, 'timestamp'):
-                                expires_at_aware = expires_at.replace(tzinfo=current_time.tzinfo) if expires_at.tzinfo is None else expires_at
-                                current_time_aware = current_time.replace(tzinfo=expires_at.tzinfo) if current_time.tzinfo is None else current_time
-                                
-                                is_valid = current_time_aware < expires_at_aware and ticket_data.get('status', 'valid') == 'valid'
-                                ticket_data['isValid'] = is_valid
-                                ticket_data['timeRemaining'] = max(0, (expires_at_aware - current_time_aware).total_seconds()) if is_valid else 0
-                                ticket_data['expiresAt'] = expires_at.isoformat()
-                            else:
-                                # Handle regular datetime objects
-                                if isinstance(expires_at, datetime):
-                                    is_valid = current_time < expires_at and ticket_data.get('status', 'valid') == 'valid'
-                                    ticket_data['isValid'] = is_valid
-                                    ticket_data['timeRemaining'] = max(0, (expires_at - current_time).total_seconds()) if is_valid else 0
-                                    ticket_data['expiresAt'] = expires_at.isoformat()
-                                else:
-                                    ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
-                                    ticket_data['timeRemaining'] = 0
-                        except Exception as e:
-                            print(f"⚠️ Error processing expiry time: {e}")
-                            ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
-                            ticket_data['timeRemaining'] = 0
-                    else:
-                        ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
-                        ticket_data['timeRemaining'] = 0
-                    
-                    # Handle timestamp with proper error handling
-                    if 'timestamp' in ticket_data:
-                        timestamp = ticket_data['timestamp']
-                        try:
-                            if hasattr(timestamp, 'seconds'):
-                                ticket_data['timestamp'] = {'seconds': timestamp.seconds}
-                            elif hasattr(timestamp, 'timestamp'):
-                                ticket_data['timestamp'] = {'seconds': int(timestamp.timestamp())}
-                        except Exception as e:
-                            print(f"⚠️ Error processing timestamp: {e}")
-                            ticket_data['timestamp'] = {'seconds': 0}
-                    
-                    # Ensure required fields exist
-                    ticket_data.setdefault('ticketId', ticket_doc.id)
-                    ticket_data.setdefault('vehicleId', 'Unknown')
-                    ticket_data.setdefault('farePaid', 0)
-                    ticket_data.setdefault('status', 'valid')
-                    
-                    tickets.append(ticket_data)
-                    
-            except Exception as e:
-                print(f"⚠️ Error processing ticket: {e}")
-                continue
-        
-        print(f"✅ Found {len(tickets)} tickets for user")
+        # Newest tickets for this user, one page at a time
+        tickets, next_cursor = _ticket_page('userId', user_id, limit, after, projection.select)
+        _normalize_tickets(tickets, now, hidden=_RIDER_HIDDEN_TICKET_FIELDS)
         
-        # Sort by timestamp (newest first)
-        try:
-            tickets.sort(key=lambda x: x.get('timestamp', {}).get('seconds', 0), reverse=True)
-        except Exception as e:
-            print(f"⚠️ Error sorting tickets: {e}")
+        _log.debug("✅ Found %s tickets for user", len(tickets))
         
-        return jsonify(tickets)
+        return _page_response(tickets, next_cursor, projection)
         
+    except UnknownCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"❌ Get user tickets error: {e}")
+        _log.exception("❌ Get user tickets error: %s", e)
         return jsonify([])
 
 # --- GET VEHICLE FARE ---
+def _vehicle_fare_body(vehicle_id, vehicle):
+    return {
+        "success": True,
+        "fare": vehicle['fixedFare'],
+        "validityMinutes": vehicle['ticketValidityMinutes'],
+        "vehicleId": vehicle_id
+    }
+
 @app.route("/get-vehicle-fare/<vehicle_id>", methods=['GET'])
 def get_vehicle_fare(vehicle_id):
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
-        print(f"🔍 Looking for vehicle: {vehicle_id}")
+        _log.debug("🔍 Looking for vehicle: %s", vehicle_id)
         
-        # Get all owners and find by vehicleId
-        owners_collection = db.collection('owners')
-        all_owners = owners_collection.stream()
+        vehicle = _lookup_vehicle(vehicle_id)
         
-        for owner_doc in all_owners:
-            owner_data = owner_doc.to_dict()
-            if owner_data.get('vehicleId') == vehicle_id:
-                print(f"✅ Vehicle found: {vehicle_id}")
-                
-                fare = int(owner_data.get('fixedFare', 10))
-                validity_minutes = int(owner_data.get('ticketValidityMinutes', 30))
-                
-                return jsonify({
-                    "success": True,
-                    "fare": fare,
-                    "validityMinutes": validity_minutes,
-                    "vehicleId": vehicle_id
-                })
+        if not vehicle:
+            _log.info("❌ Vehicle not found: %s", vehicle_id)
+            return jsonify({"error": "Vehicle not found"}), 404
         
-        print(f"❌ Vehicle not found: {vehicle_id}")
-        return jsonify({"error": "Vehicle not found"}), 404
+        _log.debug("✅ Vehicle found: %s", vehicle_id)
+        
+        return jsonify(_vehicle_fare_body(vehicle_id, vehicle))
         
     except Exception as e:
-        print(f"❌ Get vehicle fare error: {e}")
+        _log.exception("❌ Get vehicle fare error: %s", e)
         return jsonify({"error": str(e)}), 500
 
+# --- SIGNED TICKET TOKENS ---
+# A ticket token is ``base64url(payload).base64url(signature)`` where the payload
+# is ``[ticketId, vehicleId, expiresAt epoch seconds, fare]`` and the signature is
+# a truncated HMAC-SHA256. Checkers verify it locally; only revocations need
+# the database, and those are mirrored in memory. Tokens are only issued when
+# TICKET_TOKEN_SECRET is set: a key made up per process would not verify on
+# other instances or after a restart.
+TICKET_TOKEN_SECRET = os.environ.get("TICKET_TOKEN_SECRET")
+if not TICKET_TOKEN_SECRET:
+    _log.warning("⚠️ TICKET_TOKEN_SECRET is not set; tickets are issued without tokens")
+_ticket_token_key = TICKET_TOKEN_SECRET.encode() if TICKET_TOKEN_SECRET else None
+TICKET_TOKEN_SIGNATURE_BYTES = 16
+REVOCATION_REFRESH_SECONDS = int(os.environ.get("REVOCATION_REFRESH_SECONDS", "30"))
+REVOCATION_OVERLAP = timedelta(minutes=1)
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _ticket_token_signature(payload):
+    return hmac.new(_ticket_token_key, payload, hashlib.sha256).digest()[:TICKET_TOKEN_SIGNATURE_BYTES]
+
+def sign_ticket_token(ticket_id, vehicle_id, expires_at, fare):
+    """Issue the compact signed token for a ticket; None while tokens are disabled."""
+    if _ticket_token_key is None:
+        return None
+    payload = json.dumps(
+        [ticket_id, vehicle_id, int(expires_at.timestamp()), fare],
+        separators=(',', ':')
+    ).encode()
+    return f"{_b64encode(payload)}.{_b64encode(_ticket_token_signature(payload))}"
+
+def verify_ticket_token(token, now=None):
+    """Verify a ticket token without a database read.
+
+    Returns ``None`` when the token is malformed, the signature does not
+    match or tokens are disabled. Otherwise returns the ticket's claims with
+    ``isValid`` and a ``status`` of ``valid``, ``expired`` or ``revoked``.
+    """
+    if _ticket_token_key is None:
+        return None
+    try:
+        encoded_payload, encoded_signature = token.split('.')
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except (AttributeError, ValueError):
+        return None
+    if not hmac.compare_digest(signature, _ticket_token_signature(payload)):
+        return None
+    
+    ticket_id, vehicle_id, expires_epoch, fare = json.loads(payload)
+    now = time.time() if now is None else now
+    if _revoked_tickets.contains(ticket_id):
+        status = 'revoked'
+    elif now >= expires_epoch:
+        status = 'expired'
+    else:
+        status = 'valid'
+    
+    return {
+        "ticketId": ticket_id,
+        "isValid": status == 'valid',
+        "status": status,
+        "expiresAt": datetime.fromtimestamp(expires_epoch, tz=timezone.utc).isoformat(),
+        "farePaid": fare,
+        "vehicleId": vehicle_id
+    }
+
+class _RevocationSet:
+    """Revoked ticket ids mirrored from the ``revokedTickets`` collection.
+
+    ``prime()`` loads the set on a daemon thread at startup; a lookup only
+    waits if that first load has not finished yet. After that a stale set is
+    refreshed on a daemon thread while lookups keep answering from memory.
+    Entries are dropped once the ticket would have expired anyway.
+    """
+
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self._revoked = {}
+        self._watermark = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._priming = False
+        self._primed = threading.Event()
+        self._lock = threading.Lock()
+
+    def prime(self):
+        """Start the first load on a daemon thread, once."""
+        with self._lock:
+            if self._priming:
+                return
+            self._priming = True
+        threading.Thread(target=self._prime, name='revocation-prime', daemon=True).start()
+
+    def _prime(self):
+        try:
+            self.refresh()
+        finally:
+            self._primed.set()
+
+    def contains(self, ticket_id):
+        if not self._primed.is_set():
+            self.prime()
+            self._primed.wait()
+        with self._lock:
+            stale = not self._refreshing and time.monotonic() - self._loaded_at >= self.refresh_seconds
+            if stale:
+                self._refreshing = True
+            revoked = ticket_id in self._revoked
+        if stale:
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return revoked
+
+    def add(self, ticket_id, expires_epoch):
+        with self._lock:
+            self._revoked[ticket_id] = expires_epoch
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh(self):
+        """Pull revocations since the last refresh (or all unexpired ones)."""
+        try:
+            if db:
+                query = db.collection('revokedTickets')
+                if self._watermark is None:
+                    query = query.where(filter=firestore.FieldFilter('expiresAt', '>', datetime.now(timezone.utc)))
+                else:
+                    query = query.where(filter=firestore.FieldFilter('revokedAt', '>', self._watermark - REVOCATION_OVERLAP))
+                docs = list(query.select(['expiresAt', 'revokedAt']).stream())
+                with self._lock:
+                    for doc in docs:
+                        self._revoked[doc.id] = doc.get('expiresAt').timestamp()
+                        revoked_at = doc.get('revokedAt')
+                        if isinstance(revoked_at, datetime) and (self._watermark is None or revoked_at > self._watermark):
+                            self._watermark = revoked_at
+                    if self._watermark is None:
+                        self._watermark = datetime.now(timezone.utc)
+                    cutoff = time.time()
+                    for ticket_id in [t for t, expires in self._revoked.items() if expires <= cutoff]:
+                        del self._revoked[ticket_id]
+        except Exception as e:
+            _log.warning("⚠️ Revocation refresh failed: %s", e)
+        finally:
+            with self._lock:
+                self._loaded_at = time.monotonic()
+
+_revoked_tickets = _RevocationSet(REVOCATION_REFRESH_SECONDS)
+if _ticket_token_key is not None and STORAGE_BACKEND == "firestore":
+    _revoked_tickets.prime()
+
 # --- PAYMENT ENDPOINT ---
+def _new_ticket(user_id, vehicle_id, vehicle):
+    """``(ticket, response_body, now)`` for a new /pay ticket; newBalance is added later."""
+    fare = vehicle['fixedFare']
+    validity_minutes = vehicle['ticketValidityMinutes']
+    
+    ticket_id = str(uuid.uuid4())
+    current_time = datetime.now(timezone.utc)
+    expiry_time = current_time + timedelta(minutes=validity_minutes)
+    
+    ticket_token = sign_ticket_token(ticket_id, vehicle_id, expiry_time, fare)
+    
+    response_body = {
+        "success": True,
+        "message": "Payment successful. Ticket generated.",
+        "ticketId": ticket_id,
+        "ticketToken": ticket_token,
+        "farePaid": fare,
+        "expiresAt": expiry_time.isoformat(),
+        "validityMinutes": validity_minutes
+    }
+    ticket = {
+        'ticketId': ticket_id,
+        'userId': user_id,
+        'ownerId': vehicle['ownerId'],
+        'vehicleId': vehicle_id,
+        'farePaid': fare,
+        'timestamp': SERVER_TIMESTAMP,
+        'recordedAt': SERVER_TIMESTAMP,
+        'expiresAt': expiry_time,
+        'status': 'valid',
+        'ticketToken': ticket_token
+    }
+    return ticket, response_body, current_time
+
 @app.route("/pay", methods=['POST'])
 def make_payment():
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
@@ -363,79 +2261,183 @@ def make_payment():
         user_id = data['userId']
         vehicle_id = data['vehicleId']
         
-        print(f"💳 Processing payment: User {user_id} -> Vehicle {vehicle_id}")
+        _log.debug("💳 Processing payment: User %s -> Vehicle %s", user_id, vehicle_id)
+        
+        # A retried request gets the original response back
+        idempotency_key = request.headers.get('Idempotency-Key')
+        idempotency_scope = f"pay:{user_id}"
+        if idempotency_key:
+            replay = _find_idempotent_response(idempotency_scope, idempotency_key)
+            if replay is not None:
+                _log.info("🔁 Replaying payment for key %s", idempotency_key)
+                return replay
         
         # Find owner by vehicle ID
-        owner_ref = None
-        owner_data = None
+        vehicle = _lookup_vehicle(vehicle_id)
         
-        owners_collection = db.collection('owners')
-        all_owners = owners_collection.stream()
+        if not vehicle:
+            return jsonify({"error": "Vehicle not found"}), 404
         
-        for owner_doc in all_owners:
-            temp_data = owner_doc.to_dict()
-            if temp_data.get('vehicleId') == vehicle_id:
-                owner_ref = owners_collection.document(owner_doc.id)
-                owner_data = temp_data
-                break
+        ticket, response_body, current_time = _new_ticket(user_id, vehicle_id, vehicle)
+        idempotency = None
+        if idempotency_key:
+            idempotency = _idempotency_record(idempotency_scope, idempotency_key, response_body, 201)
         
-        if not owner_data:
-            return jsonify({"error": "Vehicle not found"}), 404
+        # Balance check, debit, ticket and owner credit run in one transaction
+        new_user_balance = store.pay(user_id, ticket, current_time, idempotency)
         
-        fare = int(owner_data.get('fixedFare', 10))
-        validity_minutes = int(owner_data.get('ticketValidityMinutes', 30))
+        if idempotency is not None:
+            _remember_idempotent_response(idempotency)
         
-        # Check user balance
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        _log.info("✅ Payment successful: Ticket %s", ticket['ticketId'])
         
-        if not user_doc.exists:
-            return jsonify({"error": "User not found"}), 404
+        response_body['newBalance'] = new_user_balance
+        return jsonify(response_body), 201
+        
+    except IdempotentReplay as e:
+        return _replay_response(e.record)
+    except PaymentError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        _log.exception("❌ Payment error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+# --- BATCH PAYMENT ENDPOINT ---
+MAX_BATCH_PAYMENTS = 500
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+_BATCH_TICKET_NAMESPACE = uuid.UUID('6f1c9a52-3e8b-4d7a-9c1e-2b7d4f0a8e61')
+
+def _batch_ticket_id(user_id, idempotency_key):
+    """Deterministic ticket id for a queued scan; keys only need to be unique per passenger."""
+    return str(uuid.uuid5(_BATCH_TICKET_NAMESPACE, f"{user_id}:{idempotency_key}"))
+
+def _path_id(record, field):
+    """``record[field]`` if it can name a document; raises KeyError or ValueError."""
+    value = record[field]
+    if not isinstance(value, str) or not value or '/' in value:
+        raise ValueError(f"{field} must be a non-empty string without '/'")
+    return value
+
+# Earliest clientTimestamp accepted; anything before it is a device clock or
+# encoding error, not a ride.
+MIN_CLIENT_TIMESTAMP = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+def _parse_client_timestamp(value):
+    """Epoch seconds/milliseconds or an ISO-8601 string, as an aware UTC datetime.
+
+    Raises ValueError for anything else, including times before MIN_CLIENT_TIMESTAMP.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = value / 1000 if value > 1e11 else value
+        try:
+            parsed = datetime.fromtimestamp(seconds, tz=timezone.utc)
+        except (OverflowError, OSError) as e:
+            raise ValueError("clientTimestamp is out of range") from e
+    elif isinstance(value, str):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if not parsed.tzinfo:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+    else:
+        raise ValueError("clientTimestamp must be epoch seconds or an ISO-8601 string")
+    if parsed < MIN_CLIENT_TIMESTAMP:
+        raise ValueError("clientTimestamp is out of range")
+    return parsed
+
+@app.route("/pay/batch", methods=['POST'])
+def make_batch_payment():
+    """Ingest queued offline scans from conductor devices"""
+    if not store: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        data = request.get_json()
+        records = data.get('payments') if isinstance(data, dict) else data
         
-        user_data = user_doc.to_dict()
-        user_balance = user_data.get('walletBalance', 0)
+        if not isinstance(records, list) or not records:
+            return jsonify({"error": "payments must be a non-empty list"}), 400
+        if len(records) > MAX_BATCH_PAYMENTS:
+            return jsonify({"error": f"At most {MAX_BATCH_PAYMENTS} payments per batch"}), 400
         
-        if user_balance < fare:
-            return jsonify({"error": "Insufficient funds"}), 400
+        _log.debug("💳 Processing batch of %s payments", len(records))
         
-        # Update balances
-        new_user_balance = user_balance - fare
-        new_owner_earnings = owner_data.get('totalEarnings', 0) + fare
+        results = {}
+        vehicles = {}
+        seen_keys = {}
+        groups = OrderedDict()
+        now = datetime.now(timezone.utc)
         
-        user_ref.update({'walletBalance': new_user_balance})
-        owner_ref.update({'totalEarnings': new_owner_earnings})
+        for index, record in enumerate(records):
+            idempotency_key = record.get('idempotencyKey') if isinstance(record, dict) else None
+            try:
+                if not idempotency_key:
+                    raise ValueError("idempotencyKey is required")
+                if not isinstance(idempotency_key, str):
+                    raise ValueError("idempotencyKey must be a string")
+                user_id = _path_id(record, 'userId')
+                vehicle_id = _path_id(record, 'vehicleId')
+                boarded_at = _parse_client_timestamp(record['clientTimestamp'])
+                if boarded_at > now + MAX_CLOCK_SKEW:
+                    raise ValueError("clientTimestamp is in the future")
+            except (KeyError, TypeError, ValueError) as e:
+                message = f"Missing field: {e}" if isinstance(e, KeyError) else str(e)
+                results[index] = {"index": index, "idempotencyKey": idempotency_key, "status": "failed", "error": message}
+                continue
+            
+            if (user_id, idempotency_key) in seen_keys:
+                results[index] = {"index": index, "idempotencyKey": idempotency_key, "status": "duplicate", "ticketId": seen_keys[user_id, idempotency_key]}
+                continue
+            
+            # Each vehicle is resolved once per batch (and usually from cache)
+            if vehicle_id not in vehicles:
+                vehicles[vehicle_id] = _lookup_vehicle(vehicle_id)
+            vehicle = vehicles[vehicle_id]
+            if not vehicle:
+                results[index] = {"index": index, "idempotencyKey": idempotency_key, "status": "failed", "error": "Vehicle not found"}
+                continue
+            
+            ticket_id = _batch_ticket_id(user_id, idempotency_key)
+            seen_keys[user_id, idempotency_key] = ticket_id
+            validity_minutes = vehicle['ticketValidityMinutes']
+            expires_at = boarded_at + timedelta(minutes=validity_minutes)
+            groups.setdefault(user_id, []).append({
+                'index': index,
+                'idempotencyKey': idempotency_key,
+                'when': boarded_at,
+                'validityMinutes': validity_minutes,
+                'ticket': {
+                    'ticketId': ticket_id,
+                    'userId': user_id,
+                    'ownerId': vehicle['ownerId'],
+                    'vehicleId': vehicle_id,
+                    'farePaid': vehicle['fixedFare'],
+                    'timestamp': boarded_at,
+                    'expiresAt': expires_at,
+                    # Scans uploaded after the ride is over are stored already expired
+                    'status': 'valid' if expires_at > now else 'expired',
+                    'ticketToken': sign_ticket_token(ticket_id, vehicle_id, expires_at, vehicle['fixedFare']),
+                    'idempotencyKey': idempotency_key,
+                    'recordedAt': SERVER_TIMESTAMP
+                }
+            })
         
-        # Create ticket
-        ticket_id = str(uuid.uuid4())
-        current_time = datetime.now(pytz.UTC)
-        expiry_time = current_time + timedelta(minutes=validity_minutes)
+        # Debits are grouped per user and applied in boarding order
+        results.update(store.pay_batch([
+            (user_id, sorted(items, key=lambda item: item['when'])) for user_id, items in groups.items()
+        ]))
         
-        ticket_ref = db.collection('tickets').document(ticket_id)
-        ticket_ref.set({
-            'ticketId': ticket_id,
-            'userId': user_id,
-            'ownerId': owner_ref.id,
-            'vehicleId': vehicle_id,
-            'farePaid': fare,
-            'timestamp': firestore_client.SERVER_TIMESTAMP,
-            'expiresAt': expiry_time,
-            'status': 'valid'
-        })
+        ordered = [results[index] for index in range(len(records))]
+        summary = {status: sum(1 for r in ordered if r['status'] == status) for status in ('created', 'duplicate', 'failed')}
         
-        print(f"✅ Payment successful: Ticket {ticket_id}")
+        _log.info("✅ Batch processed: %s", summary)
         
         return jsonify({
             "success": True,
-            "message": "Payment successful. Ticket generated.",
-            "ticketId": ticket_id,
-            "newBalance": new_user_balance,
-            "farePaid": fare,
-            "expiresAt": expiry_time.isoformat(),
-            "validityMinutes": validity_minutes
-        }), 201
+            "summary": summary,
+            "results": ordered
+        })
         
     except Exception as e:
-        print(f"❌ Payment error: {e}")
+        _log.exception("❌ Batch payment error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- ADD FUNDS ---
@@ -449,301 +2451,937 @@ def add_funds():
         if amount <= 0:
             return jsonify({"error": "Amount must be greater than 0"}), 400
         
-        print(f"💰 Adding ₹{amount} to user: {user_id}")
+        _log.debug("💰 Adding ₹%s to user: %s", amount, user_id)
+        
+        idempotency_key = request.headers.get('Idempotency-Key')
+        idempotency_scope = f"add-funds:{user_id}"
+        idempotency = None
+        if idempotency_key:
+            replay = _find_idempotent_response(idempotency_scope, idempotency_key)
+            if replay is not None:
+                _log.info("🔁 Replaying top-up for key %s", idempotency_key)
+                return replay
+            idempotency = _idempotency_record(idempotency_scope, idempotency_key, {
+                "success": True, 
+                "message": f"Added ₹{amount} to wallet."
+            }, 200)
         
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        current_balance, new_balance = store.add_funds(user_id, amount, idempotency)
         
-        if user_doc.exists:
-            current_balance = user_doc.to_dict().get('walletBalance', 0)
-            new_balance = current_balance + amount
-            user_ref.update({'walletBalance': new_balance})
-            
-            print(f"✅ Balance updated: ₹{current_balance} -> ₹{new_balance}")
-            
-            return jsonify({
-                "success": True, 
-                "message": f"Added ₹{amount} to wallet.",
-                "newBalance": new_balance
-            })
-        else:
-            return jsonify({"error": "User not found"}), 404
+        if idempotency is not None:
+            _remember_idempotent_response(idempotency)
+        
+        _log.info("✅ Balance updated: ₹%s -> ₹%s", current_balance, new_balance)
+        
+        return jsonify({
+            "success": True, 
+            "message": f"Added ₹{amount} to wallet.",
+            "newBalance": new_balance
+        })
         
+    except IdempotentReplay as e:
+        return _replay_response(e.record)
+    except PaymentError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
-        print(f"❌ Add funds error: {e}")
+        _log.exception("❌ Add funds error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- GET OWNER DETAILS ---
 @app.route("/get-owner-details/<owner_id>", methods=['GET'])
 def get_owner_details(owner_id):
     try:
-        print(f"🔍 Getting owner details for: {owner_id}")
+        _log.debug("🔍 Getting owner details for: %s", owner_id)
         
-        owner_ref = db.collection('owners').document(owner_id)
-        owner_doc = owner_ref.get()
+        owner_data = store.get_owner(owner_id)
         
-        if owner_doc.exists:
-            owner_data = owner_doc.to_dict()
-            print(f"✅ Owner found: {owner_data.get('fullName', 'Unknown')}")
+        if owner_data is not None:
+            _log.debug("✅ Owner found: %s", owner_data.get('fullName', 'Unknown'))
             
             # Convert timestamps
             for key, value in owner_data.items():
                 if hasattr(value, 'seconds'):
                     owner_data[key] = {'seconds': value.seconds}
             
+            # Live earnings come from the sharded counters
+            totals = store.owner_totals(owner_id)
+            if totals is not None:
+                owner_data['totalEarnings'] = totals['totalRevenue']
+            
             return jsonify(owner_data)
         else:
-            print(f"❌ Owner not found: {owner_id}")
+            _log.info("❌ Owner not found: %s", owner_id)
             return jsonify({"error": "Owner not found"}), 404
             
     except Exception as e:
-        print(f"❌ Get owner details error: {e}")
+        _log.exception("❌ Get owner details error: %s", e)
         return jsonify({"error": str(e)}), 500
 
-# --- GET OWNER TICKETS ---
-@app.route("/get-owner-tickets/<owner_id>", methods=['GET'])
-def get_owner_tickets(owner_id):
-    if not db: 
+# --- GET OWNER EARNINGS ---
+@app.route("/get-owner-earnings/<owner_id>", methods=['GET'])
+def get_owner_earnings(owner_id):
+    """Sum the owner's earnings counter shards"""
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
-        print(f"🔍 Getting tickets for owner: {owner_id}")
-        
-        tickets = []
-        current_time = datetime.now()
+        totals = store.owner_totals(owner_id)
         
-        # Get all tickets and filter by ownerId
-        tickets_collection = db.collection('tickets')
-        all_tickets = tickets_collection.stream()
+        if totals is None:
+            return jsonify({"error": "No earnings recorded for owner"}), 404
         
-        for ticket_doc in all_tickets:
-            try:
-                ticket_data = ticket_doc.to_dict()
-                
-                # Check if this ticket belongs to the owner
-                if ticket_data.get('ownerId') == owner_id:
-                    print(f"✅ Found owner ticket: {ticket_data.get('ticketId', 'Unknown')}")
-                    
-                    # Get user details
-                    user_id = ticket_data.get('userId')
-                    if user_id:
-                        try:
-                            user_ref = db.collection('users').document(user_id)
-                            user_doc = user_ref.get()
-                            
-                            if user_doc.exists:
-                                user_data = user_doc.to_dict()
-                                ticket_data['userName'] = user_data.get('fullName', 'Unknown User')
-                                ticket_data['userEmail'] = user_data.get('email', 'No email')
-                            else:
-                                ticket_data['userName'] = 'Unknown User'
-                                ticket_data['userEmail'] = 'No email'
-                        except Exception as e:
-                            print(f"⚠️ Error getting user details: {e}")
-                            ticket_data['userName'] = 'Unknown User'
-                            ticket_data['userEmail'] = 'No email'
-                    else:
-                        ticket_data['userName'] = 'Unknown User'
-                        ticket_data['userEmail'] = 'No email'
-                    
-                    # Handle expiry time and validity
-                    expires_at = ticket_data.get('expiresAt')
-                    if expires_at:
-                        try:
-                            if hasattr(expires_at, 'timestamp'):
-                                expires_at_aware = expires_at.replace(tzinfo=current_time.tzinfo) if expires_at.tzinfo is None else expires_at
-                                current_time_aware = current_time.replace(tzinfo=expires_at.tzinfo) if current_time.tzinfo is None else current_time
-                                
-                                is_valid = current_time_aware < expires_at_aware and ticket_data.get('status', 'valid') == 'valid'
-                                ticket_data['isValid'] = is_valid
-                                ticket_data['isActive'] = is_valid
-                                ticket_data['expiresAt'] = expires_at.isoformat()
-                            else:
-                                is_valid = ticket_data.get('status', 'valid') == 'valid'
-                                ticket_data['isValid'] = is_valid
-                                ticket_data['isActive'] = is_valid
-                        except Exception as e:
-                            print(f"⚠️ Error processing expiry: {e}")
-                            ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
-                            ticket_data['isActive'] = ticket_data.get('status', 'valid') == 'valid'
-                    else:
-                        ticket_data['isValid'] = ticket_data.get('status', 'valid') == 'valid'
-                        ticket_data['isActive'] = ticket_data.get('status', 'valid') == 'valid'
-                    
-                    # Handle timestamp
-                    if 'timestamp' in ticket_data:
-                        timestamp = ticket_data['timestamp']
-                        try:
-                            if hasattr(timestamp, 'seconds'):
-                                ticket_data['timestamp'] = {'seconds': timestamp.seconds}
-                            elif hasattr(timestamp, 'timestamp'):
-                                ticket_data['timestamp'] = {'seconds': int(timestamp.timestamp())}
-                        except Exception as e:
-                            print(f"⚠️ Error processing timestamp: {e}")
-                            ticket_data['timestamp'] = {'seconds': 0}
-                    
-                    # Ensure required fields
-                    ticket_data.setdefault('ticketId', ticket_doc.id)
-                    ticket_data.setdefault('vehicleId', 'Unknown')
-                    ticket_data.setdefault('farePaid', 0)
-                    ticket_data.setdefault('status', 'valid')
-                    
-                    tickets.append(ticket_data)
-                    
-            except Exception as e:
-                print(f"⚠️ Error processing owner ticket: {e}")
-                continue
+        return jsonify({
+            "ownerId": owner_id,
+            "totalEarnings": totals['totalRevenue'],
+            "ticketCount": totals['ticketCount']
+        })
         
-        print(f"✅ Found {len(tickets)} tickets for owner")
+    except Exception as e:
+        _log.exception("❌ Get owner earnings error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+# --- OWNER ANALYTICS ---
+# The dashboard reads one document, ownerStats/{ownerId}/rollups/analytics,
+# folded from the aggregates above by _roll_up_owner: totals, the last
+# ANALYTICS_DAYS day buckets, unique passengers, and the owner's valid
+# tickets counted per expiry minute so active tickets can be counted against
+# the clock at read time. roll_up_owner_analytics refolds the owners paid
+# since its last run (see OWNER ANALYTICS ROLLUP); a rollup older than
+# ANALYTICS_ROLLUP_MAX_AGE seconds is refolded by the request that finds it.
+ANALYTICS_DAYS = 30
+ANALYTICS_ROLLUP_MAX_AGE = int(os.environ.get("ANALYTICS_ROLLUP_MAX_AGE", 300))
+
+def _count(query):
+    """Server-side count() aggregation: one read per 1000 matching index entries."""
+    return query.count(alias='total').get()[0][0].value
+
+def _analytics_rollup_ref(owner_id):
+    return db.collection('ownerStats').document(owner_id).collection('rollups').document('analytics')
+
+def _expiry_minute(when):
+    """Bucket key for a ticket expiring at ``when``: the epoch minute it has expired by."""
+    return str(-(-int(when.timestamp()) // 60))
+
+def _roll_up_owner(owner_id, now=None):
+    """Fold an owner's aggregates into their analytics rollup document and return it."""
+    now = now or datetime.now(timezone.utc)
+    today = now.astimezone(_analytics_tz()).date()
+    day_keys = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(ANALYTICS_DAYS)]
+    stats_ref = db.collection('ownerStats').document(owner_id)
+    
+    expiries = {}
+    for ticket_doc in db.collection('tickets').where(
+        filter=firestore.FieldFilter('ownerId', '==', owner_id)
+    ).where(
+        filter=firestore.FieldFilter('status', '==', 'valid')
+    ).where(
+        filter=firestore.FieldFilter('expiresAt', '>', now)
+    ).select(['expiresAt']).stream():
+        minute = _expiry_minute(ticket_doc.get('expiresAt'))
+        expiries[minute] = expiries.get(minute, 0) + 1
+    
+    rollup = {
+        'ownerId': owner_id,
+        'rolledUpAt': now,
+        'totals': _read_owner_totals(owner_id) or {'totalRevenue': 0, 'ticketCount': 0},
+        'days': _read_owner_days(stats_ref, day_keys),
+        'uniquePassengers': _count(stats_ref.collection('passengers')),
+        'expiries': expiries
+    }
+    _analytics_rollup_ref(owner_id).set(rollup)
+    return rollup
+
+@app.route("/owner-analytics/<owner_id>", methods=['GET'])
+def get_owner_analytics(owner_id):
+    """Dashboard analytics from the owner's analytics rollup"""
+    unsupported = _firestore_only()
+    if unsupported:
+        return unsupported
+    if not db: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        _log.debug("📊 Getting analytics for owner: %s", owner_id)
+        
+        now = datetime.now(timezone.utc)
+        today = now.astimezone(_analytics_tz()).date()
+        day_keys = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(ANALYTICS_DAYS)]
+        
+        rollup_doc = _analytics_rollup_ref(owner_id).get()
+        rollup = rollup_doc.to_dict() if rollup_doc.exists else None
+        if rollup is None or (now - rollup['rolledUpAt']).total_seconds() > ANALYTICS_ROLLUP_MAX_AGE:
+            rollup = _roll_up_owner(owner_id, now)
+        
+        day_data = rollup['days']
+        totals = rollup['totals']
+        now_minute = int(_expiry_minute(now))
+        active_tickets = sum(count for minute, count in rollup['expiries'].items() if int(minute) > now_minute)
+        
+        daily = [{
+            'date': key,
+            'revenue': day_data.get(key, {}).get('revenue', 0),
+            'ticketCount': day_data.get(key, {}).get('ticketCount', 0)
+        } for key in reversed(day_keys)]
+        
+        def window(days):
+            return {
+                'revenue': sum(day['revenue'] for day in daily[-days:]),
+                'ticketCount': sum(day['ticketCount'] for day in daily[-days:])
+            }
+        
+        today_hours = day_data.get(day_keys[0], {}).get('hours', {})
+        hourly = [{
+            'hour': hour,
+            'revenue': today_hours.get(f"{hour:02d}", {}).get('revenue', 0),
+            'ticketCount': today_hours.get(f"{hour:02d}", {}).get('ticketCount', 0)
+        } for hour in range(24)]
         
-        # Sort by timestamp (newest first)
-        try:
-            tickets.sort(key=lambda x: x.get('timestamp', {}).get('seconds', 0), reverse=True)
-        except Exception as e:
-            print(f"⚠️ Error sorting tickets: {e}")
+        return jsonify({
+            "ownerId": owner_id,
+            "timezone": _analytics_tz().zone,
+            "totalRevenue": totals['totalRevenue'],
+            "ticketCount": totals['ticketCount'],
+            "today": {**window(1), "hourly": hourly},
+            "week": window(7),
+            "month": window(ANALYTICS_DAYS),
+            "daily": daily,
+            "activeTickets": active_tickets,
+            "expiredTickets": max(0, totals['ticketCount'] - active_tickets),
+            "uniquePassengers": rollup['uniquePassengers'],
+            "rolledUpAt": rollup['rolledUpAt'].isoformat()
+        })
         
-        return jsonify(tickets)
+    except Exception as e:
+        _log.exception("❌ Owner analytics error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.cli.command('compact-owner-stats')
+@click.option('--owner', 'owner_ids', multiple=True, help='Owner ID to compact (default: all owners).')
+@click.option('--verify-days', default=0, type=int, help='Also re-check this many recent day buckets.')
+def compact_owner_stats(owner_ids, verify_days):
+    """Fold earnings and day shards into their ownerStats documents and optionally verify day buckets."""
+    if store.name != 'firestore':
+        raise click.ClickException(f"Not available with STORAGE_BACKEND={store.name}")
+    if not db:
+        raise click.ClickException("Database not initialized")
+    
+    if not owner_ids:
+        owner_ids = [stats_doc.id for stats_doc in db.collection('ownerStats').select(['ownerId']).stream()]
+    
+    for owner_id in owner_ids:
+        stats_ref = db.collection('ownerStats').document(owner_id)
+        folded = _compact_owner_shards(db.transaction(), stats_ref)
+        day_keys = sorted({
+            shard_doc.to_dict().get('date') for shard_doc in stats_ref.collection('dayShards').select(['date']).stream()
+        })
+        folded_days = sum(_compact_owner_day_shards(db.transaction(), stats_ref, keys) for keys in _day_chunks(day_keys))
+        corrections = []
+        if verify_days:
+            totals = _read_owner_totals(owner_id) or {'totalRevenue': 0, 'ticketCount': 0}
+            _, corrections = _verify_owner_stats(owner_id, totals, verify_days)
+        _roll_up_owner(owner_id)
+        click.echo(
+            f"{owner_id}: folded {folded} shard(s) and {folded_days} day(s) of day shards, "
+            f"{len(corrections)} day correction(s)"
+        )
+
+# --- GET OWNER TICKETS ---
+@app.route("/get-owner-tickets/<owner_id>", methods=['GET'])
+def get_owner_tickets(owner_id):
+    if not store: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        _log.debug("🔍 Getting tickets for owner: %s", owner_id)
         
+        limit, after = _page_args()
+        try:
+            projection = _projection_args(passenger_info=True)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        enrich = projection.wants(_PASSENGER_FIELDS)
+        now = _now_micros()
+        
+        if limit is None and _stream_requested():
+            # Passenger info is attached per chunk, so enrichment reads stay batched
+            tickets = _ticket_history('ownerId', owner_id, after=after, select=projection.select)
+            chunks = _chunked(_normalized_tickets(tickets, now))
+            if enrich:
+                chunks = (_attach_user_info(chunk) for chunk in chunks)
+            return _stream_json_array(chunks, projection)
+        
+        # Newest tickets for this owner, one page at a time
+        tickets, next_cursor = _ticket_page('ownerId', owner_id, limit, after, projection.select)
+        _normalize_tickets(tickets, now)
+        
+        # Passenger names/emails for the whole page in one batched read
+        if enrich:
+            _attach_user_info(tickets)
+        
+        _log.debug("✅ Found %s tickets for owner", len(tickets))
+        
+        return _page_response(tickets, next_cursor, projection)
+        
+    except UnknownCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"❌ Get owner tickets error: {e}")
+        _log.exception("❌ Get owner tickets error: %s", e)
         return jsonify([])
 
 # --- GET TICKETS BY STATUS ---
+def _unexpired(ticket, now_micros):
+    expires_at = ticket.get('expiresAt')
+    return not isinstance(expires_at, datetime) or _epoch_micros(expires_at) > now_micros
+
+def _newest_first(ticket):
+    """Sort key matching ``iter_tickets`` order: timestamp, then ticketId."""
+    timestamp = ticket.get('timestamp')
+    return (_epoch_micros(timestamp) if isinstance(timestamp, datetime) else 0, ticket['ticketId'])
+
 @app.route("/get-tickets-by-status/<owner_id>/<status>", methods=['GET'])
 def get_tickets_by_status(owner_id, status):
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
-        print(f"🔍 Getting {status} tickets for owner: {owner_id}")
+        _log.debug("🔍 Getting %s tickets for owner: %s", status, owner_id)
         
+        limit, after = _page_args()
+        try:
+            projection = _projection_args(passenger_info=True, reads=('status', 'expiresAt', 'timestamp'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        enrich = projection.wants(_PASSENGER_FIELDS)
         filtered_tickets = []
-        current_time = datetime.now()
+        next_cursor = None
+        now = _now_micros()
+        position = archive_position(after)
+        # Cursors of the archived tickets read, taken before normalizing rewrites timestamp
+        archive_cursors = {}
+        
+        def scan(statuses):
+            if position:
+                return iter(())
+            return store.iter_tickets('ownerId', owner_id, after=after, fields=projection.select, statuses=statuses)
+        
+        def archived():
+            for ticket in store.iter_archived_tickets('ownerId', owner_id, position, projection.select):
+                archive_cursors[ticket['ticketId']] = archive_cursor(ticket)
+                yield ticket
+        
+        # Status is kept up to date by the expiry sweeper, so each scan is an
+        # indexed status query. Tickets that lapsed since the last sweep are
+        # still stored as 'valid' and are sorted out against the clock here.
+        if status == 'active':
+            tickets = (ticket for ticket in scan(['valid']) if _unexpired(ticket, now))
+        elif status == 'expired':
+            lapsed = (ticket for ticket in scan(['valid']) if not _unexpired(ticket, now))
+            tickets = itertools.chain(
+                heapq.merge(scan(['expired', 'revoked']), lapsed, key=_newest_first, reverse=True),
+                # Archived tickets are far older than any ticket validity
+                archived()
+            )
+        else:
+            tickets = iter(())
+        matching = _normalized_tickets(tickets, now)
+        
+        if limit is None and _stream_requested():
+            chunks = _chunked(matching)
+            if enrich:
+                chunks = (_attach_user_info(chunk) for chunk in chunks)
+            return _stream_json_array(chunks, projection)
+        
+        for ticket_data in matching:
+            if limit and len(filtered_tickets) == limit:
+                last_id = filtered_tickets[-1]['ticketId']
+                next_cursor = archive_cursors.get(last_id, last_id)
+                break
+            filtered_tickets.append(ticket_data)
+        
+        if enrich:
+            _attach_user_info(filtered_tickets)
         
-        # Get all tickets and filter by ownerId and status
-        tickets_collection = db.collection('tickets')
-        all_tickets = tickets_collection.stream()
+        _log.debug("✅ Found %s %s tickets for owner", len(filtered_tickets), status)
         
-        for ticket_doc in all_tickets:
+        return _page_response(filtered_tickets, next_cursor, projection)
+        
+    except UnknownCursor as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        _log.exception("❌ Get tickets by status error: %s", e)
+        return jsonify([])
+
+# --- TICKET EXPIRY SWEEPER ---
+# Tickets are written 'valid' and lapse by the clock. The sweeper writes that
+# down: a range query on the (status, expiresAt) index finds 'valid' tickets
+# whose expiresAt has passed, and they are flipped to 'expired' in
+# transactions of up to EXPIRY_SWEEP_BATCH_SIZE writes. Flipped tickets leave
+# the range, so an interrupted sweep picks up where it stopped; progress is
+# checkpointed after every batch under checkpoints/ticketExpiry. Run it with
+# ``flask sweep-expired-tickets`` (e.g. from cron), or set
+# EXPIRY_SWEEP_INTERVAL to a number of seconds to sweep in-process.
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get("EXPIRY_SWEEP_INTERVAL", 0))
+EXPIRY_SWEEP_BATCH_SIZE = min(500, int(os.environ.get("EXPIRY_SWEEP_BATCH_SIZE", 500)))
+_EXPIRY_CHECKPOINT = 'ticketExpiry'
+
+def sweep_expired_tickets(cutoff=None, batch_size=EXPIRY_SWEEP_BATCH_SIZE, max_batches=None):
+    """Flip every 'valid' ticket that expired by ``cutoff`` (default: now) to 'expired'.
+
+    Stops early after ``max_batches``. Returns the run's final checkpoint.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = cutoff or now
+    previous = store.get_checkpoint(_EXPIRY_CHECKPOINT) or {}
+    checkpoint = {
+        'cutoff': cutoff,
+        'startedAt': now,
+        'updatedAt': now,
+        'completedAt': None,
+        'expired': 0,
+        'batches': 0,
+        'lastExpiresAt': None,
+        'sweptThrough': previous.get('sweptThrough')
+    }
+    
+    while max_batches is None or checkpoint['batches'] < max_batches:
+        count, last_expires_at = store.expire_tickets(cutoff, batch_size)
+        checkpoint['updatedAt'] = datetime.now(timezone.utc)
+        if count:
+            checkpoint['expired'] += count
+            checkpoint['batches'] += 1
+            checkpoint['lastExpiresAt'] = last_expires_at
+        if count < batch_size:
+            checkpoint['completedAt'] = checkpoint['updatedAt']
+            checkpoint['sweptThrough'] = cutoff
+        store.save_checkpoint(_EXPIRY_CHECKPOINT, checkpoint)
+        if checkpoint['completedAt']:
+            break
+    
+    _log.info("⏰ Expired %s ticket(s) in %s batch(es) up to %s", checkpoint['expired'], checkpoint['batches'], cutoff.isoformat())
+    return checkpoint
+
+class _PeriodicJob:
+    """Runs ``job`` every ``interval`` seconds on a daemon thread."""
+
+    def __init__(self, name, interval, job):
+        self.name = name
+        self.interval = interval
+        self.job = job
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
             try:
-                ticket_data = ticket_doc.to_dict()
-                
-                # Check if this ticket belongs to the owner
-                if ticket_data.get('ownerId') == owner_id:
-                    
-                    # Determine if ticket is active or expired
-                    expires_at = ticket_data.get('expiresAt')
-                    if expires_at:
-                        try:
-                            if hasattr(expires_at, 'timestamp'):
-                                expires_at_aware = expires_at.replace(tzinfo=current_time.tzinfo) if expires_at.tzinfo is None else expires_at
-                                current_time_aware = current_time.replace(tzinfo=expires_at.tzinfo) if current_time.tzinfo is None else current_time
-                                is_active = current_time_aware < expires_at_aware and ticket_data.get('status', 'valid') == 'valid'
-                                ticket_data['expiresAt'] = expires_at.isoformat()
-                            else:
-                                is_active = ticket_data.get('status', 'valid') == 'valid'
-                        except Exception as e:
-                            print(f"⚠️ Error checking ticket status: {e}")
-                            is_active = ticket_data.get('status', 'valid') == 'valid'
-                    else:
-                        is_active = ticket_data.get('status', 'valid') == 'valid'
-                    
-                    # Filter based on requested status
-                    if (status == 'active' and is_active) or (status == 'expired' and not is_active):
-                        
-                        # Get user details
-                        user_id = ticket_data.get('userId')
-                        if user_id:
-                            try:
-                                user_ref = db.collection('users').document(user_id)
-                                user_doc = user_ref.get()
-                                
-                                if user_doc.exists:
-                                    user_data = user_doc.to_dict()
-                                    ticket_data['userName'] = user_data.get('fullName', 'Unknown User')
-                                    ticket_data['userEmail'] = user_data.get('email', 'No email')
-                                else:
-                                    ticket_data['userName'] = 'Unknown User'
-                                    ticket_data['userEmail'] = 'No email'
-                            except Exception as e:
-                                print(f"⚠️ Error getting user details: {e}")
-                                ticket_data['userName'] = 'Unknown User'
-                                ticket_data['userEmail'] = 'No email'
-                        else:
-                            ticket_data['userName'] = 'Unknown User'
-                            ticket_data['userEmail'] = 'No email'
-                        
-                        ticket_data['isActive'] = is_active
-                        ticket_data['isValid'] = is_active
-                        
-                        # Handle timestamp
-                        if 'timestamp' in ticket_data:
-                            timestamp = ticket_data['timestamp']
-                            try:
-                                if hasattr(timestamp, 'seconds'):
-                                    ticket_data['timestamp'] = {'seconds': timestamp.seconds}
-                                elif hasattr(timestamp, 'timestamp'):
-                                    ticket_data['timestamp'] = {'seconds': int(timestamp.timestamp())}
-                            except Exception as e:
-                                print(f"⚠️ Error processing timestamp: {e}")
-                                ticket_data['timestamp'] = {'seconds': 0}
-                        
-                        # Ensure required fields
-                        ticket_data.setdefault('ticketId', ticket_doc.id)
-                        ticket_data.setdefault('vehicleId', 'Unknown')
-                        ticket_data.setdefault('farePaid', 0)
-                        ticket_data.setdefault('status', 'valid')
-                        
-                        filtered_tickets.append(ticket_data)
-                        
+                if store:
+                    self.job()
             except Exception as e:
-                print(f"⚠️ Error processing ticket by status: {e}")
+                _log.warning("⚠️ %s failed: %s", self.name, e)
+
+_expiry_sweeper = _PeriodicJob('expiry-sweeper', EXPIRY_SWEEP_INTERVAL, sweep_expired_tickets)
+if EXPIRY_SWEEP_INTERVAL > 0:
+    _expiry_sweeper.start()
+
+@app.cli.command('sweep-expired-tickets')
+@click.option('--batch-size', default=EXPIRY_SWEEP_BATCH_SIZE, type=click.IntRange(1, 500), help='Tickets flipped per transaction.')
+@click.option('--max-batches', default=None, type=int, help='Stop after this many batches (default: until none are left).')
+def sweep_expired_tickets_command(batch_size, max_batches):
+    """Mark 'valid' tickets past their expiry as 'expired'."""
+    if not store:
+        raise click.ClickException("Database not initialized")
+    
+    checkpoint = sweep_expired_tickets(batch_size=batch_size, max_batches=max_batches)
+    remaining = "" if checkpoint['completedAt'] else "; more remain"
+    click.echo(f"expired {checkpoint['expired']} ticket(s) in {checkpoint['batches']} batch(es){remaining}")
+
+# Tickets written before every writer set ``status`` have none, and the
+# indexed status queries (the active/expired listings and the sweeper) never
+# match them. Firestore cannot query for a missing field, so
+# ``flask backfill-ticket-status`` walks the whole collection once in document
+# id order and stores 'valid' or 'expired' by the clock, which is what the
+# listings used to infer. SQLite has always stored a status.
+def backfill_ticket_status(batch_size=500):
+    """Store a status on every Firestore ticket that has none. Returns ``(scanned, updated)``."""
+    tickets_collection = db.collection('tickets')
+    # Unordered queries come back in document id order
+    query = tickets_collection.select(['status', 'expiresAt']).limit(batch_size)
+    scanned = updated = 0
+    last_doc = None
+    while True:
+        page = list((query.start_after(last_doc) if last_doc else query).stream())
+        now = datetime.now(timezone.utc)
+        batch = db.batch()
+        missing = 0
+        for ticket_doc in page:
+            ticket = ticket_doc.to_dict()
+            if 'status' in ticket:
                 continue
+            expires_at = ticket.get('expiresAt')
+            lapsed = isinstance(expires_at, datetime) and expires_at <= now
+            batch.update(ticket_doc.reference, {'status': 'expired' if lapsed else 'valid'})
+            missing += 1
+        if missing:
+            batch.commit()
+        scanned += len(page)
+        updated += missing
+        if len(page) < batch_size:
+            return scanned, updated
+        last_doc = page[-1]
+
+@app.cli.command('backfill-ticket-status')
+@click.option('--batch-size', default=500, type=click.IntRange(1, 500), help='Tickets read (and at most updated) per batch.')
+def backfill_ticket_status_command(batch_size):
+    """Give tickets stored without a status 'valid' or 'expired'."""
+    if store.name != 'firestore':
+        raise click.ClickException(f"Not available with STORAGE_BACKEND={store.name}")
+    if not db:
+        raise click.ClickException("Database not initialized")
+    
+    scanned, updated = backfill_ticket_status(batch_size)
+    click.echo(f"set status on {updated} of {scanned} ticket(s)")
+
+# --- TICKET ARCHIVE ---
+# Tickets older than ARCHIVE_AFTER_DAYS leave the hot tickets collection for
+# compacted per-owner, per-month archive parts (see storage.add_to_archive),
+# oldest first and ARCHIVE_BATCH_SIZE per transaction. Ticket history
+# listings continue into the archive once a page runs past the last hot
+# ticket; validity checks, revocation and the owner feed only see hot
+# tickets. The age never drops below MIN_ARCHIVE_DAYS, so the earnings
+# verification window (31 days at most) always reads hot tickets.
+MIN_ARCHIVE_DAYS = 32
+ARCHIVE_AFTER_DAYS = max(MIN_ARCHIVE_DAYS, int(os.environ.get("ARCHIVE_AFTER_DAYS", 180)))
+# One delete per ticket plus at most two part writes per owner-month touched
+ARCHIVE_BATCH_SIZE = 160
+_ARCHIVE_CHECKPOINT = 'ticketArchive'
+
+def archive_old_tickets(older_than_days=ARCHIVE_AFTER_DAYS, max_batches=None):
+    """Move every ticket older than ``older_than_days`` into the archive tier.
+
+    Stops early after ``max_batches``. Returns the run's final checkpoint.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=max(MIN_ARCHIVE_DAYS, older_than_days))
+    previous = store.get_checkpoint(_ARCHIVE_CHECKPOINT) or {}
+    checkpoint = {
+        'cutoff': cutoff,
+        'startedAt': now,
+        'updatedAt': now,
+        'completedAt': None,
+        'archived': 0,
+        'batches': 0,
+        'lastTimestamp': None,
+        'archivedThrough': previous.get('archivedThrough')
+    }
+    
+    while max_batches is None or checkpoint['batches'] < max_batches:
+        count, last_timestamp = store.archive_tickets(cutoff, ARCHIVE_BATCH_SIZE)
+        checkpoint['updatedAt'] = datetime.now(timezone.utc)
+        if count:
+            checkpoint['archived'] += count
+            checkpoint['batches'] += 1
+            checkpoint['lastTimestamp'] = last_timestamp
+        if count < ARCHIVE_BATCH_SIZE:
+            checkpoint['completedAt'] = checkpoint['updatedAt']
+            checkpoint['archivedThrough'] = cutoff
+        store.save_checkpoint(_ARCHIVE_CHECKPOINT, checkpoint)
+        if checkpoint['completedAt']:
+            break
+    
+    _log.info("📦 Archived %s ticket(s) in %s batch(es) older than %s", checkpoint['archived'], checkpoint['batches'], cutoff.isoformat())
+    return checkpoint
+
+@app.cli.command('archive-tickets')
+@click.option('--older-than-days', default=ARCHIVE_AFTER_DAYS, type=click.IntRange(MIN_ARCHIVE_DAYS), help='Archive tickets older than this.')
+@click.option('--max-batches', default=None, type=int, help='Stop after this many batches (default: until none are left).')
+def archive_tickets_command(older_than_days, max_batches):
+    """Move old tickets into the per-owner, per-month archive."""
+    if not store:
+        raise click.ClickException("Database not initialized")
+    
+    checkpoint = archive_old_tickets(older_than_days, max_batches)
+    remaining = "" if checkpoint['completedAt'] else "; more remain"
+    click.echo(f"archived {checkpoint['archived']} ticket(s) in {checkpoint['batches']} batch(es){remaining}")
+
+# --- WALLET LEDGER ---
+# Every wallet change is appended to users/{userId}/ledger in the same
+# transaction that moves walletBalance with an Increment (see storage.ledger_entry).
+# /wallet-history pages through it newest first; its cursor is the seq a page
+# ended on, which compaction keeps (a snapshot takes its month's last seq).
+# Entries older than
+# LEDGER_COMPACT_AFTER_DAYS are folded into monthly snapshot entries, oldest
+# first and LEDGER_COMPACT_BATCH_SIZE per transaction, by
+# `flask compact-wallet-ledger` or every LEDGER_COMPACT_INTERVAL seconds.
+LEDGER_COMPACT_AFTER_DAYS = int(os.environ.get("LEDGER_COMPACT_AFTER_DAYS", 90))
+LEDGER_COMPACT_INTERVAL = int(os.environ.get("LEDGER_COMPACT_INTERVAL", 0))
+# One delete per entry plus at most one snapshot write per user-month
+LEDGER_COMPACT_BATCH_SIZE = 240
+_LEDGER_CHECKPOINT = 'walletLedger'
+
+@app.route("/wallet-history/<user_id>", methods=['GET'])
+def get_wallet_history(user_id):
+    """A user's wallet ledger, newest first, paged with ?limit=&after="""
+    if not store:
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        limit, after = _page_args()
+        if after is not None and not (after.isascii() and after.isdigit()):
+            raise UnknownCursor(after)
         
-        print(f"✅ Found {len(filtered_tickets)} {status} tickets for owner")
+        # One extra entry tells us whether another page exists
+        entries = list(store.iter_ledger(user_id, limit and limit + 1, after and int(after)))
+        next_cursor = None
+        if limit and len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = str(entries[-1]['seq'])
+        
+        for entry in entries:
+            entry['createdAt'] = entry['createdAt'].isoformat()
+        
+        return _page_response(entries, next_cursor)
+        
+    except UnknownCursor as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        _log.exception("❌ Wallet history error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def compact_wallet_ledger(older_than_days=LEDGER_COMPACT_AFTER_DAYS, max_batches=None):
+    """Fold every ledger entry older than ``older_than_days`` into monthly snapshots.
+
+    Stops early after ``max_batches``. Returns the run's final checkpoint.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=max(1, older_than_days))
+    checkpoint = {
+        'cutoff': cutoff,
+        'startedAt': now,
+        'updatedAt': now,
+        'completedAt': None,
+        'folded': 0,
+        'batches': 0,
+        'lastCreatedAt': None
+    }
+    
+    while max_batches is None or checkpoint['batches'] < max_batches:
+        count, last_created_at = store.compact_ledger(cutoff, LEDGER_COMPACT_BATCH_SIZE)
+        checkpoint['updatedAt'] = datetime.now(timezone.utc)
+        if count:
+            checkpoint['folded'] += count
+            checkpoint['batches'] += 1
+            checkpoint['lastCreatedAt'] = last_created_at
+        if count < LEDGER_COMPACT_BATCH_SIZE:
+            checkpoint['completedAt'] = checkpoint['updatedAt']
+        store.save_checkpoint(_LEDGER_CHECKPOINT, checkpoint)
+        if checkpoint['completedAt']:
+            break
+    
+    _log.info("📒 Folded %s ledger entries in %s batch(es) older than %s", checkpoint['folded'], checkpoint['batches'], cutoff.isoformat())
+    return checkpoint
+
+_ledger_compactor = _PeriodicJob('ledger-compactor', LEDGER_COMPACT_INTERVAL, compact_wallet_ledger)
+if LEDGER_COMPACT_INTERVAL > 0:
+    _ledger_compactor.start()
+
+@app.cli.command('compact-wallet-ledger')
+@click.option('--older-than-days', default=LEDGER_COMPACT_AFTER_DAYS, type=click.IntRange(1), help='Fold entries older than this.')
+@click.option('--max-batches', default=None, type=int, help='Stop after this many batches (default: until none are left).')
+def compact_wallet_ledger_command(older_than_days, max_batches):
+    """Fold old wallet ledger entries into monthly snapshot entries."""
+    if not store:
+        raise click.ClickException("Database not initialized")
+    
+    checkpoint = compact_wallet_ledger(older_than_days, max_batches)
+    remaining = "" if checkpoint['completedAt'] else "; more remain"
+    click.echo(f"folded {checkpoint['folded']} ledger entries in {checkpoint['batches']} batch(es){remaining}")
+
+# --- OWNER ANALYTICS ROLLUP ---
+# Refolds the analytics rollup of every owner with a day shard written since
+# the previous run (checkpoints/ownerAnalytics), looking back a further
+# ANALYTICS_ROLLUP_OVERLAP for writers whose clocks lag. The first run folds
+# every owner. Run it with ``flask roll-up-owner-analytics`` (e.g. from cron),
+# or set ANALYTICS_ROLLUP_INTERVAL to a number of seconds to run in-process.
+ANALYTICS_ROLLUP_INTERVAL = float(os.environ.get("ANALYTICS_ROLLUP_INTERVAL", 0))
+ANALYTICS_ROLLUP_OVERLAP = timedelta(minutes=5)
+_ANALYTICS_CHECKPOINT = 'ownerAnalytics'
+
+def roll_up_owner_analytics(owner_ids=None):
+    """Refold the rollups of ``owner_ids`` (default: owners paid since the last run).
+
+    Returns the number of owners folded.
+    """
+    now = datetime.now(timezone.utc)
+    scheduled = owner_ids is None
+    if scheduled:
+        previous = store.get_checkpoint(_ANALYTICS_CHECKPOINT) or {}
+        since = previous.get('rolledUpThrough')
+        if since is None:
+            owner_ids = [owner_doc.id for owner_doc in db.collection('owners').select(['vehicleId']).stream()]
+        else:
+            owner_ids = sorted({
+                shard_doc.get('ownerId') for shard_doc in db.collection_group('dayShards').where(
+                    filter=firestore.FieldFilter('updatedAt', '>', since - ANALYTICS_ROLLUP_OVERLAP)
+                ).select(['ownerId']).stream()
+            })
+    
+    for owner_id in owner_ids:
+        _roll_up_owner(owner_id, now)
+    
+    if scheduled:
+        store.save_checkpoint(_ANALYTICS_CHECKPOINT, {
+            'rolledUpThrough': now,
+            'updatedAt': datetime.now(timezone.utc),
+            'owners': len(owner_ids)
+        })
+    _log.info("📊 Rolled up analytics for %s owner(s)", len(owner_ids))
+    return len(owner_ids)
+
+_analytics_roller = _PeriodicJob('analytics-rollup', ANALYTICS_ROLLUP_INTERVAL, roll_up_owner_analytics)
+if ANALYTICS_ROLLUP_INTERVAL > 0 and store and store.name == 'firestore':
+    _analytics_roller.start()
+
+@app.cli.command('roll-up-owner-analytics')
+@click.option('--owner', 'owner_ids', multiple=True, help='Owner ID to fold (default: owners paid since the last run).')
+def roll_up_owner_analytics_command(owner_ids):
+    """Refold owner analytics rollups."""
+    if store.name != 'firestore':
+        raise click.ClickException(f"Not available with STORAGE_BACKEND={store.name}")
+    if not db:
+        raise click.ClickException("Database not initialized")
+    
+    count = roll_up_owner_analytics(list(owner_ids) or None)
+    click.echo(f"rolled up analytics for {count} owner(s)")
+
+# --- OWNER TICKET FEED ---
+# Tickets created for an owner after a cursor, ordered by recordedAt (the
+# server time a ticket was written). A cursor is recordedAt in epoch
+# microseconds. Each instance keeps one Firestore snapshot listener per owner
+# and fans its changes out to every long-poll and SSE subscriber.
+FEED_MAX_WAIT = 25
+FEED_HEARTBEAT_SECONDS = 15
+FEED_PAGE_SIZE = 200
+
+def _feed_cursor(when):
+    return str(_epoch_micros(when))
+
+def _feed_cursor_time(cursor):
+    return _EPOCH + timedelta(microseconds=int(cursor))
+
+class _OwnerFeedHub:
+    """Shares one snapshot listener per owner across local feed subscribers."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._feeds = {}
+
+    def subscribe(self, owner_id):
+        subscription = queue.Queue()
+        with self._lock:
+            feed = self._feeds.get(owner_id)
+            if feed is None:
+                feed = self._feeds[owner_id] = {'subscribers': set(), 'watch': None}
+                feed['subscribers'].add(subscription)
+                query = db.collection('tickets').where(
+                    filter=firestore.FieldFilter('ownerId', '==', owner_id)
+                ).where(
+                    filter=firestore.FieldFilter('recordedAt', '>', datetime.now(timezone.utc))
+                )
+                feed['watch'] = query.on_snapshot(
+                    lambda docs, changes, read_time: self._publish(owner_id, changes)
+                )
+            else:
+                feed['subscribers'].add(subscription)
+        return subscription
+
+    def unsubscribe(self, owner_id, subscription):
+        with self._lock:
+            feed = self._feeds.get(owner_id)
+            if feed is None:
+                return
+            feed['subscribers'].discard(subscription)
+            if not feed['subscribers']:
+                del self._feeds[owner_id]
+                if feed['watch'] is not None:
+                    feed['watch'].unsubscribe()
+
+    def _publish(self, owner_id, changes):
+        added = [change.document for change in changes if change.type.name == 'ADDED']
+        if not added:
+            return
+        with self._lock:
+            subscribers = list(self._feeds.get(owner_id, {}).get('subscribers', ()))
+        for subscription in subscribers:
+            for ticket_doc in added:
+                subscription.put(ticket_doc)
+
+_feed_hub = _OwnerFeedHub()
+
+def _feed_backlog(owner_id, cursor_time):
+    return list(db.collection('tickets').where(
+        filter=firestore.FieldFilter('ownerId', '==', owner_id)
+    ).where(
+        filter=firestore.FieldFilter('recordedAt', '>', cursor_time)
+    ).order_by('recordedAt').limit(FEED_PAGE_SIZE).stream())
+
+def _drain_feed(subscription, cursor_time, timeout):
+    """Wait up to ``timeout`` seconds for tickets newer than ``cursor_time``."""
+    deadline = time.monotonic() + timeout
+    ticket_docs = []
+    while not ticket_docs:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            ticket_docs.append(subscription.get(timeout=remaining))
+        except queue.Empty:
+            break
+        while True:
+            try:
+                ticket_docs.append(subscription.get_nowait())
+            except queue.Empty:
+                break
+        ticket_docs = [
+            ticket_doc for ticket_doc in ticket_docs
+            if isinstance(ticket_doc.get('recordedAt'), datetime) and ticket_doc.get('recordedAt') > cursor_time
+        ]
+    return ticket_docs
+
+def _feed_payload(ticket_docs):
+    """(cursor, ticket) pairs in recordedAt order, shaped like the owner listings."""
+    unique = {ticket_doc.id: ticket_doc for ticket_doc in ticket_docs}
+    ordered = sorted(unique.values(), key=lambda ticket_doc: ticket_doc.get('recordedAt'))
+    tickets = _normalize_tickets(list(_ticket_dicts(ordered)), _now_micros())
+    entries = []
+    for ticket_doc, ticket in zip(ordered, tickets):
+        entries.append((_feed_cursor(ticket_doc.get('recordedAt')), ticket))
+    _attach_user_info([ticket for _, ticket in entries])
+    return entries
+
+@app.route("/owner-ticket-feed/<owner_id>", methods=['GET'])
+def get_owner_ticket_feed(owner_id):
+    """Long-poll for tickets created after ?after=<cursor>"""
+    unsupported = _firestore_only()
+    if unsupported:
+        return unsupported
+    if not db: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    after = request.args.get('after')
+    try:
+        cursor_time = _feed_cursor_time(after) if after else datetime.now(timezone.utc)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    
+    try:
+        wait = max(0.0, min(request.args.get('wait', 0, type=float), FEED_MAX_WAIT))
         
-        # Sort by timestamp (newest first)
+        # Subscribe before querying so nothing slips in between
+        subscription = _feed_hub.subscribe(owner_id) if wait else None
         try:
-            filtered_tickets.sort(key=lambda x: x.get('timestamp', {}).get('seconds', 0), reverse=True)
-        except Exception as e:
-            print(f"⚠️ Error sorting tickets: {e}")
+            ticket_docs = _feed_backlog(owner_id, cursor_time)
+            if not ticket_docs and subscription is not None:
+                ticket_docs = _drain_feed(subscription, cursor_time, wait)
+        finally:
+            if subscription is not None:
+                _feed_hub.unsubscribe(owner_id, subscription)
         
-        return jsonify(filtered_tickets)
+        entries = _feed_payload(ticket_docs)
+        
+        return jsonify({
+            "tickets": [ticket for _, ticket in entries],
+            "cursor": entries[-1][0] if entries else (after or _feed_cursor(cursor_time))
+        })
         
     except Exception as e:
-        print(f"❌ Get tickets by status error: {e}")
-        return jsonify([])
+        _log.exception("❌ Owner ticket feed error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/owner-ticket-stream/<owner_id>", methods=['GET'])
+def stream_owner_tickets(owner_id):
+    """Server-Sent Events stream of tickets created after ?after=<cursor>"""
+    unsupported = _firestore_only()
+    if unsupported:
+        return unsupported
+    if not db: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    after = request.args.get('after') or request.headers.get('Last-Event-ID')
+    try:
+        cursor_time = _feed_cursor_time(after) if after else datetime.now(timezone.utc)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    
+    def send(ticket_docs):
+        nonlocal cursor_time
+        entries = _feed_payload(ticket_docs)
+        for cursor, ticket in entries:
+            yield f"event: ticket\nid: {cursor}\ndata: {app.json.dumps(ticket)}\n\n"
+        cursor_time = _feed_cursor_time(entries[-1][0])
+    
+    def events():
+        subscription = _feed_hub.subscribe(owner_id)
+        try:
+            yield "retry: 5000\n\n"
+            # Catch up a page at a time before switching to live changes
+            while True:
+                ticket_docs = _feed_backlog(owner_id, cursor_time)
+                if ticket_docs:
+                    yield from send(ticket_docs)
+                if len(ticket_docs) < FEED_PAGE_SIZE:
+                    break
+            while True:
+                ticket_docs = _drain_feed(subscription, cursor_time, FEED_HEARTBEAT_SECONDS)
+                if ticket_docs:
+                    yield from send(ticket_docs)
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            _feed_hub.unsubscribe(owner_id, subscription)
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 # --- UPDATE OWNER SETTINGS ---
 @app.route("/update-owner-settings", methods=['POST'])
 def update_owner_settings():
-    if not db: 
+    if not store: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
         data = request.get_json()
         owner_id = data['ownerId']
         
-        print(f"🔧 Updating settings for owner: {owner_id}")
+        _log.debug("🔧 Updating settings for owner: %s", owner_id)
         
         updates = {}
         if 'fixedFare' in data:
             updates['fixedFare'] = int(data['fixedFare'])
-            print(f"📊 New fare: ₹{data['fixedFare']}")
+            _log.debug("📊 New fare: ₹%s", data['fixedFare'])
         if 'ticketValidityMinutes' in data:
             updates['ticketValidityMinutes'] = int(data['ticketValidityMinutes'])
-            print(f"⏰ New validity: {data['ticketValidityMinutes']} minutes")
+            _log.debug("⏰ New validity: %s minutes", data['ticketValidityMinutes'])
         
         if updates:
-            owner_ref = db.collection('owners').document(owner_id)
-            owner_doc = owner_ref.get()
+            owner = store.update_owner(owner_id, updates)
             
-            if not owner_doc.exists:
-                print(f"❌ Owner not found: {owner_id}")
+            if owner is None:
+                _log.info("❌ Owner not found: %s", owner_id)
                 return jsonify({"error": "Owner not found"}), 404
             
-            owner_ref.update(updates)
-            print(f"✅ Settings updated successfully")
+            vehicle_id = owner.get('vehicleId')
+            if vehicle_id:
+                _vehicle_cache.pop(vehicle_id)
+            _log.info("✅ Settings updated successfully")
             
             return jsonify({
                 "success": True,
@@ -754,54 +3392,221 @@ def update_owner_settings():
             return jsonify({"error": "No valid fields to update"}), 400
             
     except Exception as e:
-        print(f"❌ Update owner settings error: {e}")
+        _log.exception("❌ Update owner settings error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- SYNC OWNER EARNINGS ---
 @app.route("/sync-owner-earnings/<owner_id>", methods=['POST'])
 def sync_owner_earnings(owner_id):
-    """Sync owner's totalEarnings with actual ticket revenue"""
+    """Reconcile owner's totalEarnings with the ownerStats aggregates"""
+    unsupported = _firestore_only()
+    if unsupported:
+        return unsupported
     if not db: 
         return jsonify({"error": "Database not initialized"}), 500
     
     try:
-        print(f"🔄 Syncing earnings for owner: {owner_id}")
+        _log.debug("🔄 Syncing earnings for owner: %s", owner_id)
         
-        # Calculate actual total from all tickets
-        tickets_collection = db.collection('tickets')
-        all_tickets = tickets_collection.stream()
+        window_days = max(1, min(request.args.get('days', SYNC_WINDOW_DAYS, type=int), 31))
+        current_totals = _read_owner_totals(owner_id)
         
-        total_revenue = 0
-        ticket_count = 0
+        if current_totals is not None and not request.args.get('full'):
+            # Aggregates are maintained per payment; only re-check recent days
+            totals, corrections = _verify_owner_stats(owner_id, current_totals, window_days)
+            if corrections:
+                _log.warning("⚠️ Repaired %s day bucket(s) for owner %s", len(corrections), owner_id)
+        else:
+            # No aggregates yet (owner predates them) or a full rebuild was requested
+            totals = _rebuild_owner_stats(owner_id)
+            corrections = []
+            window_days = None
         
-        for ticket_doc in all_tickets:
-            ticket_data = ticket_doc.to_dict()
-            if ticket_data.get('ownerId') == owner_id:
-                total_revenue += ticket_data.get('farePaid', 0)
-                ticket_count += 1
+        total_revenue = totals['totalRevenue']
+        ticket_count = totals['ticketCount']
         
-        print(f"💰 Calculated total revenue: ₹{total_revenue} from {ticket_count} tickets")
+        _log.debug("💰 Total revenue: ₹%s from %s tickets", total_revenue, ticket_count)
         
         # Update owner's totalEarnings
         owner_ref = db.collection('owners').document(owner_id)
         owner_ref.update({'totalEarnings': total_revenue})
+        _roll_up_owner(owner_id)
         
-        print(f"✅ Owner earnings synced: ₹{total_revenue}")
+        _log.info("✅ Owner earnings synced: ₹%s", total_revenue)
         
         return jsonify({
             "success": True,
             "totalRevenue": total_revenue,
-            "ticketCount": ticket_count
+            "ticketCount": ticket_count,
+            "verifiedDays": window_days,
+            "corrections": corrections
         })
         
     except Exception as e:
-        print(f"❌ Sync earnings error: {e}")
+        _log.exception("❌ Sync earnings error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # --- TICKET VALIDITY CHECK ---
+MAX_BATCH_TICKET_CHECKS = 200
+_TICKET_VALIDITY_FIELDS = ['status', 'expiresAt', 'farePaid', 'vehicleId']
+
+def _cache_ticket(ticket_id, ticket_data, now_micros):
+    """Keep a ticket's validity fields until its expiresAt, capped by the cache TTL."""
+    fields = {field: ticket_data.get(field) for field in _TICKET_VALIDITY_FIELDS}
+    expires_at = fields['expiresAt']
+    ttl = None
+    if isinstance(expires_at, datetime):
+        remaining = (_epoch_micros(expires_at) - now_micros) / 1e6
+        if remaining > 0:
+            ttl = min(_ticket_cache.ttl, remaining)
+    _ticket_cache.set(ticket_id, fields, ttl)
+    return fields
+
+def _validity_body(ticket_id, ticket_data, now_micros):
+    ticket = _normalize_tickets([dict(ticket_data)], now_micros, defaults={})[0]
+    return {
+        "ticketId": ticket_id,
+        "isValid": ticket['isValid'],
+        "status": ticket.get('status'),
+        "expiresAt": ticket.get('expiresAt'),
+        "farePaid": ticket.get('farePaid'),
+        "vehicleId": ticket.get('vehicleId')
+    }
+
+def _batch_validity_request(data):
+    """``(ticket_ids, vehicle_id)`` from a batch check body; raises ValueError if malformed."""
+    ticket_ids = data.get('ticketIds')
+    if not isinstance(ticket_ids, list) or not ticket_ids:
+        raise ValueError("ticketIds must be a non-empty list")
+    if len(ticket_ids) > MAX_BATCH_TICKET_CHECKS:
+        raise ValueError(f"At most {MAX_BATCH_TICKET_CHECKS} tickets per batch")
+    if not all(isinstance(ticket_id, str) and ticket_id and '/' not in ticket_id for ticket_id in ticket_ids):
+        raise ValueError("ticketIds must be ticket ID strings")
+    return ticket_ids, data.get('vehicleId')
+
+def _cached_validity(ticket_ids):
+    """``(tickets, missing)``: cached validity fields by ticketId, and the ticketIds to read."""
+    tickets = {}
+    missing = []
+    for ticket_id in dict.fromkeys(ticket_ids):
+        cached = _ticket_cache.get(ticket_id)
+        if cached is None:
+            missing.append(ticket_id)
+        else:
+            tickets[ticket_id] = cached
+    return tickets, missing
+
+def _batch_validity_body(ticket_ids, tickets, vehicle_id, now_micros):
+    # Cached entries stay raw; the verdicts come from normalized copies
+    found = list(tickets)
+    normalized = _normalize_tickets([dict(tickets[ticket_id]) for ticket_id in found], now_micros, defaults={})
+    tickets = dict(zip(found, normalized))
+    
+    results = {}
+    for ticket_id in ticket_ids:
+        ticket = tickets.get(ticket_id)
+        if ticket is None:
+            results[ticket_id] = {"isValid": False, "status": "not-found"}
+            continue
+        
+        is_valid, status = ticket['isValid'], ticket.get('status')
+        # A checker on a vehicle can pass its ID to reject tickets for other vehicles
+        if vehicle_id and ticket.get('vehicleId') != vehicle_id:
+            is_valid, status = False, 'wrong-vehicle'
+        
+        results[ticket_id] = {
+            "isValid": is_valid,
+            "status": status,
+            "expiresAt": ticket.get('expiresAt')
+        }
+    
+    valid_count = sum(1 for verdict in results.values() if verdict['isValid'])
+    
+    return {
+        "checkedAt": (_EPOCH + timedelta(microseconds=now_micros)).isoformat(),
+        "summary": {"valid": valid_count, "invalid": len(results) - valid_count},
+        "results": results
+    }
+
 @app.route("/check-ticket-validity/<ticket_id>", methods=['GET'])
 def check_ticket_validity(ticket_id):
     """Check if a ticket is still valid"""
+    if not store: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        now = _now_micros()
+        ticket_data = _ticket_cache.get(ticket_id)
+        
+        if ticket_data is None:
+            ticket_data = store.get_tickets([ticket_id], _TICKET_VALIDITY_FIELDS).get(ticket_id)
+            
+            if ticket_data is None:
+                return jsonify({"error": "Ticket not found"}), 404
+            
+            ticket_data = _cache_ticket(ticket_id, ticket_data, now)
+        
+        return jsonify(_validity_body(ticket_id, ticket_data, now))
+        
+    except Exception as e:
+        _log.exception("❌ Check ticket validity error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/check-ticket-validity/batch", methods=['POST'])
+def check_ticket_validity_batch():
+    """Check many tickets against one timestamp with a single batched read"""
+    if not store: 
+        return jsonify({"error": "Database not initialized"}), 500
+    
+    try:
+        try:
+            ticket_ids, vehicle_id = _batch_validity_request(request.get_json())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        now = _now_micros()
+        tickets, missing = _cached_validity(ticket_ids)
+        if missing:
+            for ticket_id, ticket_data in store.get_tickets(missing, _TICKET_VALIDITY_FIELDS).items():
+                tickets[ticket_id] = _cache_ticket(ticket_id, ticket_data, now)
+        
+        return jsonify(_batch_validity_body(ticket_ids, tickets, vehicle_id, now))
+        
+    except Exception as e:
+        _log.exception("❌ Batch ticket validity error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/verify-ticket-token/<token>", methods=['GET'])
+def verify_ticket(token):
+    """Check a signed ticket token without reading the ticket"""
+    if _ticket_token_key is None:
+        return jsonify({"error": "Ticket tokens are not enabled"}), 503
+    
+    try:
+        claims = verify_ticket_token(token)
+        if claims is None:
+            return jsonify({"error": "Invalid ticket token"}), 400
+        
+        # A checker on a vehicle can pass its ID to reject tickets for other vehicles
+        vehicle_id = request.args.get('vehicleId')
+        if vehicle_id and vehicle_id != claims['vehicleId']:
+            claims.update(isValid=False, status='wrong-vehicle')
+        
+        return jsonify(claims)
+        
+    except Exception as e:
+        _log.exception("❌ Verify ticket token error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/revoke-ticket/<ticket_id>", methods=['POST'])
+def revoke_ticket(ticket_id):
+    """Revoke a ticket so its token stops verifying (admin key required)"""
+    denied = _admin_error()
+    if denied:
+        return denied
+    unsupported = _firestore_only()
+    if unsupported:
+        return unsupported
     if not db: 
         return jsonify({"error": "Database not initialized"}), 500
     
@@ -813,30 +3618,34 @@ def check_ticket_validity(ticket_id):
             return jsonify({"error": "Ticket not found"}), 404
         
         ticket_data = ticket_doc.to_dict()
-        current_time = datetime.now()
-        expires_at = ticket_data.get('expiresAt')
+        owner_id = ticket_data.get('ownerId')
         
-        if isinstance(expires_at, datetime):
-            is_valid = current_time < expires_at and ticket_data.get('status') == 'valid'
-        else:
-            is_valid = ticket_data.get('status') == 'valid'
+        batch = db.batch()
+        batch.update(ticket_ref, {
+            'status': 'revoked',
+            'revokedAt': firestore_client.SERVER_TIMESTAMP
+        })
+        batch.set(db.collection('revokedTickets').document(ticket_id), {
+            'ticketId': ticket_id,
+            'ownerId': owner_id,
+            'expiresAt': ticket_data['expiresAt'],
+            'revokedAt': firestore_client.SERVER_TIMESTAMP
+        })
+        batch.commit()
+        _revoked_tickets.add(ticket_id, ticket_data['expiresAt'].timestamp())
+        _ticket_cache.pop(ticket_id)
         
-        # Convert datetime to ISO format for JSON serialization
-        expires_at_iso = expires_at.isoformat() if isinstance(expires_at, datetime) else None
+        _log.info("🚫 Ticket %s of owner %s revoked", ticket_id, owner_id)
         
-        return jsonify({
-            "ticketId": ticket_id,
-            "isValid": is_valid,
-            "status": ticket_data.get('status'),
-            "expiresAt": expires_at_iso,
-            "farePaid": ticket_data.get('farePaid'),
-            "vehicleId": ticket_data.get('vehicleId')
-        })
+        return jsonify({"success": True, "ticketId": ticket_id, "status": "revoked"})
         
     except Exception as e:
-        print(f"❌ Check ticket validity error: {e}")
+        _log.exception("❌ Revoke ticket error: %s", e)
         return jsonify({"error": str(e)}), 500
 
+_startup_report["moduleLoadMs"] = _elapsed_ms(_MODULE_STARTED)
+_log.info("⏱️ main.py loaded in %s ms", _startup_report['moduleLoadMs'])
+
 # --- MAIN EXECUTION ---
 if __name__ == "__main__":
     app.run(debug=True)
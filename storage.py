@@ -0,0 +1,1093 @@
+# storage.py - storage backends for users, owners, tickets and owner totals
+
+"""Storage backends behind the core endpoints.
+
+``Storage`` is the interface main.py uses for users, owners and their
+vehicles, tickets, wallet payments and owner aggregates.
+``firestore_storage.FirestoreStorage`` implements it on Firestore (the
+default); ``SQLiteStorage`` keeps the same data in a single
+local SQLite database in WAL mode, for self-hosted nodes and load tests that
+should not depend on a Firebase project.
+
+Tickets older than the archive age live in compacted per-owner, per-month
+archive parts (see ``add_to_archive``) with the same layout on every backend.
+Wallet changes are recorded as ledger entries (see ``ledger_entry``).
+
+Documents are plain dicts with the same field names on every backend.
+Datetimes are timezone-aware UTC, and ``SERVER_TIMESTAMP`` in a write means
+"the time the backend commits it".
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+
+SERVER_TIMESTAMP = object()
+
+class PaymentError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+class IdempotentReplay(Exception):
+    def __init__(self, record):
+        super().__init__("Idempotent replay")
+        self.record = record
+
+class VehicleTaken(Exception):
+    def __init__(self, vehicle_id):
+        super().__init__(f"Vehicle {vehicle_id} is already registered to another owner")
+        self.vehicle_id = vehicle_id
+
+class UnknownCursor(ValueError):
+    """A page cursor that names no ticket, or a malformed archive cursor."""
+    def __init__(self, cursor):
+        super().__init__(f"Unknown cursor: {cursor}")
+        self.cursor = cursor
+
+def idempotency_id(scope, key):
+    """Document/row id for an Idempotency-Key within its scope."""
+    return hashlib.sha256(f"{scope}:{key}".encode('utf-8')).hexdigest()
+
+def live_idempotency_record(record):
+    """``record`` unless it is missing or past its expiresAt."""
+    if record is None:
+        return None
+    expires_at = record.get('expiresAt')
+    if isinstance(expires_at, datetime) and expires_at <= datetime.now(timezone.utc):
+        return None
+    return record
+
+class Storage:
+    """Operations the core endpoints need from a datastore."""
+
+    name = None
+
+    # Users
+    def create_user(self, user_id, data):
+        raise NotImplementedError
+
+    def create_users(self, users):
+        """Create many users at once; ``users`` maps user_id to its document.
+
+        A user created with a walletBalance also gets its opening ledger entry.
+        """
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        """The user's document as a dict, or None."""
+        raise NotImplementedError
+
+    def get_users(self, user_ids, fields=None):
+        """``{user_id: dict or None}`` for every id, in one round trip where possible."""
+        raise NotImplementedError
+
+    def update_user(self, user_id, updates):
+        raise NotImplementedError
+
+    # Owners and vehicles
+    def create_owner(self, owner_id, data, vehicle):
+        """Write the owner, its vehicle index entry and zeroed totals together.
+
+        Raises VehicleTaken, writing nothing, if another owner holds the vehicle.
+        """
+        raise NotImplementedError
+
+    def create_owners(self, owners):
+        """``create_owner`` for many ``(owner_id, data, vehicle)`` triples, batched.
+
+        A batch that includes a vehicle held by another owner is not written
+        and raises VehicleTaken; earlier batches stay written.
+        """
+        raise NotImplementedError
+
+    def get_owner(self, owner_id):
+        raise NotImplementedError
+
+    def get_owners(self, owner_ids, fields=None):
+        """``{owner_id: dict or None}`` for every id, in one round trip where possible."""
+        raise NotImplementedError
+
+    def update_owner(self, owner_id, updates):
+        """Apply ``updates`` to the owner and its vehicle entry; the updated owner, or None."""
+        raise NotImplementedError
+
+    def get_vehicle(self, vehicle_id):
+        """``{ownerId, fixedFare, ticketValidityMinutes}`` for a vehicle, or None."""
+        raise NotImplementedError
+
+    def get_vehicles(self, vehicle_ids):
+        """``{vehicle_id: get_vehicle(vehicle_id)}`` for every id, in one round trip where possible."""
+        raise NotImplementedError
+
+    # Tickets
+    def get_tickets(self, ticket_ids, fields=None):
+        """``{ticket_id: dict}`` for the tickets that exist."""
+        raise NotImplementedError
+
+    def iter_tickets(self, field, value, limit=None, after=None, fields=None, statuses=None):
+        """Tickets whose ``field`` (userId or ownerId) equals ``value``, newest first.
+
+        ``after`` is the ticketId the previous page ended on; UnknownCursor is
+        raised, before any ticket is read, if it names no ticket. Each ticket
+        includes ``ticketId``; ``fields`` may restrict the rest. ``statuses``
+        keeps only tickets whose stored status is one of those values.
+        """
+        raise NotImplementedError
+
+    def expire_tickets(self, cutoff, limit):
+        """Mark up to ``limit`` 'valid' tickets with expiresAt <= ``cutoff`` as 'expired'.
+
+        Tickets are taken oldest expiry first. Returns ``(count, last_expires_at)``.
+        """
+        raise NotImplementedError
+
+    def archive_tickets(self, cutoff, limit):
+        """Move up to ``limit`` of the oldest tickets before ``cutoff`` into archive parts.
+
+        Returns ``(count, newest timestamp moved)``.
+        """
+        raise NotImplementedError
+
+    def iter_archived_tickets(self, field, value, after=None, fields=None):
+        """Archived tickets whose ``field`` (userId or ownerId) equals ``value``, newest first.
+
+        ``after`` is a ``(timestamp, ticketId)`` position from
+        :func:`archive_position`; only tickets older than it are returned and
+        parts of later months are not read.
+        """
+        raise NotImplementedError
+
+    # Background job checkpoints
+    def get_checkpoint(self, name):
+        raise NotImplementedError
+
+    def save_checkpoint(self, name, data):
+        raise NotImplementedError
+
+    # Wallet payments
+    def pay(self, user_id, ticket, when, idempotency=None):
+        """Debit the fare, store the ticket and count it in the owner's totals atomically.
+
+        The debit is recorded as a 'payment' ledger entry in the same write,
+        after an 'opening' entry if this is the user's first ledger write.
+        ``idempotency`` is an Idempotency-Key record stored in the same
+        transaction with ``newBalance`` filled in. Returns the new balance;
+        raises PaymentError or IdempotentReplay.
+        """
+        raise NotImplementedError
+
+    def add_funds(self, user_id, amount, idempotency=None):
+        """Credit a wallet and append a 'top-up' ledger entry atomically.
+
+        Like ``pay``, the user's first ledger write opens the ledger first.
+
+        Returns ``(old_balance, new_balance)``.
+        """
+        raise NotImplementedError
+
+    def get_idempotency_record(self, scope, key):
+        raise NotImplementedError
+
+    def pay_batch(self, user_groups):
+        """Apply queued payments; ``user_groups`` is ``[(user_id, items)]``, items in boarding order.
+
+        An item has the request ``index``, ``idempotencyKey``, boarding time
+        ``when``, ``validityMinutes`` and the ``ticket`` to create under its
+        deterministic ticketId. A ticket that already exists is a replay and
+        is not charged again. Returns ``{index: batch_result(...)}``.
+        """
+        raise NotImplementedError
+
+    # Wallet ledger
+    def ensure_wallet(self, user_id):
+        """Give a user without a walletBalance a zero balance; an existing balance is untouched."""
+        raise NotImplementedError
+
+    def iter_ledger(self, user_id, limit=None, before_seq=None):
+        """The user's ledger entries, newest first, resuming below ``seq`` ``before_seq``.
+
+        Page cursors are seqs rather than entryIds so they survive compaction
+        deleting the entry a page ended on.
+        """
+        raise NotImplementedError
+
+    def compact_ledger(self, cutoff, limit):
+        """Fold up to ``limit`` of the oldest entries before ``cutoff`` into monthly snapshots.
+
+        Returns ``(count, createdAt of the newest entry folded)``.
+        """
+        raise NotImplementedError
+
+    # Owner aggregates
+    def owner_totals(self, owner_id):
+        """``{totalRevenue, ticketCount}`` for an owner, or None if nothing is recorded."""
+        raise NotImplementedError
+
+# --- ARCHIVE TIER ---
+# Old tickets move out of the hot tickets collection into archive parts: one
+# per owner and calendar month (UTC), split into further parts once a part
+# holds ARCHIVE_PART_SIZE tickets. A part stores its tickets column-wise,
+# newest first, with the newest timestamp and the passengers it contains so
+# history reads can find the parts for an owner or a user.
+ARCHIVE_PART_SIZE = 1500
+
+def archive_month(when):
+    return when.astimezone(timezone.utc).strftime('%Y-%m')
+
+def archive_part_id(owner_id, month, part):
+    return f"{owner_id}_{month}_{part:03d}"
+
+def archive_month_end(when):
+    """Start of the UTC month after ``when``'s: no part holds a ticket from before it and newer."""
+    when = when.astimezone(timezone.utc)
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+def _newest_key(ticket):
+    return (ticket['timestamp'], ticket['ticketId'])
+
+# Hot-tier cursors are plain ticketIds. A page that ends in the archive gets
+# ``archive:<timestamp micros>:<ticketId>`` instead, so the next page goes
+# straight to the archive parts of that month and earlier.
+ARCHIVE_CURSOR_PREFIX = 'archive:'
+
+def archive_cursor(ticket):
+    return f"{ARCHIVE_CURSOR_PREFIX}{_micros(ticket['timestamp'])}:{ticket['ticketId']}"
+
+def archive_position(cursor):
+    """``(timestamp, ticketId)`` for an archive cursor, None for any other cursor.
+
+    Raises UnknownCursor if the cursor has the archive prefix but is malformed.
+    """
+    if not cursor or not cursor.startswith(ARCHIVE_CURSOR_PREFIX):
+        return None
+    micros, _, ticket_id = cursor[len(ARCHIVE_CURSOR_PREFIX):].partition(':')
+    if not micros.isdigit() or not ticket_id:
+        raise UnknownCursor(cursor)
+    return _from_micros(int(micros)), ticket_id
+
+def pack_archive_part(owner_id, month, part, tickets):
+    tickets = sorted(tickets, key=_newest_key, reverse=True)
+    names = sorted({name for ticket in tickets for name in ticket} - {'ownerId'})
+    return {
+        'ownerId': owner_id,
+        'month': month,
+        'part': part,
+        'count': len(tickets),
+        'newest': tickets[0]['timestamp'],
+        'oldest': tickets[-1]['timestamp'],
+        'userIds': sorted({ticket['userId'] for ticket in tickets if ticket.get('userId')}),
+        'columns': {name: [ticket.get(name) for ticket in tickets] for name in names}
+    }
+
+def unpack_archive_part(part):
+    """The part's tickets as dicts, newest first."""
+    columns = part['columns']
+    tickets = []
+    for index in range(part['count']):
+        ticket = {name: values[index] for name, values in columns.items() if values[index] is not None}
+        ticket['ownerId'] = part['ownerId']
+        tickets.append(ticket)
+    return tickets
+
+def add_to_archive(owner_id, month, last_part, tickets, now):
+    """Parts to write after adding ``tickets`` to an owner-month whose highest part is ``last_part``.
+
+    'valid' tickets that have expired by ``now`` are archived as 'expired'.
+    """
+    number, pending = 0, []
+    if last_part is not None:
+        number, pending = last_part['part'], unpack_archive_part(last_part)
+    for ticket in tickets:
+        expires_at = ticket.get('expiresAt')
+        if ticket.get('status', 'valid') == 'valid' and isinstance(expires_at, datetime) and expires_at <= now:
+            ticket = {**ticket, 'status': 'expired'}
+        pending.append(ticket)
+    # Oldest first, so part numbers grow with time
+    pending.sort(key=_newest_key)
+    return [
+        pack_archive_part(owner_id, month, number + index, pending[start:start + ARCHIVE_PART_SIZE])
+        for index, start in enumerate(range(0, len(pending), ARCHIVE_PART_SIZE))
+    ]
+
+class _HeapEntry:
+    """Max-heap entry: the newest ticket sorts first."""
+
+    __slots__ = ('key', 'ticket', 'rest')
+
+    def __init__(self, ticket, rest):
+        self.key = _newest_key(ticket)
+        self.ticket = ticket
+        self.rest = rest
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+_ARCHIVE_KEYS = ('ticketId', 'timestamp')
+
+def merge_archive_parts(parts, keep=None, after=None, fields=None):
+    """Tickets from ``parts`` (ordered by ``newest``, descending), newest first.
+
+    Parts can overlap in time, so they are merged; a part is only unpacked
+    once the merge reaches its newest ticket. ``keep`` filters tickets,
+    ``after`` is a ``(timestamp, ticketId)`` position to resume after (parts
+    that end before it are skipped unpacked) and ``fields`` restricts the keys
+    returned; ticketId and timestamp are always kept for the page cursor.
+    """
+    parts = iter(parts)
+    pending = next(parts, None)
+    heap = []
+
+    def push(rest):
+        for ticket in rest:
+            heapq.heappush(heap, _HeapEntry(ticket, rest))
+            return
+
+    while heap or pending is not None:
+        while pending is not None and (not heap or pending['newest'] >= heap[0].key[0]):
+            if after is None or pending['oldest'] <= after[0]:
+                push(iter([ticket for ticket in unpack_archive_part(pending) if keep is None or keep(ticket)]))
+            pending = next(parts, None)
+        if not heap:
+            continue
+        entry = heapq.heappop(heap)
+        push(entry.rest)
+        if after is not None and entry.key >= after:
+            continue
+        ticket = entry.ticket
+        if fields is not None:
+            ticket = {key: value for key, value in ticket.items() if key in fields or key in _ARCHIVE_KEYS}
+        yield ticket
+
+# --- WALLET LEDGER ---
+# Every wallet change appends an entry in the same atomic write that changes
+# walletBalance: {entryId, userId, type, seq, amount (signed), balanceAfter,
+# createdAt}, plus the ticketId or idempotencyKey behind it. ``seq`` numbers a
+# user's entries 1, 2, 3... in the order they were applied, so history is
+# ordered by it and a gap shows a missing entry. walletBalance remains the
+# balance of record, read in O(1). Compaction folds entries
+# older than the retention age into one 'snapshot' entry per user and month
+# (UTC). A snapshot keeps the entries' count, credits, debits and the
+# balance after the last of them, so a ledger stays bounded however long an
+# account lives.
+LEDGER_ENTRY_TYPES = ('opening', 'top-up', 'payment')
+
+def ledger_entry(user_id, entry_type, seq, amount, balance_after, when, entry_id=None, **refs):
+    """A ledger entry; ``refs`` such as ticketId or idempotencyKey are kept when set."""
+    entry = {
+        'entryId': entry_id or f"{entry_type}-{uuid.uuid4().hex}",
+        'userId': user_id,
+        'type': entry_type,
+        'seq': seq,
+        'amount': amount,
+        'balanceAfter': balance_after,
+        'createdAt': when
+    }
+    entry.update((key, value) for key, value in refs.items() if value is not None)
+    return entry
+
+def payment_entry_id(ticket_id):
+    return f"payment-{ticket_id}"
+
+def batch_result(item, status, ticket=None, error=None, new_balance=None):
+    """One /pay/batch result: 'failed' with ``error``, or 'duplicate'/'created' for ``ticket``."""
+    result = {"index": item['index'], "idempotencyKey": item['idempotencyKey'], "status": status}
+    if status == 'failed':
+        result['error'] = error
+        return result
+    result.update(ticketId=item['ticket']['ticketId'], farePaid=ticket.get('farePaid'), ticketToken=ticket.get('ticketToken'))
+    if status == 'created':
+        result.update(
+            expiresAt=ticket['expiresAt'].isoformat(),
+            validityMinutes=item['validityMinutes'],
+            newBalance=new_balance
+        )
+    return result
+
+def opening_entry(user_id, data, when):
+    """The opening-balance entry for a new user document, or None without a walletBalance."""
+    if 'walletBalance' not in data:
+        return None
+    balance = data['walletBalance']
+    return ledger_entry(user_id, 'opening', 1, balance, balance, when, entry_id='opening')
+
+def ledger_start(user_id, data, when):
+    """``(seq, opening)`` for a user document about to get a ledger entry.
+
+    ``seq`` is the last entry number used. A user without ``ledgerSeq`` has no
+    ledger yet (accounts created before it, or without a walletBalance);
+    ``opening`` is then the entry for the balance they already hold, to be
+    written in the same transaction so the ledger reconciles with
+    walletBalance. Otherwise it is None.
+    """
+    if 'ledgerSeq' in data:
+        return data['ledgerSeq'], None
+    opening = opening_entry(user_id, {'walletBalance': data.get('walletBalance', 0)}, when)
+    return opening['seq'], opening
+
+def ledger_snapshot_id(month):
+    return f"snapshot-{month}"
+
+def group_ledger_entries(entries):
+    """``{(user_id, month): [entry, ...]}`` for entries about to be folded."""
+    groups = {}
+    for entry in entries:
+        groups.setdefault((entry['userId'], archive_month(entry['createdAt'])), []).append(entry)
+    return groups
+
+def fold_ledger_entries(snapshot, entries):
+    """``snapshot`` (a new one if None) with one user-month's ``entries`` folded in."""
+    entries = sorted(entries, key=lambda entry: entry['seq'])
+    last = entries[-1]
+    if snapshot is None:
+        month = archive_month(last['createdAt'])
+        snapshot = {
+            'entryId': ledger_snapshot_id(month),
+            'userId': last['userId'],
+            'type': 'snapshot',
+            'seq': None,
+            'month': month,
+            'amount': 0,
+            'credits': 0,
+            'debits': 0,
+            'entries': 0,
+            'balanceAfter': None,
+            'createdAt': None
+        }
+    for entry in entries:
+        snapshot['amount'] += entry['amount']
+        if entry['amount'] >= 0:
+            snapshot['credits'] += entry['amount']
+        else:
+            snapshot['debits'] -= entry['amount']
+        snapshot['entries'] += 1
+    # The snapshot takes the place of the month's last folded entry
+    if snapshot['seq'] is None or last['seq'] > snapshot['seq']:
+        snapshot['seq'] = last['seq']
+        snapshot['createdAt'] = last['createdAt']
+        snapshot['balanceAfter'] = last['balanceAfter']
+    return snapshot
+
+# --- SQLITE ---
+_TIME_KEY = '$time'
+
+def _encode(value):
+    """JSON-ready copy of a document; datetimes become {"$time": epoch micros}."""
+    if isinstance(value, datetime):
+        return {_TIME_KEY: _micros(value)}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+def _decode_hook(obj):
+    if len(obj) == 1 and _TIME_KEY in obj:
+        return _from_micros(obj[_TIME_KEY])
+    return obj
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _micros(when):
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return (when - _EPOCH) // timedelta(microseconds=1)
+
+def _from_micros(micros):
+    return _EPOCH + timedelta(microseconds=micros)
+
+_MAX_MICROS = 2 ** 63 - 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    wallet_balance NUMERIC NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS owners (
+    owner_id TEXT PRIMARY KEY,
+    vehicle_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS owners_vehicle ON owners (vehicle_id);
+CREATE TABLE IF NOT EXISTS vehicles (
+    vehicle_id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    fixed_fare NUMERIC NOT NULL,
+    ticket_validity_minutes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    owner_id TEXT NOT NULL,
+    vehicle_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    expires_at INTEGER,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_user_time ON tickets (user_id, timestamp DESC, ticket_id DESC);
+CREATE INDEX IF NOT EXISTS tickets_owner_time ON tickets (owner_id, timestamp DESC, ticket_id DESC);
+CREATE INDEX IF NOT EXISTS tickets_vehicle_time ON tickets (vehicle_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS tickets_owner_status_expiry ON tickets (owner_id, status, expires_at);
+CREATE INDEX IF NOT EXISTS tickets_owner_status_time ON tickets (owner_id, status, timestamp DESC, ticket_id DESC);
+CREATE INDEX IF NOT EXISTS tickets_status_expiry ON tickets (status, expires_at);
+CREATE INDEX IF NOT EXISTS tickets_time ON tickets (timestamp);
+CREATE TABLE IF NOT EXISTS ticket_archive (
+    part_id TEXT PRIMARY KEY,
+    owner_id TEXT NOT NULL,
+    month TEXT NOT NULL,
+    part INTEGER NOT NULL,
+    newest INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ticket_archive_owner ON ticket_archive (owner_id, newest DESC);
+CREATE INDEX IF NOT EXISTS ticket_archive_month ON ticket_archive (owner_id, month, part);
+CREATE TABLE IF NOT EXISTS ticket_archive_users (
+    user_id TEXT NOT NULL,
+    part_id TEXT NOT NULL,
+    newest INTEGER NOT NULL,
+    PRIMARY KEY (user_id, part_id)
+);
+CREATE INDEX IF NOT EXISTS ticket_archive_users_newest ON ticket_archive_users (user_id, newest DESC);
+CREATE TABLE IF NOT EXISTS owner_stats (
+    owner_id TEXT PRIMARY KEY,
+    total_revenue NUMERIC NOT NULL DEFAULT 0,
+    ticket_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS wallet_ledger (
+    user_id TEXT NOT NULL,
+    entry_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, entry_id)
+);
+CREATE INDEX IF NOT EXISTS wallet_ledger_user_seq ON wallet_ledger (user_id, seq DESC);
+CREATE INDEX IF NOT EXISTS wallet_ledger_unfolded ON wallet_ledger (created_at) WHERE type != 'snapshot';
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key_id TEXT PRIMARY KEY,
+    expires_at INTEGER NOT NULL,
+    record TEXT NOT NULL
+);
+"""
+
+_TICKET_COLUMNS = {'userId': 'user_id', 'ownerId': 'owner_id'}
+
+class SQLiteStorage(Storage):
+    """Single-node storage in one SQLite database.
+
+    Each thread gets its own connection. The database runs in WAL mode so
+    readers never block the writer, and payments run in ``BEGIN IMMEDIATE``
+    transactions so concurrent debits on a wallet serialize instead of
+    racing. ``path=':memory:'`` gives a throwaway database in a temporary
+    directory, removed with the instance, that behaves like a file database.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        if path == ':memory:':
+            self._tempdir = tempfile.TemporaryDirectory(prefix='cholo-pay-')
+            path = os.path.join(self._tempdir.name, 'store.db')
+        self.path = path
+        self._local = threading.local()
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _dumps(data):
+        now = datetime.now(timezone.utc)
+        resolved = {key: now if value is SERVER_TIMESTAMP else value for key, value in data.items()}
+        return json.dumps(_encode(resolved), separators=(',', ':'))
+
+    @staticmethod
+    def _loads(text, fields=None):
+        data = json.loads(text, object_hook=_decode_hook)
+        if fields is not None:
+            data = {key: value for key, value in data.items() if key in fields}
+        return data
+
+    # Users
+    def create_user(self, user_id, data):
+        self.create_users({user_id: data})
+
+    def create_users(self, users):
+        now = datetime.now(timezone.utc)
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO users (user_id, wallet_balance, data) VALUES (?, ?, ?)",
+                [(user_id, data.get('walletBalance', 0), self._dumps(data)) for user_id, data in users.items()]
+            )
+            for user_id, data in users.items():
+                entry = opening_entry(user_id, data, now)
+                if entry is not None:
+                    self._put_ledger_entry(conn, entry)
+
+    def _user(self, conn, user_id):
+        row = conn.execute("SELECT wallet_balance, data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        user = self._loads(row[1])
+        user['walletBalance'] = row[0]
+        return user
+
+    def get_user(self, user_id):
+        return self._user(self._conn, user_id)
+
+    def get_users(self, user_ids, fields=None):
+        user_ids = list(user_ids)
+        found = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT user_id, wallet_balance, data FROM users WHERE user_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for user_id, balance, data in rows:
+                user = self._loads(data)
+                user['walletBalance'] = balance
+                if fields is not None:
+                    user = {key: value for key, value in user.items() if key in fields}
+                found[user_id] = user
+        return {user_id: found.get(user_id) for user_id in user_ids}
+
+    def update_user(self, user_id, updates):
+        with self._transaction() as conn:
+            user = self._user(conn, user_id)
+            if user is None:
+                raise KeyError(user_id)
+            user.update(updates)
+            conn.execute(
+                "UPDATE users SET wallet_balance = ?, data = ? WHERE user_id = ?",
+                (user.get('walletBalance', 0), self._dumps(user), user_id)
+            )
+
+    # Owners and vehicles
+    def _put_vehicle(self, conn, vehicle_id, vehicle):
+        conn.execute(
+            "INSERT OR REPLACE INTO vehicles (vehicle_id, owner_id, fixed_fare, ticket_validity_minutes) VALUES (?, ?, ?, ?)",
+            (vehicle_id, vehicle['ownerId'], vehicle['fixedFare'], vehicle['ticketValidityMinutes'])
+        )
+
+    def create_owner(self, owner_id, data, vehicle):
+        self.create_owners([(owner_id, data, vehicle)])
+
+    def create_owners(self, owners):
+        with self._transaction() as conn:
+            for owner_id, data, vehicle in owners:
+                row = conn.execute("SELECT owner_id FROM vehicles WHERE vehicle_id = ?", (data['vehicleId'],)).fetchone()
+                if row is not None and row[0] != owner_id:
+                    raise VehicleTaken(data['vehicleId'])
+                conn.execute(
+                    "INSERT OR REPLACE INTO owners (owner_id, vehicle_id, data) VALUES (?, ?, ?)",
+                    (owner_id, data.get('vehicleId'), self._dumps(data))
+                )
+                self._put_vehicle(conn, data['vehicleId'], vehicle)
+                conn.execute(
+                    "INSERT OR REPLACE INTO owner_stats (owner_id, total_revenue, ticket_count) VALUES (?, 0, 0)",
+                    (owner_id,)
+                )
+
+    def get_owner(self, owner_id):
+        row = self._conn.execute("SELECT data FROM owners WHERE owner_id = ?", (owner_id,)).fetchone()
+        return self._loads(row[0]) if row else None
+
+    def get_owners(self, owner_ids, fields=None):
+        owner_ids = list(owner_ids)
+        found = {}
+        for start in range(0, len(owner_ids), 500):
+            chunk = owner_ids[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT owner_id, data FROM owners WHERE owner_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for owner_id, data in rows:
+                found[owner_id] = self._loads(data, fields)
+        return {owner_id: found.get(owner_id) for owner_id in owner_ids}
+
+    def update_owner(self, owner_id, updates):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data FROM owners WHERE owner_id = ?", (owner_id,)).fetchone()
+            if row is None:
+                return None
+            owner = self._loads(row[0])
+            owner.update(updates)
+            conn.execute("UPDATE owners SET data = ? WHERE owner_id = ?", (self._dumps(owner), owner_id))
+            if owner.get('vehicleId'):
+                self._put_vehicle(conn, owner['vehicleId'], {
+                    'ownerId': owner_id,
+                    'fixedFare': int(owner.get('fixedFare', 10)),
+                    'ticketValidityMinutes': int(owner.get('ticketValidityMinutes', 30))
+                })
+            return owner
+
+    def get_vehicle(self, vehicle_id):
+        row = self._conn.execute(
+            "SELECT owner_id, fixed_fare, ticket_validity_minutes FROM vehicles WHERE vehicle_id = ?",
+            (vehicle_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'ownerId': row[0], 'fixedFare': row[1], 'ticketValidityMinutes': row[2]}
+
+    def get_vehicles(self, vehicle_ids):
+        vehicle_ids = list(vehicle_ids)
+        found = {}
+        for start in range(0, len(vehicle_ids), 500):
+            chunk = vehicle_ids[start:start + 500]
+            rows = self._conn.execute(
+                "SELECT vehicle_id, owner_id, fixed_fare, ticket_validity_minutes FROM vehicles "
+                f"WHERE vehicle_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for vehicle_id, owner_id, fixed_fare, validity in rows:
+                found[vehicle_id] = {'ownerId': owner_id, 'fixedFare': fixed_fare, 'ticketValidityMinutes': validity}
+        return {vehicle_id: found.get(vehicle_id) for vehicle_id in vehicle_ids}
+
+    # Tickets
+    def _ticket(self, ticket_id, data, fields):
+        ticket = self._loads(data, fields)
+        ticket.setdefault('ticketId', ticket_id)
+        return ticket
+
+    def get_tickets(self, ticket_ids, fields=None):
+        ticket_ids = list(ticket_ids)
+        tickets = {}
+        for start in range(0, len(ticket_ids), 500):
+            chunk = ticket_ids[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT ticket_id, data FROM tickets WHERE ticket_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for ticket_id, data in rows:
+                tickets[ticket_id] = self._ticket(ticket_id, data, fields)
+        return tickets
+
+    def iter_tickets(self, field, value, limit=None, after=None, fields=None, statuses=None):
+        column = _TICKET_COLUMNS[field]
+        sql = f"SELECT ticket_id, data FROM tickets WHERE {column} = ?"
+        params = [value]
+        if statuses:
+            sql += f" AND status IN ({','.join('?' * len(statuses))})"
+            params += statuses
+
+        if after:
+            cursor_row = self._conn.execute("SELECT timestamp FROM tickets WHERE ticket_id = ?", (after,)).fetchone()
+            if cursor_row is None:
+                raise UnknownCursor(after)
+            sql += " AND (timestamp < ? OR (timestamp = ? AND ticket_id < ?))"
+            params += [cursor_row[0], cursor_row[0], after]
+
+        sql += " ORDER BY timestamp DESC, ticket_id DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._iter_ticket_rows(sql, params, fields)
+
+    def _iter_ticket_rows(self, sql, params, fields):
+        # Run on first read, on the connection of the thread reading: the ASGI
+        # bridge pulls streamed bodies on other threads than the view ran on
+        cursor = self._conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(200)
+            if not rows:
+                return
+            for ticket_id, data in rows:
+                yield self._ticket(ticket_id, data, fields)
+
+    def expire_tickets(self, cutoff, limit):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT ticket_id, expires_at, data FROM tickets WHERE status = 'valid' AND expires_at <= ? "
+                "ORDER BY expires_at LIMIT ?",
+                (_micros(cutoff), limit)
+            ).fetchall()
+            updates = []
+            for ticket_id, _, data in rows:
+                ticket = json.loads(data)
+                ticket['status'] = 'expired'
+                updates.append((json.dumps(ticket, separators=(',', ':')), ticket_id))
+            conn.executemany("UPDATE tickets SET status = 'expired', data = ? WHERE ticket_id = ?", updates)
+        if not rows:
+            return 0, None
+        return len(rows), _from_micros(rows[-1][1])
+
+    def archive_tickets(self, cutoff, limit):
+        now = datetime.now(timezone.utc)
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT ticket_id, data FROM tickets WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                (_micros(cutoff), limit)
+            ).fetchall()
+            groups = {}
+            for ticket_id, data in rows:
+                ticket = self._ticket(ticket_id, data, None)
+                groups.setdefault((ticket['ownerId'], archive_month(ticket['timestamp'])), []).append(ticket)
+
+            for (owner_id, month), tickets in groups.items():
+                row = conn.execute(
+                    "SELECT data FROM ticket_archive WHERE owner_id = ? AND month = ? ORDER BY part DESC LIMIT 1",
+                    (owner_id, month)
+                ).fetchone()
+                for part in add_to_archive(owner_id, month, self._loads(row[0]) if row else None, tickets, now):
+                    part_id = archive_part_id(owner_id, month, part['part'])
+                    newest = _micros(part['newest'])
+                    conn.execute(
+                        "INSERT OR REPLACE INTO ticket_archive (part_id, owner_id, month, part, newest, data) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (part_id, owner_id, month, part['part'], newest, self._dumps(part))
+                    )
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO ticket_archive_users (user_id, part_id, newest) VALUES (?, ?, ?)",
+                        [(user_id, part_id, newest) for user_id in part['userIds']]
+                    )
+            conn.executemany("DELETE FROM tickets WHERE ticket_id = ?", [(row[0],) for row in rows])
+        if not rows:
+            return 0, None
+        return len(rows), max(ticket['timestamp'] for tickets in groups.values() for ticket in tickets)
+
+    def iter_archived_tickets(self, field, value, after=None, fields=None):
+        # Parts of later months than the cursor's hold nothing older than it
+        before = _micros(archive_month_end(after[0])) if after is not None else _MAX_MICROS
+        if field == 'ownerId':
+            rows = self._conn.execute(
+                "SELECT data FROM ticket_archive WHERE owner_id = ? AND newest < ? ORDER BY newest DESC",
+                (value, before)
+            )
+            keep = None
+        else:
+            rows = self._conn.execute(
+                "SELECT a.data FROM ticket_archive_users u JOIN ticket_archive a ON a.part_id = u.part_id "
+                "WHERE u.user_id = ? AND u.newest < ? ORDER BY u.newest DESC",
+                (value, before)
+            )
+            keep = lambda ticket: ticket.get('userId') == value
+        yield from merge_archive_parts((self._loads(data) for (data,) in rows), keep, after, fields)
+
+    # Background job checkpoints
+    def get_checkpoint(self, name):
+        row = self._conn.execute("SELECT data FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return self._loads(row[0]) if row else None
+
+    def save_checkpoint(self, name, data):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO checkpoints (name, data) VALUES (?, ?)", (name, self._dumps(data))
+        )
+
+    # Wallet payments
+    def _claim_idempotency(self, conn, record):
+        key_id = idempotency_id(record['scope'], record['key'])
+        row = conn.execute("SELECT record FROM idempotency_keys WHERE key_id = ?", (key_id,)).fetchone()
+        existing = live_idempotency_record(json.loads(row[0], object_hook=_decode_hook)) if row else None
+        if existing is not None:
+            raise IdempotentReplay(existing)
+        return key_id
+
+    def _store_idempotency(self, conn, key_id, record, new_balance):
+        record['response']['newBalance'] = new_balance
+        conn.execute(
+            "INSERT OR REPLACE INTO idempotency_keys (key_id, expires_at, record) VALUES (?, ?, ?)",
+            (key_id, _micros(record['expiresAt']), json.dumps(_encode(record), separators=(',', ':')))
+        )
+
+    def pay(self, user_id, ticket, when, idempotency=None):
+        fare = ticket['farePaid']
+        with self._transaction() as conn:
+            key_id = self._claim_idempotency(conn, idempotency) if idempotency is not None else None
+
+            row = conn.execute("SELECT wallet_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                raise PaymentError("User not found", 404)
+            if row[0] < fare:
+                raise PaymentError("Insufficient funds", 400)
+            new_balance = row[0] - fare
+
+            self._charge(conn, user_id, ticket, row[0], when, idempotency and idempotency['key'])
+
+            if key_id is not None:
+                self._store_idempotency(conn, key_id, idempotency, new_balance)
+        return new_balance
+
+    def _charge(self, conn, user_id, ticket, balance, when, idempotency_key=None):
+        """Debit ``ticket``'s fare from ``balance``, store the ticket and count it for its owner."""
+        fare = ticket['farePaid']
+        conn.execute("UPDATE users SET wallet_balance = wallet_balance - ? WHERE user_id = ?", (fare, user_id))
+        self._put_ledger_entry(conn, ledger_entry(
+            user_id, 'payment', self._next_seq(conn, user_id, balance, when), -fare, balance - fare, when,
+            payment_entry_id(ticket['ticketId']),
+            ticketId=ticket['ticketId'], idempotencyKey=idempotency_key
+        ))
+        timestamp = when if ticket.get('timestamp') is SERVER_TIMESTAMP else ticket['timestamp']
+        stored = {key: (when if value is SERVER_TIMESTAMP else value) for key, value in ticket.items()}
+        conn.execute(
+            "INSERT INTO tickets (ticket_id, user_id, owner_id, vehicle_id, timestamp, expires_at, status, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                ticket['ticketId'], ticket['userId'], ticket['ownerId'], ticket['vehicleId'],
+                _micros(timestamp),
+                _micros(ticket['expiresAt']) if isinstance(ticket.get('expiresAt'), datetime) else None,
+                ticket.get('status', 'valid'),
+                self._dumps(stored)
+            )
+        )
+        conn.execute(
+            "INSERT INTO owner_stats (owner_id, total_revenue, ticket_count) VALUES (?, ?, 1) "
+            "ON CONFLICT (owner_id) DO UPDATE SET total_revenue = total_revenue + excluded.total_revenue, "
+            "ticket_count = ticket_count + 1",
+            (ticket['ownerId'], fare)
+        )
+
+    def add_funds(self, user_id, amount, idempotency=None):
+        with self._transaction() as conn:
+            key_id = self._claim_idempotency(conn, idempotency) if idempotency is not None else None
+
+            row = conn.execute("SELECT wallet_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                raise PaymentError("User not found", 404)
+            new_balance = row[0] + amount
+            conn.execute("UPDATE users SET wallet_balance = wallet_balance + ? WHERE user_id = ?", (amount, user_id))
+            now = datetime.now(timezone.utc)
+            self._put_ledger_entry(conn, ledger_entry(
+                user_id, 'top-up', self._next_seq(conn, user_id, row[0], now), amount, new_balance, now,
+                idempotencyKey=idempotency and idempotency['key']
+            ))
+
+            if key_id is not None:
+                self._store_idempotency(conn, key_id, idempotency, new_balance)
+        return row[0], new_balance
+
+    def pay_batch(self, user_groups):
+        results = {}
+        recorded_at = datetime.now(timezone.utc)
+        for user_id, items in user_groups:
+            with self._transaction() as conn:
+                row = conn.execute("SELECT wallet_balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                balance = row[0] if row else None
+                for item in items:
+                    ticket = item['ticket']
+                    existing = conn.execute(
+                        "SELECT data FROM tickets WHERE ticket_id = ?", (ticket['ticketId'],)
+                    ).fetchone()
+                    if existing is not None:
+                        result = batch_result(item, 'duplicate', self._loads(existing[0]))
+                    elif balance is None:
+                        result = batch_result(item, 'failed', error="User not found")
+                    elif balance < ticket['farePaid']:
+                        result = batch_result(item, 'failed', error="Insufficient funds")
+                    else:
+                        self._charge(conn, user_id, ticket, balance, recorded_at, item['idempotencyKey'])
+                        balance -= ticket['farePaid']
+                        result = batch_result(item, 'created', ticket, new_balance=balance)
+                    results[item['index']] = result
+        return results
+
+    def get_idempotency_record(self, scope, key):
+        row = self._conn.execute(
+            "SELECT record FROM idempotency_keys WHERE key_id = ? AND expires_at > ?",
+            (idempotency_id(scope, key), _micros(datetime.now(timezone.utc)))
+        ).fetchone()
+        return json.loads(row[0], object_hook=_decode_hook) if row else None
+
+    # Wallet ledger
+    def _put_ledger_entry(self, conn, entry):
+        conn.execute(
+            "INSERT OR REPLACE INTO wallet_ledger (user_id, entry_id, seq, type, created_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (entry['userId'], entry['entryId'], entry['seq'], entry['type'], _micros(entry['createdAt']), self._dumps(entry))
+        )
+
+    def _next_seq(self, conn, user_id, balance, when):
+        # Writers hold the database lock, so the next number is unique. A user
+        # with no entries yet gets the opening entry for ``balance`` first.
+        row = conn.execute("SELECT MAX(seq) FROM wallet_ledger WHERE user_id = ?", (user_id,)).fetchone()
+        if row[0] is None:
+            seq, opening = ledger_start(user_id, {'walletBalance': balance}, when)
+            self._put_ledger_entry(conn, opening)
+            return seq + 1
+        return row[0] + 1
+
+    def ensure_wallet(self, user_id):
+        # wallet_balance is a NOT NULL column, so every stored user has one
+        pass
+
+    def iter_ledger(self, user_id, limit=None, before_seq=None):
+        sql = "SELECT data FROM wallet_ledger WHERE user_id = ?"
+        params = [user_id]
+        if before_seq is not None:
+            sql += " AND seq < ?"
+            params.append(before_seq)
+
+        sql += " ORDER BY seq DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        for (data,) in self._conn.execute(sql, params).fetchall():
+            yield self._loads(data)
+
+    def compact_ledger(self, cutoff, limit):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT data FROM wallet_ledger WHERE type != 'snapshot' AND created_at < ? ORDER BY created_at LIMIT ?",
+                (_micros(cutoff), limit)
+            ).fetchall()
+            entries = [self._loads(data) for (data,) in rows]
+            for (user_id, month), group in group_ledger_entries(entries).items():
+                row = conn.execute(
+                    "SELECT data FROM wallet_ledger WHERE user_id = ? AND entry_id = ?",
+                    (user_id, ledger_snapshot_id(month))
+                ).fetchone()
+                self._put_ledger_entry(conn, fold_ledger_entries(self._loads(row[0]) if row else None, group))
+                conn.executemany(
+                    "DELETE FROM wallet_ledger WHERE user_id = ? AND entry_id = ?",
+                    [(user_id, entry['entryId']) for entry in group]
+                )
+        if not entries:
+            return 0, None
+        return len(entries), max(entry['createdAt'] for entry in entries)
+
+    # Owner aggregates
+    def owner_totals(self, owner_id):
+        row = self._conn.execute(
+            "SELECT total_revenue, ticket_count FROM owner_stats WHERE owner_id = ?", (owner_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'totalRevenue': row[0], 'ticketCount': row[1]}
@@ -0,0 +1,136 @@
+"""Fixtures for the API tests: main.py on the SQLite backend, one database per test.
+
+``firestore_store`` swaps in the Firestore engine on the in-memory client from
+benchmarks/fake_firestore.py instead.
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.update(STORAGE_BACKEND='sqlite', SQLITE_PATH=':memory:', TICKET_TOKEN_SECRET='test-secret')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import main  # noqa: E402
+from storage import SQLiteStorage  # noqa: E402
+
+_CACHES = (
+    main._vehicle_cache, main._user_info_cache, main._idempotency_cache, main._ticket_cache,
+    main._login_uid_cache, main._custom_token_cache
+)
+
+@pytest.fixture
+def store(monkeypatch):
+    fresh = SQLiteStorage(':memory:')
+    monkeypatch.setattr(main, 'store', fresh)
+    for cache in _CACHES:
+        cache.clear()
+    return fresh
+
+@pytest.fixture
+def firestore_store(monkeypatch):
+    fake_firestore = pytest.importorskip('fake_firestore')
+    import firestore_storage
+
+    monkeypatch.setattr(firestore_storage, 'main', main)
+    monkeypatch.setattr(main, 'db', fake_firestore.FakeFirestore())
+    fresh = firestore_storage.FirestoreStorage()
+    monkeypatch.setattr(main, 'store', fresh)
+    for cache in _CACHES:
+        cache.clear()
+    return fresh
+
+@pytest.fixture
+def fs_client(firestore_store):
+    """A test client for the app on the Firestore engine, with rider-1 and BUS-1 as above."""
+    firestore_store.create_user('rider-1', {'uid': 'rider-1', 'email': 'rider@example.com', 'fullName': 'Rider', 'walletBalance': 100})
+    owner = main._new_owner_data('owner-1', 'owner@example.com', 'Owner', 'BUS-1', fixed_fare=15)
+    firestore_store.create_owner('owner-1', owner, main._vehicle_index_entry('owner-1', owner))
+    return main.app.test_client()
+
+@pytest.fixture
+def client(store):
+    return main.app.test_client()
+
+@pytest.fixture
+def rider(store):
+    """A passenger with ₹100 in their wallet."""
+    store.create_user('rider-1', {'uid': 'rider-1', 'email': 'rider@example.com', 'fullName': 'Rider', 'walletBalance': 100})
+    return 'rider-1'
+
+@pytest.fixture
+def bus(store):
+    """Vehicle BUS-1 with a ₹15 fare and 30-minute tickets."""
+    owner = main._new_owner_data('owner-1', 'owner@example.com', 'Owner', 'BUS-1', fixed_fare=15)
+    store.create_owner('owner-1', owner, main._vehicle_index_entry('owner-1', owner))
+    return 'BUS-1'
+
+@pytest.fixture
+def spy(monkeypatch):
+    """``spy(obj, name)``: a list that records the args of every call to ``obj.name``."""
+    def install(obj, name):
+        calls = []
+        original = getattr(obj, name)
+
+        def wrapper(*args, **kwargs):
+            calls.append(args)
+            return original(*args, **kwargs)
+
+        monkeypatch.setattr(obj, name, wrapper)
+        return calls
+    return install
+
+@pytest.fixture
+def pages(client):
+    """``pages(path, limit)``: every item of a paged listing, following X-Next-Cursor."""
+    def fetch(path, limit):
+        items, after = [], None
+        while True:
+            query = f"?limit={limit}" + (f"&after={after}" if after else "")
+            response = client.get(path + query)
+            assert response.status_code == 200, response.get_json()
+            items += response.get_json()
+            after = response.headers.get('X-Next-Cursor')
+            if not after:
+                return items
+    return fetch
+
+@pytest.fixture
+def asgi_client(store):
+    """``asgi_client(method, path, body=None)``: ``(status, headers, body bytes)`` from asgi.app."""
+    import asgi
+
+    async def call(method, path, body):
+        path, _, query = path.partition('?')
+        raw = json.dumps(body).encode() if body is not None else b''
+        headers = [(b'host', b'localhost')]
+        if body is not None:
+            headers.append((b'content-type', b'application/json'))
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(), 'headers': headers,
+            'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80), 'root_path': ''
+        }
+        messages = [{'type': 'http.request', 'body': raw, 'more_body': False}]
+        response = {'body': b''}
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = {name.decode(): value.decode() for name, value in message['headers']}
+            else:
+                response['body'] += message.get('body', b'')
+
+        await asgi.app(scope, receive, send)
+        return response['status'], response['headers'], response['body']
+
+    return lambda method, path, body=None: asyncio.run(call(method, path, body))
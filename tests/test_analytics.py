@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta, timezone
+
+import main
+
+def pay(client):
+    assert client.post('/pay', json={'userId': 'rider-1', 'vehicleId': 'BUS-1'}).status_code == 201
+
+def test_analytics_reads_only_the_rollup(fs_client):
+    for _ in range(3):
+        pay(fs_client)
+    main.roll_up_owner_analytics()
+    reads = main.db.stats['reads']
+
+    body = fs_client.get("/owner-analytics/owner-1").get_json()
+
+    assert main.db.stats['reads'] - reads == 1
+    assert (body['totalRevenue'], body['ticketCount'], body['activeTickets'], body['uniquePassengers']) == (45, 3, 3, 1)
+    assert body['today']['ticketCount'] == body['month']['ticketCount'] == 3
+    assert len(body['daily']) == main.ANALYTICS_DAYS
+
+def test_scheduled_rollup_refolds_owners_paid_since_the_last_run(fs_client, firestore_store):
+    owner = main._new_owner_data('owner-2', 'two@example.com', 'Two', 'BUS-2', fixed_fare=10)
+    firestore_store.create_owner('owner-2', owner, main._vehicle_index_entry('owner-2', owner))
+    assert main.roll_up_owner_analytics() == 2
+
+    pay(fs_client)
+
+    assert main.roll_up_owner_analytics() == 1
+    assert fs_client.get("/owner-analytics/owner-1").get_json()['ticketCount'] == 1
+    assert fs_client.get("/owner-analytics/owner-2").get_json()['ticketCount'] == 0
+
+def test_active_tickets_are_counted_at_read_time(fs_client, monkeypatch):
+    pay(fs_client)
+    main.roll_up_owner_analytics()
+    later = datetime.now(timezone.utc) + timedelta(minutes=31)
+    monkeypatch.setattr(main, 'ANALYTICS_ROLLUP_MAX_AGE', 3600)
+    monkeypatch.setattr(main, 'datetime', type('LaterDatetime', (datetime,), {'now': staticmethod(lambda tz=None: later)}))
+
+    reads = main.db.stats['reads']
+    body = fs_client.get("/owner-analytics/owner-1").get_json()
+
+    assert main.db.stats['reads'] - reads == 1
+    assert (body['activeTickets'], body['expiredTickets']) == (0, 1)
+
+def test_stale_rollup_is_refolded_on_read(fs_client, monkeypatch):
+    pay(fs_client)
+    main.roll_up_owner_analytics()
+    pay(fs_client)
+    monkeypatch.setattr(main, 'ANALYTICS_ROLLUP_MAX_AGE', 0)
+
+    assert fs_client.get("/owner-analytics/owner-1").get_json()['ticketCount'] == 2
+
+def test_analytics_is_firestore_only(client, store):
+    assert client.get("/owner-analytics/owner-1").status_code == 501
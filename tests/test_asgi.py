@@ -0,0 +1,78 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import main
+
+asgi = pytest.importorskip('asgi')
+
+def environ(path):
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [(b'host', b'localhost')],
+        'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80), 'root_path': ''
+    }
+    return asgi._environ(scope, b'')
+
+def test_streamed_listing_matches_flask(client, asgi_client, rider, bus):
+    for _ in range(3):
+        client.post('/pay', json={'userId': rider, 'vehicleId': bus})
+
+    status, headers, body = asgi_client('GET', '/get-owner-tickets/owner-1?stream=1')
+
+    assert status == 200
+    flask_ids = [ticket['ticketId'] for ticket in client.get('/get-owner-tickets/owner-1?stream=1').get_json()]
+    assert [ticket['ticketId'] for ticket in json.loads(body)] == flask_ids
+
+def test_streams_past_the_cap_get_503(store, monkeypatch):
+    monkeypatch.setattr(asgi, '_open_streams', asgi.ASGI_STREAM_THREADS)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi._serve_stream(environ('/stream-owner-tickets/owner-1'), None, send))
+
+    assert sent[0]['status'] == 503
+
+def test_stream_is_closed_when_the_client_disconnects(monkeypatch):
+    closed = threading.Event()
+
+    def endless(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/event-stream')])
+
+        def events():
+            try:
+                while True:
+                    time.sleep(0.01)
+                    yield b": keepalive\n\n"
+            finally:
+                closed.set()
+        return events()
+
+    monkeypatch.setattr(main, 'app', endless)
+
+    async def serve():
+        bodies = []
+        gone = asyncio.Event()
+
+        async def receive():
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                bodies.append(message)
+                if len(bodies) == 3:
+                    gone.set()
+
+        await asyncio.wait_for(asgi._serve_stream({}, receive, send), timeout=5)
+        return bodies
+
+    bodies = asyncio.run(serve())
+
+    assert closed.is_set()
+    assert asgi._open_streams == 0
+    assert len(bodies) == 3 and all(body['more_body'] for body in bodies)
@@ -0,0 +1,45 @@
+"""The endpoints on the Firestore engine, against the in-memory client."""
+
+import main
+
+def pay(client, key=None):
+    headers = {'Idempotency-Key': key} if key else {}
+    return client.post('/pay', json={'userId': 'rider-1', 'vehicleId': 'BUS-1'}, headers=headers)
+
+def test_pay_updates_wallet_ticket_ledger_and_aggregates(fs_client, firestore_store):
+    body = pay(fs_client).get_json()
+
+    assert body['newBalance'] == 85
+    assert firestore_store.get_user('rider-1')['walletBalance'] == 85
+    assert firestore_store.owner_totals('owner-1') == {'totalRevenue': 15, 'ticketCount': 1}
+    assert [entry['type'] for entry in fs_client.get("/wallet-history/rider-1").get_json()] == ['payment', 'opening']
+    [ticket] = fs_client.get("/get-owner-tickets/owner-1").get_json()
+    assert (ticket['ticketId'], ticket['userName'], ticket['isValid']) == (body['ticketId'], 'Rider', True)
+
+def test_pay_rejects_insufficient_funds(fs_client, firestore_store):
+    firestore_store.update_user('rider-1', {'walletBalance': 10})
+
+    response = pay(fs_client)
+
+    assert response.status_code == 400
+    assert firestore_store.get_user('rider-1')['walletBalance'] == 10
+
+def test_pay_replays_idempotency_key(fs_client, firestore_store):
+    first = pay(fs_client, key='scan-1').get_json()
+    main._idempotency_cache.clear()
+    second = pay(fs_client, key='scan-1')
+
+    assert second.headers.get('Idempotent-Replayed') == 'true'
+    assert second.get_json()['ticketId'] == first['ticketId']
+    assert firestore_store.get_user('rider-1')['walletBalance'] == 85
+
+def test_listings_page_newest_first(fs_client):
+    ticket_ids = [pay(fs_client).get_json()['ticketId'] for _ in range(5)]
+
+    first = fs_client.get("/get-user-tickets/rider-1?limit=3")
+    rest = fs_client.get(f"/get-user-tickets/rider-1?limit=3&after={first.headers['X-Next-Cursor']}")
+
+    listed = [ticket['ticketId'] for ticket in first.get_json() + rest.get_json()]
+    assert sorted(listed) == sorted(ticket_ids) and len(set(listed)) == 5
+    assert 'X-Next-Cursor' not in rest.headers
+    assert fs_client.get("/get-user-tickets/rider-1?limit=3&after=nope").status_code == 400
@@ -0,0 +1,16 @@
+"""Firestore engine helpers that need no Firestore project."""
+
+import firestore_storage
+
+def chunk_writes(chunk):
+    return sum(2 + 5 * len(items) for _, items in chunk)
+
+def test_payment_transactions_stay_under_the_write_limit():
+    groups = [(f"user-{n}", [object()]) for n in range(100)] + [('heavy', [object()] * 250)]
+
+    chunks = firestore_storage._pack_payment_transactions(groups)
+
+    assert all(chunk_writes(chunk) <= 500 for chunk in chunks)
+    assert [len(chunk) for chunk in chunks[:2]] == [71, 29]
+    assert [len(items) for user, items in (part for chunk in chunks for part in chunk) if user == 'heavy'] == [99, 99, 52]
+    assert sum(len(items) for chunk in chunks for _, items in chunk) == 350
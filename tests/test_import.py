@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+class FakeImportAuth:
+    """The slice of firebase_admin.auth that account imports use."""
+
+    ImportUserRecord = staticmethod(lambda **fields: SimpleNamespace(**fields))
+    UidIdentifier = staticmethod(lambda uid: ('uid', uid))
+    EmailIdentifier = staticmethod(lambda email: ('email', email))
+    UserImportHash = SimpleNamespace(pbkdf2_sha256=lambda rounds: ('pbkdf2_sha256', rounds))
+
+    def __init__(self):
+        self.users = {}
+        self.calls = []
+
+    def get_users(self, identifiers):
+        found = [user for user in self.users.values() if ('uid', user.uid) in identifiers or ('email', user.email) in identifiers]
+        return SimpleNamespace(users=found)
+
+    def import_users(self, records, hash_alg=None):
+        self.calls.append(len(records))
+        for record in records:
+            self.users[record.uid] = SimpleNamespace(uid=record.uid, email=record.email)
+        return SimpleNamespace(errors=[])
+
+@pytest.fixture
+def fake_auth(store, monkeypatch):
+    auth = FakeImportAuth()
+    monkeypatch.setattr(main, 'auth', auth)
+    monkeypatch.setattr(main, 'ADMIN_API_KEY', 'admin-key')
+    monkeypatch.setattr(main, 'IMPORT_HASH_ROUNDS', 1)
+    return auth
+
+def upload(client, kind, body, mimetype='text/csv', key='admin-key'):
+    return client.post(f"/import/{kind}", data=body, content_type=mimetype, headers={'Authorization': f"Bearer {key}"})
+
+def test_import_creates_owners_and_reports_each_row(client, store, fake_auth):
+    body = "email,fullName,vehicleId,fixedFare\na@x.com,A,BUS-1,20\nb@x.com,B,BUS-1,\nbad,C,BUS-3,\nd@x.com,D,BUS-4,-5\n"
+
+    response = upload(client, 'owners', body)
+
+    summary, results = response.get_json()['summary'], response.get_json()['results']
+    assert (summary['created'], summary['failed'], summary['rows']) == (1, 3, 4)
+    assert [(result['row'], result['status']) for result in results] == [(1, 'created'), (2, 'failed'), (3, 'failed'), (4, 'failed')]
+    assert results[1]['error'] == 'Duplicate vehicleId (row 1)'
+    assert client.get("/get-vehicle-fare/BUS-1").get_json()['fare'] == 20
+    assert fake_auth.calls == [1]
+
+def test_import_again_reports_existing_rows(client, store, fake_auth, monkeypatch):
+    monkeypatch.setattr(main, 'IMPORT_CHUNK_SIZE', 2)
+    body = "\n".join(f'{{"email": "rider{i}@x.com", "fullName": "Rider {i}"}}' for i in range(5))
+
+    first = upload(client, 'users', body, mimetype='application/x-ndjson').get_json()
+    again = upload(client, 'users', body, mimetype='application/x-ndjson').get_json()
+
+    assert first['summary']['created'] == 5 and sorted(fake_auth.calls) == [1, 2, 2]
+    assert again['summary']['exists'] == 5 and len(fake_auth.calls) == 3
+    assert store.get_user(first['results'][0]['uid'])['fullName'] == 'Rider 0'
+
+def test_import_refuses_accounts_held_by_someone_else(client, store, fake_auth):
+    fake_auth.users['other'] = SimpleNamespace(uid='other', email='taken@x.com')
+
+    [result] = upload(client, 'users', "email,fullName\ntaken@x.com,Taken\n").get_json()['results']
+
+    assert (result['status'], result['error']) == ('failed', 'Email already registered')
+
+def test_import_needs_the_admin_key(client, fake_auth):
+    assert upload(client, 'users', "email,fullName\na@x.com,A\n", key='wrong').status_code == 401
+    assert upload(client, 'users', "email,fullName\na@x.com,A\n", mimetype='text/plain').status_code == 400
+    assert upload(client, 'buses', "email,fullName\na@x.com,A\n").status_code == 404
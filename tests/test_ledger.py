@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta, timezone
+
+def history(pages, user_id, limit=2):
+    return pages(f"/wallet-history/{user_id}", limit)
+
+def assert_reconciles(entries, balance):
+    """Entries (newest first) number 1..n without gaps and add up to ``balance``."""
+    seqs = [entry['seq'] for entry in entries if entry['type'] != 'snapshot']
+    assert seqs == sorted(seqs, reverse=True)
+    assert entries[0]['balanceAfter'] == balance
+    assert sum(entry['amount'] for entry in entries) == balance
+
+def test_new_user_ledger_opens_with_starting_balance(pages, rider):
+    entries = history(pages, rider)
+
+    assert [(entry['type'], entry['seq'], entry['amount']) for entry in entries] == [('opening', 1, 100)]
+
+def test_payments_and_top_ups_are_recorded(client, store, pages, rider, bus):
+    ticket_id = client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketId']
+    client.post('/add-funds', json={'userId': rider, 'amount': 50}, headers={'Idempotency-Key': 'top-up-1'})
+    client.post('/add-funds', json={'userId': rider, 'amount': 50}, headers={'Idempotency-Key': 'top-up-1'})
+
+    entries = history(pages, rider)
+
+    assert [(entry['type'], entry['seq']) for entry in entries] == [('top-up', 3), ('payment', 2), ('opening', 1)]
+    assert entries[0]['idempotencyKey'] == 'top-up-1'
+    assert entries[1]['ticketId'] == ticket_id
+    assert_reconciles(entries, store.get_user(rider)['walletBalance'])
+
+def test_user_from_before_the_ledger_gets_an_opening_entry(client, store, pages, bus):
+    # Written the way rows were before the ledger existed: no entries at all
+    with store._transaction() as conn:
+        conn.execute(
+            "INSERT INTO users (user_id, wallet_balance, data) VALUES (?, ?, ?)",
+            ('legacy', 60, store._dumps({'fullName': 'Legacy'}))
+        )
+
+    client.post('/pay', json={'userId': 'legacy', 'vehicleId': bus})
+    entries = history(pages, 'legacy')
+
+    assert [(entry['type'], entry['seq'], entry['amount']) for entry in entries] == [('payment', 2, -15), ('opening', 1, 60)]
+    assert_reconciles(entries, 45)
+
+def test_compaction_keeps_the_ledger_reconciled(client, store, pages, rider, bus):
+    for _ in range(3):
+        client.post('/pay', json={'userId': rider, 'vehicleId': bus})
+
+    count, _ = store.compact_ledger(datetime.now(timezone.utc) + timedelta(seconds=1), 500)
+    client.post('/add-funds', json={'userId': rider, 'amount': 5})
+    entries = history(pages, rider)
+
+    assert count == 4
+    assert [entry['type'] for entry in entries] == ['top-up', 'snapshot']
+    assert entries[1]['entries'] == 4
+    assert_reconciles(entries, store.get_user(rider)['walletBalance'])
+
+def test_history_cursor_survives_compaction(client, store, rider, bus):
+    for _ in range(3):
+        client.post('/pay', json={'userId': rider, 'vehicleId': bus})
+    first = client.get(f"/wallet-history/{rider}?limit=1")
+    cursor = first.headers['X-Next-Cursor']
+
+    store.compact_ledger(datetime.now(timezone.utc) + timedelta(seconds=1), 500)
+    client.post('/add-funds', json={'userId': rider, 'amount': 5})
+    rest = client.get(f"/wallet-history/{rider}?limit=10&after={cursor}")
+
+    assert cursor == '4'
+    assert rest.status_code == 200 and rest.get_json() == []
+    assert client.get(f"/wallet-history/{rider}?limit=2&after=bogus").status_code == 400
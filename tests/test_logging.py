@@ -0,0 +1,46 @@
+import json
+import logging
+import queue
+
+import main
+
+def record(level=logging.DEBUG, **extra):
+    return logging.makeLogRecord({'name': 'cholo_pay', 'levelno': level, 'levelname': logging.getLevelName(level),
+                                  'msg': 'paid %s', 'args': ('BUS-1',), **extra})
+
+def test_request_id_is_reused_or_generated(client, store):
+    given = client.get("/get-vehicle-fare/NONE", headers={'X-Request-ID': 'scan-42'})
+    made_up = client.get("/get-vehicle-fare/NONE", headers={'X-Request-ID': 'not valid!'})
+
+    assert given.headers['X-Request-ID'] == 'scan-42'
+    assert len(made_up.headers['X-Request-ID']) == 32
+
+def test_unsampled_requests_drop_only_debug_lines():
+    log_filter = main._RequestContextFilter()
+    token = main._log_context.set(('req-1', '/pay', False))
+    try:
+        debug, info = record(), record(logging.INFO)
+        assert log_filter.filter(debug) is False
+        assert log_filter.filter(info) is True
+        assert (info.request_id, info.route, info.request_label) == ('req-1', '/pay', '[req-1] ')
+    finally:
+        main._log_context.reset(token)
+
+def test_sample_rates_are_clamped():
+    assert main._sample_rates(" /pay=0.1, /get-owner-tickets/<owner_id>=2 ,") == {
+        '/pay': 0.1, '/get-owner-tickets/<owner_id>': 1.0
+    }
+
+def test_json_lines_carry_extra_fields():
+    line = json.loads(main._JSONFormatter().format(record(logging.INFO, request_id='req-1', route='/pay', fare=15)))
+
+    assert (line['level'], line['message'], line['requestId'], line['fare']) == ('INFO', 'paid BUS-1', 'req-1', 15)
+
+def test_full_log_queue_drops_instead_of_blocking():
+    handler = main._QueueHandler(queue.Queue(1))
+
+    for _ in range(3):
+        handler.handle(record(logging.INFO))
+
+    assert handler.queue.get_nowait().msg == 'paid BUS-1'
+    assert handler.dropped == 2
@@ -0,0 +1,54 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+class FakeAuth:
+    """Firebase Auth stand-in: every user's uid is the part of their email before the @."""
+
+    def __init__(self):
+        self.signed = []
+
+    def get_user_by_email(self, email):
+        return SimpleNamespace(uid=email.split('@')[0])
+
+    def create_custom_token(self, uid):
+        time.sleep(0.05)
+        self.signed.append((uid, threading.current_thread().name))
+        return f"token-{uid}".encode()
+
+@pytest.fixture
+def fake_auth(store, monkeypatch):
+    auth = FakeAuth()
+    monkeypatch.setattr(main, 'auth', auth)
+    return auth
+
+def test_concurrent_logins_share_one_signature(client, fake_auth):
+    tokens = []
+    logins = [
+        threading.Thread(target=lambda: tokens.append(client.post('/login/user', json={'email': 'a@x.com'}).get_json()['token']))
+        for _ in range(8)
+    ]
+    for login in logins:
+        login.start()
+    for login in logins:
+        login.join()
+
+    assert tokens == ['token-a'] * 8
+    assert len(fake_auth.signed) == 1
+
+def test_flask_logins_sign_on_the_request_thread(client, fake_auth):
+    assert client.post('/login/owner', json={'email': 'b@x.com'}).get_json()['uid'] == 'b'
+
+    assert not fake_auth.signed[0][1].startswith('token-signer')
+
+def test_asgi_logins_sign_on_the_signing_pool(asgi_client, fake_auth):
+    status, _, body = asgi_client('POST', '/login/user', {'email': 'c@x.com'})
+
+    assert status == 200 and b'token-c' in body
+    assert fake_auth.signed[0][1].startswith('token-signer')
+    assert asgi_client('POST', '/login/user', {'email': 'c@x.com'})[0] == 200
+    assert len(fake_auth.signed) == 1
@@ -0,0 +1,5 @@
+def test_metrics_content_type_names_one_charset(client):
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta, timezone
+
+import main
+
+def pay(client, user_id, vehicle_id, key=None):
+    headers = {'Idempotency-Key': key} if key else {}
+    return client.post('/pay', json={'userId': user_id, 'vehicleId': vehicle_id}, headers=headers)
+
+def scan(user_id, vehicle_id, key, minutes_ago=0):
+    boarded_at = datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)
+    return {'userId': user_id, 'vehicleId': vehicle_id, 'idempotencyKey': key, 'clientTimestamp': boarded_at.isoformat()}
+
+def test_pay_debits_wallet_and_issues_ticket(client, store, rider, bus):
+    response = pay(client, rider, bus)
+
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['newBalance'] == 85
+    assert store.get_user(rider)['walletBalance'] == 85
+    assert store.owner_totals('owner-1') == {'totalRevenue': 15, 'ticketCount': 1}
+    assert client.get(f"/check-ticket-validity/{body['ticketId']}").get_json()['isValid'] is True
+
+def test_pay_rejects_insufficient_funds(client, store, rider, bus):
+    store.update_user(rider, {'walletBalance': 10})
+
+    response = pay(client, rider, bus)
+
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Insufficient funds"}
+
+def test_pay_unknown_user_and_vehicle(client, rider, bus):
+    assert pay(client, 'nobody', bus).status_code == 404
+    assert pay(client, rider, 'NO-SUCH-BUS').status_code == 404
+
+def test_pay_replays_idempotency_key(client, store, rider, bus):
+    first = pay(client, rider, bus, key='scan-1')
+    # A fresh process would not have the response cached
+    main._idempotency_cache.clear()
+    second = pay(client, rider, bus, key='scan-1')
+
+    assert second.status_code == 201
+    assert second.headers.get('Idempotent-Replayed') == 'true'
+    assert second.get_json()['ticketId'] == first.get_json()['ticketId']
+    assert store.get_user(rider)['walletBalance'] == 85
+    assert store.owner_totals('owner-1')['ticketCount'] == 1
+
+def test_idempotency_keys_are_per_user(client, store, rider, bus):
+    store.create_user('rider-2', {'fullName': 'Other', 'walletBalance': 50})
+
+    pay(client, rider, bus, key='same')
+    other = pay(client, 'rider-2', bus, key='same')
+
+    assert 'Idempotent-Replayed' not in other.headers
+    assert store.get_user('rider-2')['walletBalance'] == 35
+
+def test_batch_pay_applies_scans_in_boarding_order(client, store, rider, bus):
+    response = client.post('/pay/batch', json={'payments': [
+        scan(rider, bus, 'later', minutes_ago=1),
+        scan(rider, bus, 'earlier', minutes_ago=5),
+    ]})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['summary'] == {'created': 2, 'duplicate': 0, 'failed': 0}
+    assert [result['newBalance'] for result in body['results']] == [70, 85]
+    assert store.get_user(rider)['walletBalance'] == 70
+    assert store.owner_totals('owner-1') == {'totalRevenue': 30, 'ticketCount': 2}
+
+def test_batch_pay_reports_duplicates_and_failures(client, store, rider, bus):
+    first = client.post('/pay/batch', json={'payments': [scan(rider, bus, 'a')]}).get_json()
+    store.update_user(rider, {'walletBalance': 20})
+
+    body = client.post('/pay/batch', json=[
+        scan(rider, bus, 'a'),
+        scan(rider, bus, 'b'),
+        scan(rider, bus, 'c'),
+        scan('nobody', bus, 'd'),
+        scan(rider, 'NO-SUCH-BUS', 'e'),
+        {'userId': 'bad/id', 'vehicleId': bus, 'idempotencyKey': 'f', 'clientTimestamp': 0},
+        scan(rider, bus, 'b'),
+    ]).get_json()
+
+    results = body['results']
+    assert [result['status'] for result in results] == [
+        'duplicate', 'created', 'failed', 'failed', 'failed', 'failed', 'duplicate'
+    ]
+    assert results[0]['ticketId'] == first['results'][0]['ticketId']
+    assert results[2]['error'] == "Insufficient funds"
+    assert results[3]['error'] == "User not found"
+    assert results[4]['error'] == "Vehicle not found"
+    assert results[6]['ticketId'] == results[1]['ticketId']
+    assert store.get_user(rider)['walletBalance'] == 5
+
+def test_batch_pay_rejects_bad_client_timestamps_one_by_one(client, store, rider, bus):
+    bad = [1e300, -1e20, float('inf'), '1969-07-20T20:17:00Z', 'yesterday', None]
+    future = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+    payments = [{**scan(rider, bus, f"bad-{index}"), 'clientTimestamp': value} for index, value in enumerate(bad + [future])]
+
+    response = client.post('/pay/batch', json=payments + [scan(rider, bus, 'good')])
+
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == ['failed'] * 7 + ['created']
+    assert results[0]['error'] == results[3]['error'] == "clientTimestamp is out of range"
+    assert results[6]['error'] == "clientTimestamp is in the future"
+    assert store.get_user(rider)['walletBalance'] == 85
+
+def test_batch_pay_validates_the_batch_and_each_record(client, store, rider, bus, monkeypatch):
+    monkeypatch.setattr(main, 'MAX_BATCH_PAYMENTS', 2)
+    for body in ({'payments': []}, {'payments': 'x'}, {}, [scan(rider, bus, str(n)) for n in range(3)]):
+        assert client.post('/pay/batch', json=body).status_code == 400
+
+    no_key = {**scan(rider, bus, 'k'), 'idempotencyKey': ''}
+    no_time = {key: value for key, value in scan(rider, bus, 'k').items() if key != 'clientTimestamp'}
+    results = client.post('/pay/batch', json=[no_key, no_time]).get_json()['results']
+
+    assert [result['error'] for result in results] == ["idempotencyKey is required", "Missing field: 'clientTimestamp'"]
+    assert store.get_user(rider)['walletBalance'] == 100
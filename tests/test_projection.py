@@ -0,0 +1,33 @@
+def test_fields_trim_the_listing_and_its_reads(client, store, rider, bus, spy):
+    ticket_id = client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketId']
+    queries = spy(store, 'iter_tickets')
+
+    response = client.get(f"/get-user-tickets/{rider}?fields=ticketId,farePaid,isValid")
+
+    assert response.get_json() == [{'ticketId': ticket_id, 'farePaid': 15, 'isValid': True}]
+    assert queries[0][4] == ['expiresAt', 'farePaid', 'status', 'ticketId']
+
+def test_columns_format(client, rider, bus):
+    ticket_id = client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketId']
+
+    body = client.get("/get-owner-tickets/owner-1?fields=ticketId,userName&format=columns").get_json()
+    streamed = client.get("/get-owner-tickets/owner-1?fields=ticketId,userName&format=columns&stream=1").get_json()
+
+    assert body == {'fields': ['ticketId', 'userName'], 'rows': [[ticket_id, 'Rider']]}
+    assert streamed == body
+
+def test_columns_without_fields_lists_every_field(client, rider, bus):
+    client.post('/pay', json={'userId': rider, 'vehicleId': bus})
+
+    body = client.get(f"/get-user-tickets/{rider}?format=columns").get_json()
+
+    assert 'userName' not in body['fields']
+    assert len(body['rows'][0]) == len(body['fields'])
+    assert dict(zip(body['fields'], body['rows'][0]))['farePaid'] == 15
+
+def test_unknown_fields_are_rejected(client, rider):
+    response = client.get(f"/get-user-tickets/{rider}?fields=ticketId,userName")
+
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('Unknown ticket fields: userName.')
+    assert client.get("/get-owner-tickets/owner-1?fields=,").status_code == 400
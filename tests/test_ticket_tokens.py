@@ -0,0 +1,49 @@
+import pytest
+
+import main
+
+@pytest.fixture
+def token(client, rider, bus):
+    return client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketToken']
+
+def test_token_verifies_without_a_ticket_read(client, store, token, monkeypatch):
+    monkeypatch.setattr(store, 'get_tickets', None)
+
+    claims = client.get(f"/verify-ticket-token/{token}").get_json()
+
+    assert claims['isValid'] and claims['status'] == 'valid' and claims['vehicleId'] == 'BUS-1'
+    wrong = client.get(f"/verify-ticket-token/{token}?vehicleId=BUS-2").get_json()
+    assert wrong['status'] == 'wrong-vehicle' and not wrong['isValid']
+
+def test_tampered_and_expired_tokens(client, token):
+    payload, signature = token.split('.')
+    assert client.get(f"/verify-ticket-token/{payload}.{signature[:-2]}AA").status_code == 400
+    assert main.verify_ticket_token(token, now=4102444800)['status'] == 'expired'
+
+def test_revoked_tokens_stop_verifying(client, token, monkeypatch):
+    ticket_id = main.verify_ticket_token(token)['ticketId']
+    monkeypatch.setitem(main._revoked_tickets._revoked, ticket_id, 4102444800)
+
+    assert client.get(f"/verify-ticket-token/{token}").get_json()['status'] == 'revoked'
+
+def test_revoking_takes_the_admin_key(client, monkeypatch):
+    assert client.post('/revoke-ticket/t').status_code == 403
+    monkeypatch.setattr(main, 'ADMIN_API_KEY', 'admin-key')
+    assert client.post('/revoke-ticket/t', json={'ownerId': 'owner-1'}).status_code == 401
+    assert client.post('/revoke-ticket/t', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    # Past the key check, the SQLite backend has no revocation list
+    assert client.post('/revoke-ticket/t', headers={'Authorization': 'Bearer admin-key'}).status_code == 501
+
+def test_revoking_on_firestore(fs_client, monkeypatch):
+    monkeypatch.setattr(main, 'ADMIN_API_KEY', 'admin-key')
+    monkeypatch.setattr(main, '_revoked_tickets', main._RevocationSet(main.REVOCATION_REFRESH_SECONDS))
+    paid = fs_client.post('/pay', json={'userId': 'rider-1', 'vehicleId': 'BUS-1'}).get_json()
+    admin = {'Authorization': 'Bearer admin-key'}
+
+    response = fs_client.post(f"/revoke-ticket/{paid['ticketId']}", headers=admin)
+
+    assert response.get_json() == {'success': True, 'ticketId': paid['ticketId'], 'status': 'revoked'}
+    assert fs_client.get(f"/verify-ticket-token/{paid['ticketToken']}").get_json()['status'] == 'revoked'
+    assert fs_client.get(f"/check-ticket-validity/{paid['ticketId']}").get_json()['isValid'] is False
+    assert main.db.collection('revokedTickets').document(paid['ticketId']).get().get('ownerId') == 'owner-1'
+    assert fs_client.post("/revoke-ticket/nope", headers=admin).status_code == 404
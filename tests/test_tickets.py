@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta, timezone
+
+import main
+
+def board(client, user_id, vehicle_id, key, days_ago):
+    boarded_at = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    body = client.post('/pay/batch', json=[{
+        'userId': user_id, 'vehicleId': vehicle_id, 'idempotencyKey': key, 'clientTimestamp': boarded_at.isoformat()
+    }]).get_json()
+    return body['results'][0]['ticketId']
+
+def test_expiry_sweep_flips_lapsed_tickets_in_batches(client, store, rider, bus):
+    ticket_ids = [client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketId'] for _ in range(3)]
+    later = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    checkpoint = main.sweep_expired_tickets(cutoff=later, batch_size=2)
+
+    assert checkpoint['expired'] == 3
+    assert checkpoint['batches'] == 2
+    assert checkpoint['completedAt'] is not None
+    assert store.get_checkpoint('ticketExpiry')['sweptThrough'] == later
+    assert {ticket['status'] for ticket in store.get_tickets(ticket_ids).values()} == {'expired'}
+    assert main.sweep_expired_tickets(cutoff=later)['expired'] == 0
+
+def test_expiry_sweep_leaves_live_tickets(client, store, rider, bus):
+    ticket_id = client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketId']
+
+    assert main.sweep_expired_tickets()['expired'] == 0
+    assert store.get_tickets([ticket_id])[ticket_id]['status'] == 'valid'
+
+def test_archive_paging_continues_past_the_hot_tickets(client, store, rider, bus, pages):
+    store.update_user(rider, {'walletBalance': 1000})
+    old = [board(client, rider, bus, f"old-{day}", days_ago=200 + day) for day in range(7)]
+    recent = [board(client, rider, bus, f"new-{day}", days_ago=day) for day in range(3)]
+
+    checkpoint = main.archive_old_tickets(older_than_days=180)
+
+    assert checkpoint['archived'] == 7
+    assert store.get_tickets(old) == {}
+    newest_first = recent + old
+    for limit in (1, 2, 3, 10):
+        assert [ticket['ticketId'] for ticket in pages(f"/get-user-tickets/{rider}", limit)] == newest_first
+        assert [ticket['ticketId'] for ticket in pages("/get-owner-tickets/owner-1", limit)] == newest_first
+
+def test_archive_cursor_names_its_position(client, store, rider, bus):
+    store.update_user(rider, {'walletBalance': 1000})
+    old = [board(client, rider, bus, f"old-{day}", days_ago=200 + 40 * day) for day in range(3)]
+    main.archive_old_tickets(older_than_days=180)
+
+    response = client.get(f"/get-user-tickets/{rider}?limit=1")
+    cursor = response.headers['X-Next-Cursor']
+    assert cursor.startswith('archive:') and cursor.endswith(f":{old[0]}")
+    expired = client.get(f"/get-tickets-by-status/owner-1/expired?limit=2&after={cursor}")
+    assert [ticket['ticketId'] for ticket in expired.get_json()] == old[1:]
+    assert client.get(f"/get-user-tickets/{rider}?limit=1&after=archive:soon:{old[0]}").status_code == 400
+
+def test_archived_tickets_are_not_valid(client, rider, bus):
+    ticket_id = board(client, rider, bus, 'old', days_ago=200)
+    main.archive_old_tickets(older_than_days=180)
+
+    response = client.get(f"/check-ticket-validity/{ticket_id}")
+
+    assert response.status_code == 404
+
+def test_unknown_cursor_is_rejected(client, rider, bus):
+    client.post('/pay', json={'userId': rider, 'vehicleId': bus})
+
+    for path in (f"/get-user-tickets/{rider}", "/get-owner-tickets/owner-1", "/get-tickets-by-status/owner-1/active"):
+        response = client.get(f"{path}?limit=1&after=no-such-ticket")
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Unknown cursor: no-such-ticket'}
+    assert client.get(f"/get-user-tickets/{rider}?stream=1&after=no-such-ticket").status_code == 400
+
+def test_listings_leave_out_server_fields(client, rider, bus):
+    token = client.post('/pay', json={'userId': rider, 'vehicleId': bus}).get_json()['ticketToken']
+
+    [mine] = client.get(f"/get-user-tickets/{rider}").get_json()
+    [theirs] = client.get("/get-owner-tickets/owner-1").get_json()
+    assert mine['ticketToken'] == token and 'recordedAt' not in mine
+    assert 'ticketToken' not in theirs and 'recordedAt' not in theirs
+    [streamed] = client.get(f"/get-user-tickets/{rider}?stream=1").get_json()
+    assert 'recordedAt' not in streamed
+
+def test_status_backfill_is_firestore_only(store):
+    result = main.app.test_cli_runner().invoke(args=['backfill-ticket-status'])
+
+    assert result.exit_code != 0 and 'STORAGE_BACKEND=sqlite' in result.output
+
+def test_owner_listing_reads_passengers_in_one_batch(client, store, rider, bus, spy):
+    store.create_user('rider-2', {'fullName': 'Other', 'email': 'other@example.com', 'walletBalance': 100})
+    for user_id in (rider, 'rider-2', rider):
+        client.post('/pay', json={'userId': user_id, 'vehicleId': bus})
+    lookups = spy(store, 'get_users')
+
+    first = client.get("/get-owner-tickets/owner-1").get_json()
+    again = client.get("/get-tickets-by-status/owner-1/active").get_json()
+
+    assert [(ticket['userName'], ticket['userEmail']) for ticket in first] == [
+        ('Rider', 'rider@example.com'), ('Other', 'other@example.com'), ('Rider', 'rider@example.com')
+    ]
+    assert [ticket['userName'] for ticket in again] == ['Rider', 'Other', 'Rider']
+    assert len(lookups) == 1 and sorted(lookups[0][0]) == [rider, 'rider-2']
+
+def test_owner_listing_names_missing_passengers(client, store, rider, bus):
+    client.post('/pay', json={'userId': rider, 'vehicleId': bus})
+    with store._transaction() as conn:
+        conn.execute("DELETE FROM users WHERE user_id = ?", (rider,))
+
+    [ticket] = client.get("/get-owner-tickets/owner-1").get_json()
+
+    assert (ticket['userName'], ticket['userEmail']) == ('Unknown User', 'No email')
+
+def test_normalization_judges_a_batch_against_one_now():
+    now = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+    naive_expiry = datetime(2026, 1, 1, 12, 10)
+    tickets = [
+        {'status': 'valid', 'timestamp': now, 'expiresAt': now + timedelta(minutes=5)},
+        {'status': 'valid', 'expiresAt': now},
+        {'status': 'revoked', 'expiresAt': now + timedelta(minutes=5)},
+        {'status': 'valid', 'expiresAt': naive_expiry},
+    ]
+
+    live, lapsed, revoked, naive = main._normalize_tickets(tickets, main._epoch_micros(now))
+
+    assert (live['isValid'], live['isActive'], live['timeRemaining']) == (True, True, 300.0)
+    assert live['timestamp'] == {'seconds': int(now.timestamp())}
+    assert live['expiresAt'] == (now + timedelta(minutes=5)).isoformat()
+    assert (lapsed['isValid'], lapsed['timeRemaining']) == (False, 0)
+    assert revoked['isValid'] is False
+    assert naive['timeRemaining'] == 600.0
+
+def test_only_listings_default_a_missing_status():
+    now = main._now_micros()
+
+    [listed] = main._normalize_tickets([{'ticketId': 't'}], now)
+    [checked] = main._normalize_tickets([{'ticketId': 't'}], now, defaults={})
+
+    assert (listed['status'], listed['vehicleId'], listed['farePaid'], listed['isValid']) == ('valid', 'Unknown', 0, True)
+    assert 'status' not in checked and checked['isValid'] is False
+    assert main._validity_body('t', {'expiresAt': None}, now)['isValid'] is False
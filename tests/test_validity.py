@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta, timezone
+
+import main
+
+def buy(client, user_id, vehicle_id):
+    return client.post('/pay', json={'userId': user_id, 'vehicleId': vehicle_id}).get_json()['ticketId']
+
+def test_batch_check_reads_once_and_reports_each_ticket(client, store, rider, bus, spy):
+    lapsed = buy(client, rider, bus)
+    store.expire_tickets(datetime.now(timezone.utc) + timedelta(hours=1), 500)
+    live = buy(client, rider, bus)
+    reads = spy(store, 'get_tickets')
+
+    body = client.post('/check-ticket-validity/batch', json={'ticketIds': [live, lapsed, 'nope', live]}).get_json()
+
+    assert len(reads) == 1 and sorted(reads[0][0]) == sorted([live, lapsed, 'nope'])
+    assert body['summary'] == {'valid': 1, 'invalid': 2}
+    assert body['results'][live]['isValid'] is True
+    assert (body['results'][lapsed]['isValid'], body['results'][lapsed]['status']) == (False, 'expired')
+    assert body['results']['nope'] == {'isValid': False, 'status': 'not-found'}
+
+def test_batch_check_serves_repeats_from_cache(client, store, rider, bus, spy):
+    ticket_id = buy(client, rider, bus)
+    client.post('/check-ticket-validity/batch', json={'ticketIds': [ticket_id]})
+    reads = spy(store, 'get_tickets')
+
+    body = client.post('/check-ticket-validity/batch', json={'ticketIds': [ticket_id]}).get_json()
+
+    assert reads == []
+    assert body['results'][ticket_id]['isValid'] is True
+
+def test_batch_check_rejects_tickets_for_another_vehicle(client, rider, bus):
+    ticket_id = buy(client, rider, bus)
+
+    body = client.post('/check-ticket-validity/batch', json={'ticketIds': [ticket_id], 'vehicleId': 'BUS-2'}).get_json()
+
+    assert body['results'][ticket_id]['status'] == 'wrong-vehicle'
+    assert body['results'][ticket_id]['isValid'] is False
+
+def test_batch_check_validates_its_body(client, store):
+    too_many = [f"t{i}" for i in range(main.MAX_BATCH_TICKET_CHECKS + 1)]
+
+    for body in ({'ticketIds': 'x'}, {'ticketIds': []}, {'ticketIds': ['a/b']}, {'ticketIds': too_many}):
+        assert client.post('/check-ticket-validity/batch', json=body).status_code == 400
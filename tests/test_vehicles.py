@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import main
+
+def test_fare_lookups_are_cached(client, store, bus, spy):
+    lookups = spy(store, 'get_vehicle')
+
+    for _ in range(3):
+        response = client.get(f"/get-vehicle-fare/{bus}")
+
+    assert response.get_json() == {'success': True, 'fare': 15, 'validityMinutes': 30, 'vehicleId': bus}
+    assert len(lookups) == 1
+
+def test_fare_change_invalidates_the_cache(client, bus):
+    client.get(f"/get-vehicle-fare/{bus}")
+
+    client.post('/update-owner-settings', json={'ownerId': 'owner-1', 'fixedFare': 20, 'ticketValidityMinutes': 45})
+
+    body = client.get(f"/get-vehicle-fare/{bus}").get_json()
+    assert (body['fare'], body['validityMinutes']) == (20, 45)
+
+def test_unknown_vehicle(client, store):
+    assert client.get("/get-vehicle-fare/NO-SUCH-BUS").status_code == 404
+
+def test_vehicle_can_only_be_registered_once(client, bus, monkeypatch):
+    created = []
+    monkeypatch.setattr(main, 'auth', SimpleNamespace(create_user=lambda **kwargs: created.append(kwargs)))
+
+    response = client.post('/register/owner', json={
+        'email': 'second@example.com', 'password': 'secret', 'fullName': 'Second', 'vehicleId': bus
+    })
+
+    assert response.status_code == 409
+    assert created == []